@@ -1,6 +1,10 @@
 # COSC 530 ISA Emulator Project
 # ELF Portion
+import mmap
 import struct
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
 
 # '<' specifies little-endian byte order
 # '4s' corresponds to the ELF magic number (4 bytes)
@@ -16,66 +20,168 @@ PROGRAM_HEADER_FORMAT = '<IIIIIIII'
 # 8 * 4 = 32 bytes (each 'I' represents a 4-byte unsigned int, and there are 8 fields)
 PROGRAM_HEADER_SIZE = 32
 
+# Section header: name, type, flags, addr, offset, size, link, info, addralign, entsize (10 * 4 = 40 bytes)
+SECTION_HEADER_FORMAT = '<IIIIIIIIII'
+SECTION_HEADER_SIZE = 40
+# Symbol: name, value, size, info, other, section index (4 * 3 + 1 + 1 + 2 = 16 bytes)
+SYMBOL_FORMAT = '<IIIBBH'
+SYMBOL_SIZE = 16
+
 # Constants for checking the ELF file
 ELF_MAGIC = b'\x7fELF'
 RISC_V_MACHINE = 243
 PT_LOAD = 1
-
-def load_elf(filename):
-    with open(filename, 'rb') as file:
-        # Read ELF header
-        elf_header_data = file.read(ELF_HEADER_SIZE)
-        elf_header = struct.unpack(ELF_HEADER_FORMAT, elf_header_data)
+SHT_SYMTAB = 2
+SHF_EXECINSTR = 0x4
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+STT_NOTYPE = 0
+STT_FUNC = 2
+
+Symbol = namedtuple('Symbol', ['name', 'start', 'end'])
+
+class SymbolTable:
+    # Function address ranges sorted by start, so a PC is mapped to its function with one binary search.
+    # Symbols without a size (assembly labels such as _start) extend to the next symbol.
+    def __init__(self, symbols=()):
+        self.starts = array('I')
+        self.ends = array('Q')
+        self.names = []
+        # At a shared address the sized symbol wins over aliases and labels
+        for start, size, name in sorted(symbols, key=lambda symbol: (symbol[0], -symbol[1], symbol[2])):
+            if self.starts and self.starts[-1] == start:
+                continue
+            self.starts.append(start)
+            self.ends.append(start + size if size else 0)
+            self.names.append(name)
+        for index, end in enumerate(self.ends):
+            if not end:
+                self.ends[index] = self.starts[index + 1] if index + 1 < len(self.starts) else 1 << 32
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, address):
+        # Symbol containing address, or None
+        index = bisect_right(self.starts, address) - 1
+        if index >= 0 and address < self.ends[index]:
+            return Symbol(self.names[index], self.starts[index], self.ends[index])
+        return None
+
+    def name(self, address):
+        symbol = self.lookup(address)
+        return symbol.name if symbol is not None else f'0x{address:08x}'
+
+class ElfFile:
+    # Read-only mapping of an ELF executable. Segment contents are views into the mapping, so the
+    # file is never copied into Python objects and the page cache is shared by every loader.
+    def __init__(self, filename):
+        with open(filename, 'rb') as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = struct.unpack_from(ELF_HEADER_FORMAT, self.mapping, 0)
 
         # Verify ELF header
-        if elf_header[0] != ELF_MAGIC:
+        if self.header[0] != ELF_MAGIC:
             raise ValueError("Not an ELF file")
-        if elf_header[10] != 2:
+        if self.header[6] != 2:
             raise ValueError("Not an executable file")
-        if elf_header[11] != RISC_V_MACHINE:
+        if self.header[7] != RISC_V_MACHINE:
             raise ValueError("Not a RISC-V file")
-        if elf_header[4] != 1:
+        if self.header[1] != 1:
             raise ValueError("Not a 32-bit file")
 
-        e_phoff = elf_header[9]
-        e_phnum = elf_header[17]
-        e_entry = elf_header[8]
+        self.entry = self.header[9]
+        e_phoff = self.header[10]
+        e_phentsize = self.header[14]
+        e_phnum = self.header[15]
+        self.program_headers = [struct.unpack_from(PROGRAM_HEADER_FORMAT, self.mapping, e_phoff + i * e_phentsize) for i in range(e_phnum)]
+        self.symbol_table = None
+
+    def load_segments(self):
+        return [ph for ph in self.program_headers if ph[0] == PT_LOAD]
+
+    def segment_data(self, ph):
+        # File-backed part of a segment; release the view before closing the file
+        return memoryview(self.mapping)[ph[1]:ph[1] + ph[4]]
+
+    def section_headers(self):
+        # Section headers are optional for execution; they are only read for the symbol table
+        e_shoff = self.header[11]
+        e_shentsize = self.header[16]
+        e_shnum = self.header[17] if e_shoff else 0
+        if e_shnum and (e_shentsize < SECTION_HEADER_SIZE or e_shoff + e_shnum * e_shentsize > len(self.mapping)):
+            raise ValueError("Section header table outside the file")
+        return [struct.unpack_from(SECTION_HEADER_FORMAT, self.mapping, e_shoff + i * e_shentsize) for i in range(e_shnum)]
+
+    def string(self, sh, offset):
+        # NUL-terminated string from a string table section
+        start = sh[4] + offset
+        end = self.mapping.find(b'\0', start, sh[4] + sh[5])
+        if offset >= sh[5] or end < 0:
+            raise ValueError("Symbol name outside its string table")
+        return self.mapping[start:end].decode('utf-8', 'replace')
+
+    def symbols(self):
+        # SymbolTable of the functions in .symtab, built once. Stripped files and files whose section or
+        # symbol tables are malformed get an empty table, since symbols are not needed to run.
+        if self.symbol_table is None:
+            try:
+                self.symbol_table = SymbolTable(self.read_symbols())
+            except (ValueError, struct.error):
+                self.symbol_table = SymbolTable()
+        return self.symbol_table
+
+    def read_symbols(self):
+        # (value, size, name) of every function symbol; raises ValueError on out-of-range indices or offsets
+        sections = self.section_headers()
+        size = len(self.mapping)
+        symbols = []
+        for sh in sections:
+            if sh[1] != SHT_SYMTAB:
+                continue
+            if sh[6] >= len(sections):
+                raise ValueError("Symbol table links to a missing string table")
+            strtab = sections[sh[6]]
+            if sh[4] + sh[5] > size or strtab[4] + strtab[5] > size:
+                raise ValueError("Symbol or string table outside the file")
+            for offset in range(sh[4], sh[4] + sh[5] - SYMBOL_SIZE + 1, SYMBOL_SIZE):
+                st_name, st_value, st_size, st_info, st_other, st_shndx = struct.unpack_from(SYMBOL_FORMAT, self.mapping, offset)
+                kind = st_info & 0xf
+                if kind not in (STT_FUNC, STT_NOTYPE) or st_shndx == SHN_UNDEF or st_shndx >= SHN_LORESERVE:
+                    continue
+                if st_shndx >= len(sections):
+                    raise ValueError("Symbol in a missing section")
+                if kind == STT_NOTYPE and not sections[st_shndx][2] & SHF_EXECINSTR:
+                    continue  # Data labels
+                name = self.string(strtab, st_name)
+                if name and not name.startswith(('$', '.L')):  # Mapping symbols and local labels
+                    symbols.append((st_value, st_size, name))
+        return symbols
+
+    def close(self):
+        self.mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-        # Read and process program headers
-        file.seek(e_phoff)
-        for _ in range(e_phnum):
-            program_header_data = file.read(PROGRAM_HEADER_SIZE)
-            program_header = struct.unpack(PROGRAM_HEADER_FORMAT, program_header_data)
-
-            if program_header[0] == PT_LOAD:
-                copy_segment(file, program_header)
+def load_elf(filename):
+    with ElfFile(filename) as elf:
+        for program_header in elf.load_segments():
+            copy_segment(elf, program_header)
 
         # Set the program counter to the entry point
-        print(f"Entry point: 0x{e_entry:x}")
-
-# vaddr added for later
-def allocate_memory(size, vaddr):
-    memory = bytearray(size)
-    return memory
-
-def copy_segment(file, ph):
-    p_offset, p_vaddr, p_filesz, p_memsz = ph[1], ph[2], ph[4], ph[5]
-
-    # Allocate memory for the segment
-    memory = allocate_memory(p_memsz, p_vaddr)
-
-    # Seek to the segment in the file
-    file.seek(p_offset)
-
-    # Read the segment into memory
-    segment_data = file.read(p_filesz)
-    memory[:p_filesz] = segment_data
+        print(f"Entry point: 0x{elf.entry:x}")
+        print(f"Function symbols: {len(elf.symbols())}")
 
-    # Zero out the remaining memory if p_memsz > p_filesz
-    if p_memsz > p_filesz:
-        memory[p_filesz:p_memsz] = b'\x00' * (p_memsz - p_filesz)
+def copy_segment(elf, ph):
+    p_vaddr, p_filesz, p_memsz = ph[2], ph[4], ph[5]
 
-    print(f"Loaded segment at 0x{p_vaddr:x}, size {p_memsz}")
+    # Only the file-backed bytes exist in the file; the rest of p_memsz is zero-filled (BSS)
+    with elf.segment_data(ph) as segment_data:
+        print(f"Loaded segment at 0x{p_vaddr:x}, size {p_memsz} ({len(segment_data)} from file, {p_memsz - p_filesz} zero-filled)")
 
 if __name__ == '__main__':
     import sys
@@ -1,202 +1,333 @@
 # Comprised of the Fetch, Decode, and Execute portions of the ISA project
 
 import struct
+from collections import namedtuple
 
-ELF_HEADER_FORMAT = '<4sBBBBB7xHHIIIIIHHHHHH'
-ELF_HEADER_SIZE = 52
+from console import Console
+from ELF import ElfFile, SymbolTable
+from memory import MemoryStage, PagedMemory, PAGE_SHIFT, STACK_TOP
+from rvc import expansion_table
+from writeback import WriteBack
 
-# Defines the program header structure for 32-bit little-endian RISC-V architecture
-PROGRAM_HEADER_FORMAT = '<IIIIIIII'
-PROGRAM_HEADER_SIZE = 32
+# size is the instruction length in bytes (2 for compressed instructions, whose inst is the halfword and
+# whose other fields are those of the 32-bit expansion); operation is the ALU callable named by aluop
+Predecoded = namedtuple('Predecoded', ['inst', 'opcode', 'rd', 'rs1', 'rs2', 'funct3', 'funct7', 'imm', 'aluop', 'memop', 'size', 'operation'])
 
-# Constants for checking the ELF file
-ELF_MAGIC = b'\x7fELF'
-RISC_V_MACHINE = 243
-PT_LOAD = 1
+# Per-instruction state passed between the pipeline stages. Each Machine reuses one record, refilled by
+# expand(), so stepping allocates nothing; as_dict() gives the old dictionary form for debugging.
+class DecodedInstruction:
+    __slots__ = ('inst', 'opcode', 'left', 'right', 'strval', 'rd', 'rs1', 'rs2', 'funct3', 'funct7',
+                 'imm', 'memop', 'aluop', 'size', 'operation', 'result', 'pc_update', 'branch_taken')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def __getitem__(self, key):
+        # Read-only dictionary-style access, for debugging and older callers
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f'DecodedInstruction({self.as_dict()!r})'
+
+# Outcome of Machine.run; reason is 'exit', 'until_pc', 'max_instructions' or 'blocked' (getchar with no input ready)
+RunResult = namedtuple('RunResult', ['reason', 'instructions', 'exit_code'])
+
+class DecodeCache:
+    def __init__(self):
+        self.entries = {}  # PC -> Predecoded
+        self.pages = set()  # Pages holding at least one cached PC
+
+    def insert(self, pc, predecoded):
+        self.entries[pc] = predecoded
+        self.pages.add(pc >> PAGE_SHIFT)
+        self.pages.add((pc + 3) >> PAGE_SHIFT)
+
+    def invalidate(self, address, size):
+        # Drops every cached instruction overlapping the written bytes
+        if address >> PAGE_SHIFT not in self.pages and (address + size - 1) >> PAGE_SHIFT not in self.pages:
+            return False
+        entries = self.entries
+        dropped = False
+        for pc in range(address - 3, address + size):
+            if entries.pop(pc, None) is not None:
+                dropped = True
+        return dropped
+
+    def clear(self):
+        self.entries.clear()
+        self.pages.clear()
 
 class Machine:
     def __init__(self):
-        self.memory = bytearray(1024 * 1024)  # Initialize 1MB of memory
+        self.memory = PagedMemory()  # Sparse 4 GiB address space
         self.registers = [0] * 32
         self.pc = 0  # Program counter
-        self.registers[2] = len(self.memory)  # Set the stack pointer to the bottom of the RAM memory
+        self.registers[2] = STACK_TOP  # Set the stack pointer
         self.alu = ALU()
+        self.memory_stage = MemoryStage(self.memory)
+        self.write_back = WriteBack(self)
+        self.console = Console()  # Device behind putchar and getchar
+        self.decode_cache = DecodeCache()
+        self.code_caches = [self.decode_cache]  # Everything derived from guest code, invalidated on stores
+        self.decoded = DecodedInstruction()  # Record reused by every expand()
+        self.symbols = SymbolTable()  # Functions of the loaded ELF file, for mapping PCs to names
 
     def load_elf(self, filename):
-        with open(filename, 'rb') as file:
-            # Read ELF Header
-            elf_header_data = file.read(ELF_HEADER_SIZE)
-            elf_header = struct.unpack(ELF_HEADER_FORMAT, elf_header_data)
-
-            # Verifies ELF Header
-            if elf_header[0] != ELF_MAGIC:
-                raise ValueError("Not an ELF file")
-            if elf_header[10] != 2:
-                raise ValueError("Not an executable file")
-            if elf_header[11] != RISC_V_MACHINE:
-                raise ValueError("Not a RISC-V file")
-            if elf_header[4] != 1:
-                raise ValueError("Not a 32-bit file")
-
-            e_phoff = elf_header[9]
-            e_phnum = elf_header[17]
-            e_entry = elf_header[8]
-
-            # Read and progress program headers
-            file.seek(e_phoff)
-            for _ in range(e_phnum):
-                program_header_data = file.read(PROGRAM_HEADER_SIZE)
-                program_header = struct.unpack(PROGRAM_HEADER_FORMAT, program_header_data)
-
-                if program_header[0] == PT_LOAD:
-                    self.copy_segment(file, program_header)
-
-            # Set the program counter to the entry point
-            self.pc = e_entry
-
-    def copy_segment(self, file, program_header):
-        p_offset = program_header[1]
+        # Accepts a path or an open ElfFile, so many machines can load from one shared mapping.
+        # The mapping stays open while guest pages still reference it.
+        if not isinstance(filename, ElfFile):
+            filename = ElfFile(filename)
+        self.load_image(filename)
+
+    def load_image(self, elf):
+        for program_header in elf.load_segments():
+            self.copy_segment(elf, program_header)
+
+        # Set the program counter to the entry point
+        self.pc = elf.entry
+        self.symbols = elf.symbols()
+        for cache in self.code_caches:
+            cache.clear()
+
+    def copy_segment(self, elf, program_header):
         p_vaddr = program_header[2]
         p_filesz = program_header[4]
         p_memsz = program_header[5]
 
-        file.seek(p_offset)
-        segment_data = file.read(p_filesz)
-        self.memory[p_vaddr:p_vaddr + p_memsz] = segment_data.ljust(p_memsz, b'\x00')
+        # Whole pages reference the file mapping and are copied on first write
+        self.memory.map(p_vaddr, elf.segment_data(program_header))
+
+        # BSS stays zero-fill-on-demand
+        if p_memsz > p_filesz:
+            self.memory.zero(p_vaddr + p_filesz, p_memsz - p_filesz)
+
+    def fork(self):
+        # Copy of this machine sharing unmodified memory pages copy-on-write. Devices hold host state
+        # (files, consoles) and are bound to this machine, so a machine with a device bus cannot fork.
+        if self.memory_stage.bus is not None:
+            raise ValueError("Cannot fork a machine with memory-mapped devices")
+        child = type(self)()
+        child.registers[:] = self.registers
+        child.pc = self.pc
+        child.memory = self.memory.fork()
+        child.memory_stage = MemoryStage(child.memory)
+        child.console = self.console.fork()
+        child.symbols = self.symbols
+        child.decode_cache.entries.update(self.decode_cache.entries)
+        child.decode_cache.pages.update(self.decode_cache.pages)
+        return child
 
     def fetch(self):
-        instruction = struct.unpack('<I', self.memory[self.pc:self.pc + 4])[0]
-        return {'inst': instruction}
+        return {'inst': self.read_instruction(self.pc)}
+
+    def read_instruction(self, address):
+        # Always four bytes; a compressed instruction is the low halfword
+        return struct.unpack('<I', self.memory.read(address, 4))[0]
+
+    def predecode(self, instruction):
+        # Extracts the register-independent fields of an instruction once so they can be cached by PC
+        if instruction & 0x3 != 0x3:
+            return predecode_compressed(instruction & 0xffff)
+        return PREDECODERS.get(instruction & 0x7f, predecode_other)(instruction)
 
     def decode(self, fetched_instruction):
-        instruction = fetched_instruction['inst']
-        opcode = instruction & 0x7f
-
-        decoded_instruction = {
-            'inst': instruction,
-            'left': None,
-            'right': None,
-            'disp_strval': None,
-            'rd': None,
-            'memop': 0,
-            'aluop': 'Nop',  # Default ALU operation
-        }
-
-        if opcode == 0x33:  # R-type
-            decoded_instruction.update({
-                'funct7': (instruction >> 25) & 0x7f,
-                'rs2': (instruction >> 20) & 0x1f,
-                'rs1': (instruction >> 15) & 0x1f,
-                'funct3': (instruction >> 12) & 0x7,
-                'rd': (instruction >> 7) & 0x1f,
-                'left': self.read_register((instruction >> 15) & 0x1f),
-                'right': self.read_register((instruction >> 20) & 0x1f)
-            })
-        elif opcode in [0x03, 0x13, 0x67, 0x73]:  # I-type
-            imm = (instruction >> 20) & 0xfff
-            decoded_instruction.update({
-                'imm': sign_extend(imm, 12),
-                'rs1': (instruction >> 15) & 0x1f,
-                'funct3': (instruction >> 12) & 0x7,
-                'rd': (instruction >> 7) & 0x1f,
-                'left': self.read_register((instruction >> 15) & 0x1f),
-                'right': sign_extend(imm, 12)
-            })
-        elif opcode == 0x23:  # S-type
-            imm = ((instruction >> 25) << 5) | ((instruction >> 7) & 0x1f)
-            decoded_instruction.update({
-                'imm': sign_extend(imm, 12),
-                'rs2': (instruction >> 20) & 0x1f,
-                'rs1': (instruction >> 15) & 0x1f,
-                'funct3': (instruction >> 12) & 0x7,
-                'left': self.read_register((instruction >> 15) & 0x1f),
-                'right': self.read_register((instruction >> 20) & 0x1f)
-            })
-        elif opcode == 0x63:  # B-type
-            imm = ((instruction >> 31) << 12) | (((instruction >> 25) & 0x3f) << 5) | (((instruction >> 8) & 0xf) << 1) | (((instruction >> 7) & 0x1) << 11)
-            decoded_instruction.update({
-                'imm': sign_extend(imm, 13),
-                'rs2': (instruction >> 20) & 0x1f,
-                'rs1': (instruction >> 15) & 0x1f,
-                'funct3': (instruction >> 12) & 0x7,
-                'left': self.read_register((instruction >> 15) & 0x1f),
-                'right': self.read_register((instruction >> 20) & 0x1f)
-            })
-        elif opcode in [0x37, 0x17]:  # U-type
-            imm = instruction & 0xfffff000
-            decoded_instruction.update({
-                'imm': sign_extend(imm, 32),
-                'rd': (instruction >> 7) & 0x1f,
-                'right': sign_extend(imm, 32)
-            })
-        elif opcode == 0x6f:  # J-type
-            imm = ((instruction >> 31) << 20) | (((instruction >> 21) & 0x3ff) << 1) | (((instruction >> 20) & 0x1) << 11) | ((instruction >> 12) & 0xff)
-            decoded_instruction.update({
-                'imm': sign_extend(imm, 21),
-                'rd': (instruction >> 7) & 0x1f,
-                'right': sign_extend(imm, 21)
-            })
+        return self.expand(self.predecode(fetched_instruction['inst']))
 
-        return decoded_instruction
+    def expand(self, predecoded):
+        # Reads the source registers for a predecoded instruction
+        inst, opcode, rd, rs1, rs2, funct3, funct7, imm, aluop, memop, size, operation = predecoded
+        left = right = strval = None
 
-    def execute(self, decoded_instruction):
-        opcode = decoded_instruction['inst'] & 0x7f
-        if opcode == 0x6f:  # JAL instruction
-            imm = decoded_instruction['imm']
-            decoded_instruction['pc_update'] = self.pc + imm
+        if rs1 is not None:
+            left = self.read_register(rs1)
+        if opcode == 0x33 or opcode == 0x63:  # R-type and B-type compare two registers
+            right = self.read_register(rs2)
         else:
-            decoded_instruction['pc_update'] = self.pc + 4  # Default PC update for other instructions
-
-        if opcode in [0x03, 0x13, 0x67, 0x73]:  # I-type
-            funct3 = decoded_instruction['funct3']
-            if opcode == 0x03:  # LOAD
-                decoded_instruction['memop'] = 'load'
-            elif opcode == 0x13:  # OP-IMM
-                decoded_instruction['aluop'] = self.decode_alu_operation(opcode, funct3, 0)
-            elif opcode == 0x67:  # JALR
-                decoded_instruction['aluop'] = 'jalr'
-            elif opcode == 0x73:  # SYSTEM (ECALL)
-                if funct3 == 0:
-                    decoded_instruction['aluop'] = 'ecall'
-
-        elif opcode == 0x23:  # S-type (STORE)
-            decoded_instruction['memop'] = 'store'
-
-        elif opcode == 0x63:  # B-type (BRANCH)
-            decoded_instruction['aluop'] = 'Cmp'
-
-        elif opcode == 0x37:  # U-type (LUI)
-            decoded_instruction['aluop'] = 'lui'
-
-        elif opcode == 0x17:  # U-type (AUIPC)
-            decoded_instruction['aluop'] = 'auipc'
-
-        elif opcode == 0x33:  # R-type
-            funct3 = decoded_instruction['funct3']
-            funct7 = decoded_instruction['funct7']
-            decoded_instruction['aluop'] = self.decode_alu_operation(opcode, funct3, funct7)
-
-        decoded_instruction['result'] = self.alu.perform_operation(decoded_instruction['aluop'], decoded_instruction['left'], decoded_instruction['right'])
+            right = imm
+        if opcode == 0x23:  # S-type stores rs2 at rs1 + imm
+            strval = self.read_register(rs2)
+        elif opcode == 0x17 or opcode == 0x6f:  # AUIPC and JAL are relative to the PC
+            left = self.pc
+
+        record = self.decoded
+        record.inst = inst
+        record.opcode = opcode
+        record.left = left
+        record.right = right
+        record.strval = strval
+        record.rd = rd
+        record.rs1 = rs1
+        record.rs2 = rs2
+        record.funct3 = funct3
+        record.funct7 = funct7
+        record.imm = imm
+        record.memop = memop
+        record.aluop = aluop
+        record.size = size
+        record.operation = operation
+        record.result = record.pc_update = record.branch_taken = None
+        return record
+
+    def execute(self, decoded_instruction):
+        result = decoded_instruction.operation(decoded_instruction.left, decoded_instruction.right)
+        decoded_instruction.result = EXECUTE_HANDLERS.get(decoded_instruction.opcode, execute_sequential)(self, decoded_instruction, result)
         return decoded_instruction
 
     def memory_access(self, decoded_instruction):
-        memop = decoded_instruction['memop']
+        memop = decoded_instruction.memop
         if memop == 'load':
-            pass
+            address = decoded_instruction.result & 0xffffffff
+            decoded_instruction.result = self.memory_stage.load_funct3(address, decoded_instruction.funct3)
         elif memop == 'store':
-            pass
+            address = decoded_instruction.result & 0xffffffff
+            funct3 = decoded_instruction.funct3
+            self.memory_stage.store_funct3(address, funct3, decoded_instruction.strval)
+            self.invalidate_code(address, self.get_size(funct3))  # Self-modifying code
+
+    def invalidate_code(self, address, size):
+        # Returns True if any cached code overlapped the written bytes
+        dropped = False
+        for cache in self.code_caches:
+            if cache.invalidate(address, size):
+                dropped = True
+        return dropped
 
     def writeback(self, decoded_instruction):
-        rd = decoded_instruction['rd']
-        result = decoded_instruction['result']
+        self.write_back.writeback(decoded_instruction)
 
     def step(self):
-        fetched_instruction = self.fetch()
-        decoded_instruction = self.decode(fetched_instruction)
-        executed_instruction = self.execute(decoded_instruction)
+        predecoded = self.decode_cache.entries.get(self.pc)
+        if predecoded is None:
+            predecoded = self.predecode(self.fetch()['inst'])
+            self.decode_cache.insert(self.pc, predecoded)
+        executed_instruction = self.execute(self.expand(predecoded))
         self.memory_access(executed_instruction)
         self.writeback(executed_instruction)
-        self.pc = executed_instruction['pc_update']  # Update PC after instruction execution
+        self.pc = executed_instruction.pc_update  # Update PC after instruction execution
+
+    def run(self, max_instructions=None, until_pc=None, until_ecall_exit=True):
+        # Same semantics as repeated step() calls, with the PC and operands kept in locals and no
+        # per-instruction dicts. Stops after max_instructions, when the PC reaches until_pc, or at the
+        # exit ecall (left as the current instruction, as step() leaves it) if until_ecall_exit is set.
+        registers = self.registers
+        entries = self.decode_cache.entries
+        load = self.memory_stage.load_funct3
+        store = self.memory_stage.store_funct3
+        invalidate = self.invalidate_code
+        syscall = self.write_back.syscall
+        sizes = [self.get_size(funct3) for funct3 in range(8)]
+        branch_conditions = BRANCH_CONDITIONS
+        limit = -1 if max_instructions is None else max_instructions
+        reason = 'max_instructions'
+        exit_code = None
+        count = 0
+        pc = self.pc
+
+        try:
+            while count != limit:
+                predecoded = entries.get(pc)
+                if predecoded is None:
+                    pc &= 0xffffffff  # Sequential PCs are only wrapped at the top of memory here, where they miss
+                    predecoded = self.predecode(self.read_instruction(pc))
+                    self.decode_cache.insert(pc, predecoded)
+                inst, opcode, rd, rs1, rs2, funct3, funct7, imm, aluop, memop, size, operation = predecoded
+
+                if opcode == 0x13:  # OP-IMM
+                    if rd:
+                        result = operation(registers[rs1], imm) & 0xffffffff
+                        registers[rd] = result - ((result & 0x80000000) << 1)
+                    pc += size
+                elif opcode == 0x33:  # R-type
+                    if rd:
+                        result = operation(registers[rs1], registers[rs2]) & 0xffffffff
+                        registers[rd] = result - ((result & 0x80000000) << 1)
+                    pc += size
+                elif opcode == 0x03:  # LOAD
+                    result = load((registers[rs1] + imm) & 0xffffffff, funct3)
+                    if rd:
+                        result &= 0xffffffff
+                        registers[rd] = result - ((result & 0x80000000) << 1)
+                    pc += size
+                elif opcode == 0x23:  # STORE
+                    address = (registers[rs1] + imm) & 0xffffffff
+                    store(address, funct3, registers[rs2])
+                    invalidate(address, sizes[funct3])
+                    pc += size
+                elif opcode == 0x63:  # BRANCH
+                    if branch_conditions[funct3](operation(registers[rs1], registers[rs2])):
+                        pc = (pc + imm) & 0xffffffff
+                    else:
+                        pc += size
+                elif opcode == 0x6f:  # JAL
+                    if rd:
+                        result = (pc + size) & 0xffffffff
+                        registers[rd] = result - ((result & 0x80000000) << 1)
+                    pc = (pc + imm) & 0xffffffff
+                elif opcode == 0x67:  # JALR
+                    target = operation(registers[rs1], imm) & 0xffffffff
+                    if rd:
+                        result = (pc + size) & 0xffffffff
+                        registers[rd] = result - ((result & 0x80000000) << 1)
+                    pc = target
+                elif opcode == 0x37:  # LUI
+                    if rd:
+                        registers[rd] = imm
+                    pc += size
+                elif opcode == 0x17:  # AUIPC
+                    if rd:
+                        result = (pc + imm) & 0xffffffff
+                        registers[rd] = result - ((result & 0x80000000) << 1)
+                    pc += size
+                elif aluop == 'ecall':
+                    if until_ecall_exit and registers[17] == 0:
+                        count += 1
+                        reason = 'exit'
+                        exit_code = registers[10]
+                        break
+                    self.pc = pc
+                    syscall.ecall()
+                    pc += size
+                elif aluop == 'ebreak':
+                    self.pc = pc
+                    syscall.ebreak()
+                else:
+                    if rd:
+                        result = operation(None if rs1 is None else registers[rs1], imm) & 0xffffffff
+                        registers[rd] = result - ((result & 0x80000000) << 1)
+                    pc += size
+
+                count += 1
+                if pc == until_pc:
+                    reason = 'until_pc'
+                    break
+        except BlockingIOError:
+            # Input not ready for getchar or a device; the instruction is left current, to be retried
+            reason = 'blocked'
+        finally:
+            self.pc = pc & 0xffffffff
+            self.console.flush()
+
+        return RunResult(reason, count, exit_code)
+
+    def get_size(self, funct3):
+        if funct3 & 0x3 == 0:  # lb, lbu, sb
+            return 1
+        elif funct3 & 0x3 == 1:  # lh, lhu, sh
+            return 2
+        return 4  # lw, sw
+
+    def is_signed(self, funct3):
+        return funct3 in [0, 1, 2]  # lb, lh, lw are signed; lbu, lhu are unsigned
+
+    def branch_taken(self, funct3, flags):
+        return BRANCH_CONDITIONS[funct3](flags)
 
     def read_register(self, reg_num):
         if reg_num == 0:
@@ -204,108 +335,283 @@ class Machine:
         return self.registers[reg_num]
 
     def decode_alu_operation(self, opcode, funct3, funct7):
-        if opcode == 0x33:  # R-type
-            if funct3 == 0x0:
-                if funct7 == 0x00:
-                    return 'Add'
-                elif funct7 == 0x20:
-                    return 'Sub'
-            elif funct3 == 0x1:
-                return 'LeftShift'
-            elif funct3 == 0x5:
-                if funct7 == 0x00:
-                    return 'RightShiftL'
-                elif funct7 == 0x20:
-                    return 'RightShiftA'
-            elif funct3 == 0x2:
-                return 'Slt'
-            elif funct3 == 0x3:
-                return 'SltU'
-            elif funct3 == 0x4:
-                return 'Xor'
-            elif funct3 == 0x6:
-                return 'Or'
-            elif funct3 == 0x7:
-                return 'And'
-            elif funct3 == 0x8:
-                return 'Mul'
-            elif funct3 == 0x9:
-                return 'Div'
-            elif funct3 == 0xa:
-                return 'DivU'
-            elif funct3 == 0xb:
-                return 'Rem'
-            elif funct3 == 0xc:
-                return 'RemU'
-        elif opcode == 0x13:  # I-type OP-IMM
-            if funct3 == 0x0:
-                return 'Add'
-            elif funct3 == 0x1:
-                return 'LeftShift'
-            elif funct3 == 0x5:
-                if funct7 == 0x00:
-                    return 'RightShiftL'
-                elif funct7 == 0x20:
-                    return 'RightShiftA'
-            elif funct3 == 0x2:
-                return 'Slt'
-            elif funct3 == 0x3:
-                return 'SltU'
-            elif funct3 == 0x4:
-                return 'Xor'
-            elif funct3 == 0x6:
-                return 'Or'
-            elif funct3 == 0x7:
-                return 'And'
-        elif opcode == 0x63:  # B-type (BRANCH)
-            return 'Cmp'
-        return 'Nop'
+        return ALU_DECODE.get((opcode, funct3, funct7), 'Nop')
+
+def run_stepwise(machine, step, max_instructions=None, until_pc=None, until_ecall_exit=True, on_exit=None):
+    # Machine.run semantics driven by a replacement step function, for instrumented runs.
+    # on_exit is called with the Predecoded exit ecall that stops the run.
+    count = 0
+    while max_instructions is None or count < max_instructions:
+        if until_ecall_exit and machine.registers[17] == 0:
+            predecoded = machine.decode_cache.entries.get(machine.pc)
+            if predecoded is None:
+                predecoded = machine.predecode(machine.read_instruction(machine.pc))
+            if predecoded.aluop == 'ecall':
+                if on_exit is not None:
+                    on_exit(predecoded)
+                return RunResult('exit', count + 1, machine.registers[10])
+        try:
+            step()
+        except BlockingIOError:
+            return RunResult('blocked', count, None)
+        count += 1
+        if machine.pc == until_pc:
+            return RunResult('until_pc', count, None)
+    return RunResult('max_instructions', count, None)
 
 class ALU:
     def __init__(self):
         pass
 
     def perform_operation(self, operation, operand1, operand2):
-        if operation == 'Add':
-            return operand1 + operand2
-        elif operation == 'Sub':
-            return operand1 - operand2
-        elif operation == 'Mul':
-            return operand1 * operand2
-        elif operation == 'Div':
-            return operand1 // operand2 if operand2 != 0 else 0  # Handles division by zero
-        elif operation == 'DivU':
-            return (operand1 % (1 << 32)) // (operand2 % (1 << 32)) if operand2 != 0 else 0
-        elif operation == 'Rem':
-            return operand1 % operand2 if operand2 != 0 else 0
-        elif operation == 'RemU':
-            return (operand1 % (1 << 32)) % (operand2 % (1 << 32)) if operand2 != 0 else 0
-        elif operation == 'LeftShift':
-            return operand1 << operand2
-        elif operation == 'RightShiftA':
-            return operand1 >> operand2
-        elif operation == 'RightShiftL':
-            return (operand1 % (1 << 32)) >> operand2
-        elif operation == 'Or':
-            return operand1 | operand2
-        elif operation == 'Xor':
-            return operand1 ^ operand2
-        elif operation == 'And':
-            return operand1 & operand2
-        elif operation == 'Slt':
-            return 1 if operand1 < operand2 else 0
-        elif operation == 'SltU':
-            return 1 if (operand1 % (1 << 32)) < (operand2 % (1 << 32)) else 0
-        elif operation == 'Cmp':
-            result = 0
-            if operand1 != operand2:
-                result |= 0b01  # NE/EQ
-            if operand1 < operand2:
-                result |= 0b10  # GE/LT
-            if (operand1 % (1 << 32)) < (operand2 % (1 << 32)):
-                result |= 0b100  # GEU/LTU
-            return result
-        return 0
+        return ALU_OPERATIONS.get(operation, alu_nop)(operand1, operand2)
+
+# ALU operations, looked up by name once at decode time
+
+def alu_add(operand1, operand2):
+    return operand1 + operand2
+
+def alu_sub(operand1, operand2):
+    return operand1 - operand2
+
+def alu_mul(operand1, operand2):
+    return operand1 * operand2
+
+def alu_mulh(operand1, operand2):
+    return (operand1 * operand2) >> 32
+
+def alu_mulhsu(operand1, operand2):
+    return (operand1 * (operand2 % (1 << 32))) >> 32
+
+def alu_mulhu(operand1, operand2):
+    return ((operand1 % (1 << 32)) * (operand2 % (1 << 32))) >> 32
+
+# Division follows the RISC-V M extension: quotients truncate toward zero and remainders take the sign
+# of the dividend; dividing by zero gives all ones and leaves the dividend as the remainder; the
+# overflowing -2**31 / -1 wraps to -2**31 with remainder 0
+
+def alu_div(operand1, operand2):
+    if operand2 == 0:
+        return -1
+    quotient = abs(operand1) // abs(operand2)
+    return -quotient if (operand1 < 0) != (operand2 < 0) else quotient
+
+def alu_divu(operand1, operand2):
+    divisor = operand2 % (1 << 32)
+    return (operand1 % (1 << 32)) // divisor if divisor else 0xffffffff
+
+def alu_rem(operand1, operand2):
+    if operand2 == 0:
+        return operand1
+    remainder = abs(operand1) % abs(operand2)
+    return -remainder if operand1 < 0 else remainder
+
+def alu_remu(operand1, operand2):
+    divisor = operand2 % (1 << 32)
+    return (operand1 % (1 << 32)) % divisor if divisor else operand1
+
+def alu_left_shift(operand1, operand2):
+    return operand1 << (operand2 & 0x1f)
+
+def alu_right_shift_a(operand1, operand2):
+    return operand1 >> (operand2 & 0x1f)
+
+def alu_right_shift_l(operand1, operand2):
+    return (operand1 % (1 << 32)) >> (operand2 & 0x1f)
+
+def alu_or(operand1, operand2):
+    return operand1 | operand2
+
+def alu_xor(operand1, operand2):
+    return operand1 ^ operand2
+
+def alu_and(operand1, operand2):
+    return operand1 & operand2
+
+def alu_slt(operand1, operand2):
+    return 1 if operand1 < operand2 else 0
+
+def alu_sltu(operand1, operand2):
+    return 1 if (operand1 % (1 << 32)) < (operand2 % (1 << 32)) else 0
+
+def alu_lui(operand1, operand2):
+    return operand2
+
+def alu_jalr(operand1, operand2):
+    return (operand1 + operand2) & ~1
+
+def alu_cmp(operand1, operand2):
+    result = 0
+    if operand1 != operand2:
+        result |= 0b01  # NE/EQ
+    if operand1 < operand2:
+        result |= 0b10  # GE/LT
+    if (operand1 % (1 << 32)) < (operand2 % (1 << 32)):
+        result |= 0b100  # GEU/LTU
+    return result
+
+def alu_nop(operand1, operand2):
+    return 0
+
+ALU_OPERATIONS = {
+    'Add': alu_add,
+    'Sub': alu_sub,
+    'Mul': alu_mul,
+    'MulH': alu_mulh,
+    'MulHSU': alu_mulhsu,
+    'MulHU': alu_mulhu,
+    'Div': alu_div,
+    'DivU': alu_divu,
+    'Rem': alu_rem,
+    'RemU': alu_remu,
+    'LeftShift': alu_left_shift,
+    'RightShiftA': alu_right_shift_a,
+    'RightShiftL': alu_right_shift_l,
+    'Or': alu_or,
+    'Xor': alu_xor,
+    'And': alu_and,
+    'Slt': alu_slt,
+    'SltU': alu_sltu,
+    'lui': alu_lui,
+    'auipc': alu_add,
+    'jal': alu_add,
+    'jalr': alu_jalr,
+    'Cmp': alu_cmp,
+    'Nop': alu_nop,
+}
+
+def build_alu_decode():
+    # (opcode, funct3, funct7) -> ALU operation name, expanded over every funct7 a field ignores
+    table = {}
+    shared = {0x1: 'LeftShift', 0x2: 'Slt', 0x3: 'SltU', 0x4: 'Xor', 0x6: 'Or', 0x7: 'And'}
+    shifts = {0x00: 'RightShiftL', 0x20: 'RightShiftA'}
+    for funct7 in range(0x80):
+        for opcode in [0x33, 0x13]:
+            for funct3, aluop in shared.items():
+                table[(opcode, funct3, funct7)] = aluop
+            table[(opcode, 0x5, funct7)] = shifts.get(funct7, 'Nop')
+        table[(0x33, 0x0, funct7)] = {0x00: 'Add', 0x20: 'Sub'}.get(funct7, 'Nop')
+        table[(0x13, 0x0, funct7)] = 'Add'
+        for funct3 in range(8):
+            table[(0x63, funct3, funct7)] = 'Cmp'
+    # M extension: R-type with funct7 0x01
+    for funct3, aluop in enumerate(['Mul', 'MulH', 'MulHSU', 'MulHU', 'Div', 'DivU', 'Rem', 'RemU']):
+        table[(0x33, funct3, 0x01)] = aluop
+    return table
+
+ALU_DECODE = build_alu_decode()
+
+# Predecoders, one per major opcode
+
+def predecoded(instruction, rd, rs1, rs2, funct3, funct7, imm, aluop, memop=0):
+    return Predecoded(instruction, instruction & 0x7f, rd, rs1, rs2, funct3, funct7, imm, aluop, memop, 4, ALU_OPERATIONS.get(aluop, alu_nop))
+
+def predecode_compressed(halfword):
+    # Predecodes the 32-bit expansion of an RV32C instruction
+    expanded = expansion_table()[halfword]
+    if not expanded:  # Reserved encodings, including the all-zero halfword, have no expansion
+        raise ValueError(f"Illegal instruction 0x{halfword:04x}")
+    return PREDECODERS.get(expanded & 0x7f, predecode_other)(expanded)._replace(inst=halfword, size=2)
+
+def predecode_r_type(instruction):
+    funct7 = (instruction >> 25) & 0x7f
+    funct3 = (instruction >> 12) & 0x7
+    aluop = ALU_DECODE.get((0x33, funct3, funct7), 'Nop')
+    return predecoded(instruction, (instruction >> 7) & 0x1f, (instruction >> 15) & 0x1f, (instruction >> 20) & 0x1f, funct3, funct7, None, aluop)
+
+def predecode_i_type(instruction, aluop, memop=0):
+    imm = sign_extend((instruction >> 20) & 0xfff, 12)
+    return predecoded(instruction, (instruction >> 7) & 0x1f, (instruction >> 15) & 0x1f, None, (instruction >> 12) & 0x7, None, imm, aluop, memop)
+
+def predecode_load(instruction):
+    return predecode_i_type(instruction, 'Add', 'load')  # Effective address
+
+def predecode_op_imm(instruction):
+    funct3 = (instruction >> 12) & 0x7
+    aluop = ALU_DECODE.get((0x13, funct3, (instruction >> 25) & 0x7f), 'Nop')
+    if funct3 == 0x1 or funct3 == 0x5:  # Shifts keep funct7 in the upper immediate bits
+        return predecoded(instruction, (instruction >> 7) & 0x1f, (instruction >> 15) & 0x1f, None, funct3, (instruction >> 25) & 0x7f, (instruction >> 20) & 0x1f, aluop)
+    return predecode_i_type(instruction, aluop)
+
+def predecode_jalr(instruction):
+    return predecode_i_type(instruction, 'jalr')
+
+def predecode_system(instruction):
+    if (instruction >> 12) & 0x7:
+        return predecode_i_type(instruction, 'Nop')
+    return predecode_i_type(instruction, 'ebreak' if instruction >> 20 == 1 else 'ecall')  # EBREAK has imm 1
+
+def predecode_store(instruction):
+    imm = sign_extend(((instruction >> 25) << 5) | ((instruction >> 7) & 0x1f), 12)
+    return predecoded(instruction, None, (instruction >> 15) & 0x1f, (instruction >> 20) & 0x1f, (instruction >> 12) & 0x7, None, imm, 'Add', 'store')
+
+def predecode_branch(instruction):
+    imm = ((instruction >> 31) << 12) | (((instruction >> 25) & 0x3f) << 5) | (((instruction >> 8) & 0xf) << 1) | (((instruction >> 7) & 0x1) << 11)
+    return predecoded(instruction, None, (instruction >> 15) & 0x1f, (instruction >> 20) & 0x1f, (instruction >> 12) & 0x7, None, sign_extend(imm, 13), 'Cmp')
+
+def predecode_lui(instruction):
+    return predecoded(instruction, (instruction >> 7) & 0x1f, None, None, None, None, sign_extend(instruction & 0xfffff000, 32), 'lui')
+
+def predecode_auipc(instruction):
+    return predecoded(instruction, (instruction >> 7) & 0x1f, None, None, None, None, sign_extend(instruction & 0xfffff000, 32), 'auipc')
+
+def predecode_jal(instruction):
+    imm = ((instruction >> 31) << 20) | (((instruction >> 21) & 0x3ff) << 1) | (((instruction >> 20) & 0x1) << 11) | ((instruction >> 12) & 0xff) << 12
+    return predecoded(instruction, (instruction >> 7) & 0x1f, None, None, None, None, sign_extend(imm, 21), 'jal')
+
+def predecode_other(instruction):
+    return predecoded(instruction, None, None, None, None, None, None, 'Nop')
+
+PREDECODERS = {
+    0x33: predecode_r_type,
+    0x03: predecode_load,
+    0x13: predecode_op_imm,
+    0x67: predecode_jalr,
+    0x73: predecode_system,
+    0x23: predecode_store,
+    0x63: predecode_branch,
+    0x37: predecode_lui,
+    0x17: predecode_auipc,
+    0x6f: predecode_jal,
+}
+
+# Execute handlers take the ALU result and return the value for writeback, setting pc_update
+
+def execute_sequential(machine, decoded_instruction, result):
+    decoded_instruction.pc_update = (machine.pc + decoded_instruction.size) & 0xffffffff
+    return result
+
+def execute_jump(machine, decoded_instruction, result):
+    # JAL and JALR link the return address
+    decoded_instruction.pc_update = result & 0xffffffff
+    return machine.pc + decoded_instruction.size  # Link value, wrapped by writeback
+
+def execute_branch(machine, decoded_instruction, result):
+    taken = BRANCH_CONDITIONS[decoded_instruction.funct3](result)
+    decoded_instruction.branch_taken = taken
+    if taken:
+        decoded_instruction.pc_update = (machine.pc + decoded_instruction.imm) & 0xffffffff
+    else:
+        decoded_instruction.pc_update = (machine.pc + decoded_instruction.size) & 0xffffffff
+    return result
+
+EXECUTE_HANDLERS = {
+    0x6f: execute_jump,
+    0x67: execute_jump,
+    0x63: execute_branch,
+}
+
+# Branch conditions on the Cmp flags, indexed by funct3
+BRANCH_CONDITIONS = [
+    lambda flags: not flags & 0b01,  # BEQ
+    lambda flags: bool(flags & 0b01),  # BNE
+    lambda flags: False,
+    lambda flags: False,
+    lambda flags: bool(flags & 0b10),  # BLT
+    lambda flags: not flags & 0b10,  # BGE
+    lambda flags: bool(flags & 0b100),  # BLTU
+    lambda flags: not flags & 0b100,  # BGEU
+]
 
 def sign_extend(value, bit_length):
     sign_bit = 1 << (bit_length - 1)
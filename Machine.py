@@ -2,14 +2,16 @@
 # by Khoa Pham
 # Machine Part 1
 
+from memory import PagedMemory
+
 class RV32IMEmulator:
     def __init__(self):
         # 32, 32-bit registers (x0 - x31)
         self.registers = [0] * 32
         # Program counter register (PC)
         self.pc = 0
-        # 1 mebibyte of RAM
-        self.ram = [0] * (1 * 1024 * 1024)
+        # Sparse 32-bit address space, pages allocated on first write
+        self.ram = PagedMemory()
         # Initialize the ALU
         self.alu = ALU()
 
@@ -0,0 +1,211 @@
+# Small RV32IM assembler
+# Used to build guest programs without a cross toolchain.
+#
+# One instruction per line; '#' starts a comment and 'name:' defines a label. Memory operands are
+# written imm(reg). Supported pseudo-instructions: nop, li, mv, not, neg, j, jr, ret, call, beqz, bnez,
+# bgt, ble, bgtu, bleu. '.word v, ...' emits data words.
+
+import struct
+
+REGISTER_NAMES = {
+    'zero': 0, 'ra': 1, 'sp': 2, 'gp': 3, 'tp': 4, 't0': 5, 't1': 6, 't2': 7,
+    's0': 8, 'fp': 8, 's1': 9, 'a0': 10, 'a1': 11, 'a2': 12, 'a3': 13, 'a4': 14, 'a5': 15,
+    'a6': 16, 'a7': 17, 's2': 18, 's3': 19, 's4': 20, 's5': 21, 's6': 22, 's7': 23,
+    's8': 24, 's9': 25, 's10': 26, 's11': 27, 't3': 28, 't4': 29, 't5': 30, 't6': 31,
+}
+REGISTER_NAMES.update({f'x{num}': num for num in range(32)})
+
+# name -> (funct7, funct3)
+R_TYPE = {
+    'add': (0x00, 0x0), 'sub': (0x20, 0x0), 'sll': (0x00, 0x1), 'slt': (0x00, 0x2),
+    'sltu': (0x00, 0x3), 'xor': (0x00, 0x4), 'srl': (0x00, 0x5), 'sra': (0x20, 0x5),
+    'or': (0x00, 0x6), 'and': (0x00, 0x7),
+    'mul': (0x01, 0x0), 'mulh': (0x01, 0x1), 'mulhsu': (0x01, 0x2), 'mulhu': (0x01, 0x3),
+    'div': (0x01, 0x4), 'divu': (0x01, 0x5), 'rem': (0x01, 0x6), 'remu': (0x01, 0x7),
+}
+OP_IMM = {'addi': 0x0, 'slti': 0x2, 'sltiu': 0x3, 'xori': 0x4, 'ori': 0x6, 'andi': 0x7}
+SHIFT_IMM = {'slli': (0x00, 0x1), 'srli': (0x00, 0x5), 'srai': (0x20, 0x5)}
+LOADS = {'lb': 0x0, 'lh': 0x1, 'lw': 0x2, 'lbu': 0x4, 'lhu': 0x5}
+STORES = {'sb': 0x0, 'sh': 0x1, 'sw': 0x2}
+BRANCHES = {'beq': 0x0, 'bne': 0x1, 'blt': 0x4, 'bge': 0x5, 'bltu': 0x6, 'bgeu': 0x7}
+# Branch pseudo-instructions that swap their operands
+SWAPPED_BRANCHES = {'bgt': 'blt', 'ble': 'bge', 'bgtu': 'bltu', 'bleu': 'bgeu'}
+
+def encode_r(funct7, rs2, rs1, funct3, rd, opcode):
+    return (funct7 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+def encode_i(imm, rs1, funct3, rd, opcode):
+    check_range(imm, 12)
+    return ((imm & 0xfff) << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+def encode_s(imm, rs2, rs1, funct3):
+    check_range(imm, 12)
+    imm &= 0xfff
+    return ((imm >> 5) << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | ((imm & 0x1f) << 7) | 0x23
+
+def encode_b(imm, rs2, rs1, funct3):
+    check_range(imm, 13)
+    imm &= 0x1fff
+    return (((imm >> 12) & 0x1) << 31) | (((imm >> 5) & 0x3f) << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (((imm >> 1) & 0xf) << 8) | (((imm >> 11) & 0x1) << 7) | 0x63
+
+def encode_u(imm, rd, opcode):
+    return (imm & 0xfffff000) | (rd << 7) | opcode
+
+def encode_j(imm, rd):
+    check_range(imm, 21)
+    imm &= 0x1fffff
+    return (((imm >> 20) & 0x1) << 31) | (((imm >> 1) & 0x3ff) << 21) | (((imm >> 11) & 0x1) << 20) | (((imm >> 12) & 0xff) << 12) | (rd << 7) | 0x6f
+
+def check_range(imm, bits):
+    if not -(1 << (bits - 1)) <= imm < (1 << (bits - 1)):
+        raise ValueError(f"Immediate {imm} does not fit in {bits} bits")
+
+def split_immediate(value):
+    # Splits a 32-bit constant into LUI and ADDI parts
+    value &= 0xffffffff
+    low = ((value & 0xfff) ^ 0x800) - 0x800
+    return (value - low) & 0xffffffff, low
+
+def parse_register(text):
+    try:
+        return REGISTER_NAMES[text.strip().lower()]
+    except KeyError:
+        raise ValueError(f"Unknown register {text!r}") from None
+
+def parse_memory(text):
+    # imm(reg)
+    imm, _, reg = text.strip().rstrip(')').partition('(')
+    return parse_int(imm or '0'), parse_register(reg)
+
+def parse_int(text):
+    return int(text.strip(), 0)
+
+def tokenize(source):
+    # Yields (line number, label or None, mnemonic or None, operands)
+    for number, line in enumerate(source.splitlines(), 1):
+        line = line.split('#', 1)[0].strip()
+        while ':' in line:
+            label, _, line = line.partition(':')
+            yield number, label.strip(), None, []
+            line = line.strip()
+        if line:
+            mnemonic, _, rest = line.partition(' ')
+            operands = [operand.strip() for operand in rest.split(',')] if rest.strip() else []
+            yield number, None, mnemonic.lower(), operands
+
+def instruction_size(mnemonic, operands):
+    if mnemonic == 'li':
+        value = parse_int(operands[1])
+        return 4 if -2048 <= value < 2048 else 8
+    if mnemonic == '.word':
+        return 4 * len(operands)
+    return 4
+
+def assemble(source, base=0):
+    # Returns the machine code for source placed at address base, and the label addresses
+    labels = {}
+    address = base
+    for number, label, mnemonic, operands in tokenize(source):
+        if label is not None:
+            labels[label] = address
+        else:
+            address += instruction_size(mnemonic, operands)
+
+    words = []
+    address = base
+    for number, label, mnemonic, operands in tokenize(source):
+        if label is not None:
+            continue
+        try:
+            encoded = encode(mnemonic, operands, address, labels)
+        except (ValueError, IndexError, KeyError) as error:
+            raise ValueError(f"Line {number}: {error}") from None
+        words.extend(encoded)
+        address += 4 * len(encoded)
+    return struct.pack(f'<{len(words)}I', *words), labels
+
+def encode(mnemonic, operands, address, labels):
+    def target(text):
+        text = text.strip()
+        if text in labels:
+            return labels[text] - address
+        return parse_int(text)
+
+    reg = parse_register
+    if mnemonic in R_TYPE:
+        funct7, funct3 = R_TYPE[mnemonic]
+        return [encode_r(funct7, reg(operands[2]), reg(operands[1]), funct3, reg(operands[0]), 0x33)]
+    if mnemonic in OP_IMM:
+        return [encode_i(parse_int(operands[2]), reg(operands[1]), OP_IMM[mnemonic], reg(operands[0]), 0x13)]
+    if mnemonic in SHIFT_IMM:
+        funct7, funct3 = SHIFT_IMM[mnemonic]
+        shamt = parse_int(operands[2])
+        if not 0 <= shamt < 32:
+            raise ValueError(f"Shift amount {shamt} out of range")
+        return [encode_r(funct7, shamt, reg(operands[1]), funct3, reg(operands[0]), 0x13)]
+    if mnemonic in LOADS:
+        imm, rs1 = parse_memory(operands[1])
+        return [encode_i(imm, rs1, LOADS[mnemonic], reg(operands[0]), 0x03)]
+    if mnemonic in STORES:
+        imm, rs1 = parse_memory(operands[1])
+        return [encode_s(imm, reg(operands[0]), rs1, STORES[mnemonic])]
+    if mnemonic in BRANCHES:
+        return [encode_b(target(operands[2]), reg(operands[1]), reg(operands[0]), BRANCHES[mnemonic])]
+    if mnemonic in SWAPPED_BRANCHES:
+        return [encode_b(target(operands[2]), reg(operands[0]), reg(operands[1]), BRANCHES[SWAPPED_BRANCHES[mnemonic]])]
+    if mnemonic == 'lui':
+        return [encode_u(parse_int(operands[1]) << 12, reg(operands[0]), 0x37)]
+    if mnemonic == 'auipc':
+        return [encode_u(parse_int(operands[1]) << 12, reg(operands[0]), 0x17)]
+    if mnemonic == 'jal':
+        if len(operands) == 1:
+            return [encode_j(target(operands[0]), 1)]
+        return [encode_j(target(operands[1]), reg(operands[0]))]
+    if mnemonic == 'jalr':
+        if len(operands) == 1:
+            return [encode_i(0, reg(operands[0]), 0x0, 1, 0x67)]
+        imm, rs1 = parse_memory(operands[1])
+        return [encode_i(imm, rs1, 0x0, reg(operands[0]), 0x67)]
+    if mnemonic == 'ecall':
+        return [0x00000073]
+    if mnemonic == 'ebreak':
+        return [0x00100073]
+    if mnemonic == 'nop':
+        return [encode_i(0, 0, 0x0, 0, 0x13)]
+    if mnemonic == 'li':
+        rd = reg(operands[0])
+        value = parse_int(operands[1])
+        if -2048 <= value < 2048:
+            return [encode_i(value, 0, 0x0, rd, 0x13)]
+        upper, lower = split_immediate(value)
+        return [encode_u(upper, rd, 0x37), encode_i(lower, rd, 0x0, rd, 0x13)]
+    if mnemonic == 'mv':
+        return [encode_i(0, reg(operands[1]), 0x0, reg(operands[0]), 0x13)]
+    if mnemonic == 'not':
+        return [encode_i(-1, reg(operands[1]), 0x4, reg(operands[0]), 0x13)]
+    if mnemonic == 'neg':
+        return [encode_r(0x20, reg(operands[1]), 0, 0x0, reg(operands[0]), 0x33)]
+    if mnemonic == 'j':
+        return [encode_j(target(operands[0]), 0)]
+    if mnemonic == 'jr':
+        return [encode_i(0, reg(operands[0]), 0x0, 0, 0x67)]
+    if mnemonic == 'ret':
+        return [encode_i(0, 1, 0x0, 0, 0x67)]
+    if mnemonic == 'call':
+        return [encode_j(target(operands[0]), 1)]
+    if mnemonic == 'beqz':
+        return [encode_b(target(operands[1]), 0, reg(operands[0]), 0x0)]
+    if mnemonic == 'bnez':
+        return [encode_b(target(operands[1]), 0, reg(operands[0]), 0x1)]
+    if mnemonic == '.word':
+        return [parse_int(operand) & 0xffffffff for operand in operands]
+    raise ValueError(f"Unknown instruction {mnemonic!r}")
+
+def load_program(machine, source, base=0x1000):
+    # Assembles source into machine memory and points the PC at its first instruction
+    code, labels = assemble(source, base)
+    machine.memory.write(base, code)
+    machine.pc = base
+    for cache in machine.code_caches:
+        cache.clear()
+    return labels
@@ -0,0 +1,120 @@
+# Batch runner
+# Runs a manifest of ELF jobs across a pool of worker processes and streams JSON Lines results.
+#
+# Each manifest line is a JSON object:
+#   {"elf": "path/to/prog.elf", "id": "optional", "stdin": "text", "max_instructions": 1000000, "timeout": 10.0}
+# Only "elf" is required.
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from codecache import CodeCache
+from console import Console
+from ELF import ElfFile
+from FetchDecodeExecute import Machine
+
+SLICE_INSTRUCTIONS = 100000  # Instructions between timeout checks
+
+# Per-worker cache of open ELF mappings, so jobs repeating a binary share one mapping
+elf_files = {}
+
+def open_elf(path):
+    elf = elf_files.get(path)
+    if elf is None:
+        elf = elf_files[path] = ElfFile(path)
+    return elf
+
+def run_job(job, code_cache=None):
+    # code_cache: directory of the persistent code cache, or None
+    result = {
+        'id': job.get('id'),
+        'elf': job['elf'],
+        'status': None,
+        'exit_code': None,
+        'instructions': 0,
+        'output': '',
+        'elapsed': 0.0,
+    }
+    max_instructions = job.get('max_instructions')
+    timeout = job.get('timeout')
+    output = io.StringIO()
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+
+    try:
+        with contextlib.redirect_stdout(output):
+            machine = Machine()
+            machine.console = Console(output=output, input=job.get('stdin', ''))
+            elf = open_elf(job['elf'])
+            machine.load_elf(elf)
+            cache = None if code_cache is None else CodeCache(code_cache)
+            if cache is not None:
+                cache.load(machine, elf)
+                cached = len(machine.decode_cache.entries)
+            while True:
+                budget = SLICE_INSTRUCTIONS
+                if max_instructions is not None:
+                    budget = min(budget, max_instructions - result['instructions'])
+                outcome = machine.run(max_instructions=budget)
+                result['instructions'] += outcome.instructions
+                if outcome.reason == 'exit':
+                    result['status'] = 'exit'
+                    result['exit_code'] = outcome.exit_code
+                    break
+                if max_instructions is not None and result['instructions'] >= max_instructions:
+                    result['status'] = 'max_instructions'
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    result['status'] = 'timeout'
+                    break
+            if cache is not None and len(machine.decode_cache.entries) > cached:
+                cache.save(machine, elf)
+    except Exception as error:
+        result['status'] = 'error'
+        result['error'] = f'{type(error).__name__}: {error}'
+
+    result['output'] = output.getvalue()
+    result['elapsed'] = time.monotonic() - start
+    return result
+
+def run_batch(jobs, workers=None, chunksize=16, code_cache=None):
+    # Yields results in manifest order; one pool of worker processes serves the whole batch
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(functools.partial(run_job, code_cache=code_cache), jobs, chunksize=chunksize)
+
+def read_manifest(file):
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many ELF files in parallel")
+    parser.add_argument('manifest', help="JSON Lines manifest of jobs ('-' for stdin)")
+    parser.add_argument('-o', '--output', help="JSON Lines results file (default stdout)")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument('--chunksize', type=int, default=16, help="Jobs sent to a worker at a time")
+    parser.add_argument('--code-cache', help="Directory for the persistent decoded-code cache")
+    args = parser.parse_args()
+
+    if args.manifest == '-':
+        jobs = list(read_manifest(sys.stdin))
+    else:
+        with open(args.manifest) as manifest:
+            jobs = list(read_manifest(manifest))
+
+    with contextlib.ExitStack() as stack:
+        results = sys.stdout if args.output is None else stack.enter_context(open(args.output, 'w'))
+        for result in run_batch(jobs, args.workers, args.chunksize, args.code_cache):
+            results.write(json.dumps(result) + '\n')
+            results.flush()
+
+if __name__ == '__main__':
+    main()
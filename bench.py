@@ -0,0 +1,388 @@
+# Benchmark suite
+# Runs built-in guest workloads on each execution engine and reports MIPS, ns/instruction,
+# per-stage time of the reference pipeline and peak RSS. Results are written as JSON and can be
+# compared against a saved baseline.
+#
+#   python bench.py                       # all workloads, all engines
+#   python bench.py -w sort -e run --save baseline.json
+#   python bench.py --baseline baseline.json
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+from assembler import load_program
+from FetchDecodeExecute import Machine
+from profiler import Profiler, STAGES
+from translate import BlockTranslator
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Every workload leaves a checksum of its results in a0, which becomes the exit code; run_case
+# compares it against the matching expected_* function so an engine that skips work fails the case
+EXIT = '''
+    li a7, 0
+    ecall
+'''
+
+def wrap(value):
+    # Signed 32-bit value, as the guest registers hold it
+    value &= 0xffffffff
+    return value - ((value & 0x80000000) << 1)
+
+def arith_workload(scale):
+    return f'''
+    li t0, 0
+    li t1, {20000 * scale}
+    li t2, 0
+loop:
+    add t2, t2, t0
+    xori t3, t2, 0x55
+    slli t4, t3, 3
+    srli t5, t4, 2
+    sub t2, t2, t5
+    and t6, t2, t4
+    or t2, t2, t6
+    slt t3, t2, t0
+    addi t0, t0, 1
+    blt t0, t1, loop
+    add a0, t2, t3
+''' + EXIT
+
+def expected_arith(scale):
+    t2 = t3 = 0
+    for t0 in range(20000 * scale):
+        t2 = wrap(t2 + t0)
+        t4 = wrap((t2 ^ 0x55) << 3)
+        t5 = (t4 & 0xffffffff) >> 2
+        t2 = wrap(t2 - t5)
+        t2 |= t2 & t4
+        t3 = int(t2 < t0)
+    return wrap(t2 + t3)
+
+def memcpy_workload(scale):
+    # Copies a 4 KiB buffer word by word, then byte by byte, repeatedly
+    return f'''
+    li s0, 0x100000
+    li s1, 0x200000
+    li s2, {8 * scale}
+    li t0, 0
+fill:
+    sw t0, 0(s0)
+    addi s0, s0, 4
+    addi t0, t0, 1
+    li t1, 1024
+    blt t0, t1, fill
+    li s0, 0x100000
+repeat:
+    mv a0, s0
+    mv a1, s1
+    li a2, 1024
+words:
+    lw t0, 0(a0)
+    sw t0, 0(a1)
+    addi a0, a0, 4
+    addi a1, a1, 4
+    addi a2, a2, -1
+    bnez a2, words
+    mv a0, s0
+    mv a1, s1
+    li a2, 1024
+bytes:
+    lbu t0, 0(a0)
+    sb t0, 0(a1)
+    addi a0, a0, 1
+    addi a1, a1, 1
+    addi a2, a2, -1
+    bnez a2, bytes
+    addi s2, s2, -1
+    bnez s2, repeat
+    li t2, 0x200800
+    lw t0, 0(t2)
+    lbu t1, 2045(t2)
+    lw a0, 2044(t2)
+    add a0, a0, t0
+    add a0, a0, t1
+''' + EXIT
+
+def expected_memcpy(scale):
+    # Words 512 and 1023 of the copy, plus the second byte of the last one
+    return 512 + 1023 + (1023 >> 8)
+
+def sort_workload(scale):
+    # Bubble sort of an array filled by a xorshift generator
+    return f'''
+    li s0, 0x100000
+    li s1, {min(60 * scale, 2000)}
+    li t0, 0
+    li t1, 0x1234567
+fill:
+    slli t2, t1, 13
+    xor t1, t1, t2
+    srli t2, t1, 17
+    xor t1, t1, t2
+    slli t2, t1, 5
+    xor t1, t1, t2
+    slli t3, t0, 2
+    add t3, s0, t3
+    sw t1, 0(t3)
+    addi t0, t0, 1
+    blt t0, s1, fill
+    addi s2, s1, -1
+outer:
+    li t0, 0
+    mv a0, s0
+inner:
+    lw t1, 0(a0)
+    lw t2, 4(a0)
+    ble t1, t2, ordered
+    sw t2, 0(a0)
+    sw t1, 4(a0)
+ordered:
+    addi a0, a0, 4
+    addi t0, t0, 1
+    blt t0, s2, inner
+    addi s2, s2, -1
+    bnez s2, outer
+    slli t0, s1, 2
+    add t0, s0, t0
+    lw t1, -4(t0)
+    lw t2, 0(s0)
+    srli t0, s1, 1
+    slli t0, t0, 2
+    add t0, s0, t0
+    lw a0, 0(t0)
+    sub t1, t1, t2
+    xor a0, a0, t1
+''' + EXIT
+
+def expected_sort(scale):
+    # Median xor (largest - smallest) of the sorted array
+    count = min(60 * scale, 2000)
+    values = []
+    t1 = 0x1234567
+    for _ in range(count):
+        t1 ^= (t1 << 13) & 0xffffffff
+        t1 ^= t1 >> 17
+        t1 ^= (t1 << 5) & 0xffffffff
+        values.append(wrap(t1))
+    values.sort()
+    return values[count // 2] ^ wrap(values[-1] - values[0])
+
+def muldiv_workload(scale):
+    return f'''
+    li t0, 1
+    li t1, {10000 * scale}
+    li a0, 0x1234567
+    li a3, 0
+loop:
+    mul t2, a0, t0
+    mulh t3, a0, t0
+    mulhu t4, a0, t0
+    div t5, a0, t0
+    divu t6, a0, t0
+    rem a1, a0, t0
+    remu a2, a0, t0
+    xor t2, t2, t3
+    xor t4, t4, t5
+    xor t6, t6, a1
+    add a3, a3, t2
+    add a3, a3, t4
+    add a3, a3, t6
+    add a3, a3, a2
+    addi t0, t0, 1
+    blt t0, t1, loop
+    mv a0, a3
+''' + EXIT
+
+def expected_muldiv(scale):
+    # Operands are positive, so signed and unsigned results agree
+    a0 = 0x1234567
+    a3 = 0
+    for t0 in range(1, 10000 * scale):
+        product = a0 * t0
+        quotient, remainder = divmod(a0, t0)
+        a3 += wrap(product) ^ (product >> 32)
+        a3 += (product >> 32) ^ quotient
+        a3 += quotient ^ remainder
+        a3 = wrap(a3 + remainder)
+    return a3
+
+def putchar_workload(scale):
+    return f'''
+    li s0, {5000 * scale}
+    li a7, 1
+    li t0, 97
+    li t1, 123
+loop:
+    mv a0, t0
+    ecall
+    addi t0, t0, 1
+    blt t0, t1, next
+    li t0, 97
+next:
+    addi s0, s0, -1
+    bnez s0, loop
+    mv a0, t0
+''' + EXIT
+
+def expected_putchar(scale):
+    # The character after the last one printed
+    return 97 + 5000 * scale % 26
+
+WORKLOADS = {
+    'arith': arith_workload,
+    'memcpy': memcpy_workload,
+    'sort': sort_workload,
+    'muldiv': muldiv_workload,
+    'putchar': putchar_workload,
+}
+
+EXPECTED = {
+    'arith': expected_arith,
+    'memcpy': expected_memcpy,
+    'sort': expected_sort,
+    'muldiv': expected_muldiv,
+    'putchar': expected_putchar,
+}
+
+# Bumped when a workload's meaning changes, so saved baselines of the old version are not compared
+WORKLOAD_VERSIONS = {
+    'muldiv': 3,
+}
+
+ENGINES = ['step', 'run', 'translate']
+
+def run_engine(machine, engine):
+    # Runs to the exit ecall; returns the number of instructions retired and the exit code
+    if engine == 'run':
+        result = machine.run()
+        return result.instructions, result.exit_code
+    if engine == 'translate':
+        result = BlockTranslator(machine).run()
+        return result.instructions, result.exit_code
+    count = 0
+    try:
+        while True:
+            machine.step()
+            count += 1
+    except SystemExit as exit:
+        return count + 1, exit.code
+
+def peak_rss_kib():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # macOS reports bytes
+
+def run_case(workload, engine, scale, repeat, stage_limit):
+    # Runs in a fresh worker process so peak RSS belongs to this case alone
+    source = WORKLOADS[workload](scale)
+    expected = EXPECTED[workload](scale)
+    best = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            machine = Machine()
+            load_program(machine, source)
+            start = time.perf_counter()
+            instructions, exit_code = run_engine(machine, engine)
+            elapsed = time.perf_counter() - start
+            if exit_code != expected:
+                raise ValueError(f"{workload} on {engine}: checksum {exit_code}, expected {expected}")
+            if best is None or elapsed < best:
+                best = elapsed
+        stages = None
+        if engine == 'step' and stage_limit:
+            machine = Machine()
+            load_program(machine, source)
+            with Profiler(machine) as profiler:
+                machine.run(max_instructions=stage_limit)
+            totals = profiler.stage_times()
+            measured = max(profiler.instructions(), 1)
+            stages = {stage: totals[stage] / measured for stage in STAGES}
+
+    return {
+        'workload': workload,
+        'engine': engine,
+        'workload_version': WORKLOAD_VERSIONS.get(workload, 1),
+        'instructions': instructions,
+        'seconds': best,
+        'mips': instructions / best / 1e6,
+        'ns_per_instruction': best * 1e9 / instructions,
+        'stage_ns_per_instruction': stages,
+        'peak_rss_kib': peak_rss_kib(),
+    }
+
+def run_suite(workloads, engines, scale=1, repeat=3, stage_limit=200000):
+    results = []
+    for workload in workloads:
+        for engine in engines:
+            with multiprocessing.Pool(1) as pool:
+                results.append(pool.apply(run_case, (workload, engine, scale, repeat, stage_limit)))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scale': scale,
+        'results': results,
+    }
+
+def report(suite, baseline=None, file=sys.stdout):
+    previous = {}
+    if baseline is not None:
+        previous = {(result['workload'], result['engine']): result for result in baseline['results']}
+
+    header = f"{'workload':<10} {'engine':<10} {'instructions':>12} {'MIPS':>8} {'ns/inst':>9} {'RSS KiB':>9}"
+    if previous:
+        header += f" {'vs base':>8}"
+    print(header, file=file)
+    for result in suite['results']:
+        rss = result['peak_rss_kib']
+        line = f"{result['workload']:<10} {result['engine']:<10} {result['instructions']:>12} {result['mips']:>8.3f} {result['ns_per_instruction']:>9.1f} {rss if rss is not None else '-':>9}"
+        old = previous.get((result['workload'], result['engine']))
+        if old is not None and old.get('workload_version', 1) == result.get('workload_version', 1):
+            line += f" {old['ns_per_instruction'] / result['ns_per_instruction']:>7.2f}x"
+        elif previous:
+            line += f" {'-':>8}"
+        print(line, file=file)
+
+    stages = [result for result in suite['results'] if result['stage_ns_per_instruction']]
+    if stages:
+        print(file=file)
+        print(f"{'workload':<10} " + ' '.join(f'{stage:>9}' for stage in STAGES) + '   (ns/instruction, step engine)', file=file)
+        for result in stages:
+            times = result['stage_ns_per_instruction']
+            print(f"{result['workload']:<10} " + ' '.join(f'{times[stage]:>9.1f}' for stage in STAGES), file=file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulator benchmark suite")
+    parser.add_argument('-w', '--workload', action='append', choices=sorted(WORKLOADS), help="Workload to run (repeatable, default all)")
+    parser.add_argument('-e', '--engine', action='append', choices=ENGINES, help="Engine to run (repeatable, default all)")
+    parser.add_argument('--scale', type=int, default=1, help="Workload size multiplier")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case; the fastest is reported")
+    parser.add_argument('--stage-limit', type=int, default=200000, help="Instructions timed per stage (0 disables)")
+    parser.add_argument('--save', help="Write results as JSON to this file")
+    parser.add_argument('--baseline', help="Compare against results saved with --save")
+    args = parser.parse_args()
+
+    suite = run_suite(args.workload or list(WORKLOADS), args.engine or ENGINES, args.scale, args.repeat, args.stage_limit)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    report(suite, baseline)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(suite, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# Delta checkpoints
+# Append-only log of machine checkpoints for long runs. A base record holds every non-zero page; a delta
+# record holds only the pages written since its parent checkpoint, taken from PagedMemory's dirty set.
+# Each record names its parent, so rewinding replays one chain (base, then its deltas in order) and a
+# run continued from a rewound checkpoint simply branches the log. A new base is written once a chain
+# reaches base_interval deltas, bounding the work of any rewind.
+#
+# Every record is fsynced before checkpoint() returns, and a record torn by a crash is dropped when the
+# log is reopened.
+#
+# Records carry the PC, registers, retired instruction count and console input position (with input read
+# from the source but not yet consumed), so a resumed guest's getchar continues where it left off. Output
+# already written and device state are not covered.
+#
+#   log = CheckpointLog('run.rvck')
+#   run_with_checkpoints(machine, log, every=10 ** 7)
+#   log.restore(machine, 42)
+#
+#   python checkpoint.py run prog.elf run.rvck --every 10000000
+#   python checkpoint.py list run.rvck
+#   python checkpoint.py resume run.rvck 42
+
+import argparse
+import os
+import struct
+import zlib
+from collections import namedtuple
+
+from FetchDecodeExecute import Machine
+from memory import ZERO_PAGE
+from snapshot import PAGE_RECORD_FORMAT, PAGE_RECORD_SIZE
+
+CHECKPOINT_MAGIC = b'RVCK'
+CHECKPOINT_VERSION = 2
+LOG_HEADER = struct.Struct('<4sHH')  # magic, version, reserved
+# kind, flags, parent (NO_PARENT for bases), instructions, pc, x0-x31, page count, input bytes consumed,
+# pending input length, compressed body bytes. The body is the pending input followed by the page records.
+RECORD_HEADER = struct.Struct('<BBxxIQI32iIQII')
+KIND_BASE = 0
+KIND_DELTA = 1
+FLAG_INPUT_EOF = 0x1
+NO_PARENT = 0xffffffff
+BASE_INTERVAL = 16  # Deltas at most between a checkpoint and its base
+
+# Index entry of one record; depth counts the deltas back to its base
+Checkpoint = namedtuple('Checkpoint', ['offset', 'kind', 'parent', 'depth', 'instructions', 'pc'])
+
+class CheckpointLog:
+    def __init__(self, filename, base_interval=BASE_INTERVAL, level=1):
+        self.base_interval = base_interval
+        self.level = level
+        self.checkpoints = []
+        self.head = None  # Checkpoint the machine's dirty pages are relative to
+        exists = os.path.exists(filename) and os.path.getsize(filename) > 0
+        self.file = open(filename, 'r+b' if exists else 'w+b')
+        if exists:
+            self.scan()
+        else:
+            self.file.write(LOG_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, 0))
+            self.sync()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def sync(self):
+        # A checkpoint is only reported once it is on disk, so a host crash cannot lose it
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def scan(self):
+        # Rebuilds the index from an existing log; a record cut short by a crash is dropped and overwritten
+        file = self.file
+        file.seek(0)
+        magic, version, _ = LOG_HEADER.unpack(file.read(LOG_HEADER.size))
+        if magic != CHECKPOINT_MAGIC:
+            raise ValueError("Not a checkpoint log")
+        if version != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint log version {version}")
+        end = os.fstat(file.fileno()).st_size
+        offset = LOG_HEADER.size
+        while offset + RECORD_HEADER.size <= end:
+            file.seek(offset)
+            header = RECORD_HEADER.unpack(file.read(RECORD_HEADER.size))
+            kind, flags, parent, instructions, pc = header[:5]
+            length = header[-1]
+            if offset + RECORD_HEADER.size + length > end:
+                break
+            depth = 0 if kind == KIND_BASE else self.checkpoints[parent].depth + 1
+            self.checkpoints.append(Checkpoint(offset, kind, parent, depth, instructions, pc))
+            offset += RECORD_HEADER.size + length
+        if offset < end:
+            file.truncate(offset)
+            self.sync()
+        file.seek(offset)
+
+    def checkpoint(self, machine, instructions=0):
+        # Appends a checkpoint of machine and returns its number. The first checkpoint after opening the
+        # log, or after a chain of base_interval deltas, is a base.
+        memory = machine.memory
+        dirty = memory.take_dirty()
+        parent = self.head
+        if parent is None or self.checkpoints[parent].depth >= self.base_interval:
+            kind = KIND_BASE
+            numbers = sorted(number for number, page in memory.pages.items() if page != ZERO_PAGE)
+            parent = NO_PARENT
+            depth = 0
+        else:
+            kind = KIND_DELTA
+            numbers = sorted(dirty)
+            depth = self.checkpoints[parent].depth + 1
+
+        position, pending, eof = machine.console.input_state()
+        body = bytearray(pending) + bytearray(len(numbers) * PAGE_RECORD_SIZE)
+        offset = len(pending)
+        for number in numbers:
+            struct.pack_into(PAGE_RECORD_FORMAT, body, offset, number)
+            body[offset + 4:offset + PAGE_RECORD_SIZE] = memory.page(number)
+            offset += PAGE_RECORD_SIZE
+        body = zlib.compress(body, self.level)
+
+        file = self.file
+        file.seek(0, os.SEEK_END)
+        offset = file.tell()
+        file.write(RECORD_HEADER.pack(kind, FLAG_INPUT_EOF if eof else 0, parent, instructions, machine.pc, *machine.registers,
+                                      len(numbers), position, len(pending), len(body)))
+        file.write(body)
+        self.sync()
+        self.checkpoints.append(Checkpoint(offset, kind, parent, depth, instructions, machine.pc))
+        self.head = len(self.checkpoints) - 1
+        return self.head
+
+    def read(self, number):
+        # (header fields, pending input, page buffer) of one record
+        file = self.file
+        file.seek(self.checkpoints[number].offset)
+        header = RECORD_HEADER.unpack(file.read(RECORD_HEADER.size))
+        body = zlib.decompress(file.read(header[-1]))
+        page_count, position, pending_length = header[-4:-1]
+        if len(body) != pending_length + page_count * PAGE_RECORD_SIZE:
+            raise ValueError(f"Corrupt checkpoint {number}")
+        body = memoryview(body).toreadonly()
+        return header, bytes(body[:pending_length]), body[pending_length:]
+
+    def chain(self, number):
+        # Checkpoint numbers from the base to number
+        chain = [number]
+        while self.checkpoints[chain[-1]].kind != KIND_BASE:
+            chain.append(self.checkpoints[chain[-1]].parent)
+        chain.reverse()
+        return chain
+
+    def restore(self, machine, number=-1):
+        # Rewinds machine to a checkpoint (the latest by default) and returns its instruction count.
+        # Later checkpoints are kept; the next one written continues from here as a new branch.
+        if number < 0:
+            number += len(self.checkpoints)
+        pages = {}
+        for link in self.chain(number):
+            header, pending, body = self.read(link)
+            for offset in range(0, len(body), PAGE_RECORD_SIZE):
+                page_number = struct.unpack_from(PAGE_RECORD_FORMAT, body, offset)[0]
+                pages[page_number] = body[offset + 4:offset + PAGE_RECORD_SIZE]
+
+        memory = machine.memory
+        memory.pages.clear()
+        memory.forget_all()
+        for page_number, page in pages.items():
+            if page != ZERO_PAGE:
+                memory.pages[page_number] = page  # Read-only view, copied on first write
+        memory.take_dirty()
+        machine.pc = header[4]
+        machine.registers[:] = header[5:37]
+        machine.console.restore_input(header[-3], pending, bool(header[1] & FLAG_INPUT_EOF))
+        for cache in machine.code_caches:
+            cache.clear()
+        self.head = number
+        return header[3]
+
+def run_with_checkpoints(machine, log, every, max_instructions=None, instructions=0):
+    # Runs machine like Machine.run, appending a checkpoint every instructions; returns the last RunResult.
+    # A machine just restored from the log continues from that checkpoint instead of starting a base.
+    if log.head is None:
+        log.checkpoint(machine, instructions)
+    while True:
+        budget = every if max_instructions is None else min(every, max_instructions - instructions)
+        result = machine.run(max_instructions=budget)
+        instructions += result.instructions
+        if result.reason != 'max_instructions':
+            return result
+        log.checkpoint(machine, instructions)
+        if max_instructions is not None and instructions >= max_instructions:
+            return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Run with delta checkpoints, list them, or resume from one")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help="Run an ELF file, checkpointing periodically")
+    run.add_argument('elf', help="RV32 ELF file to run")
+    run.add_argument('log', help="Checkpoint log to append to")
+    run.add_argument('--every', type=int, default=10000000, help="Instructions between checkpoints")
+    run.add_argument('--max-instructions', type=int, help="Stop after this many instructions")
+    listing = commands.add_parser('list', help="List the checkpoints in a log")
+    listing.add_argument('log', help="Checkpoint log to read")
+    resume = commands.add_parser('resume', help="Continue running from a checkpoint")
+    resume.add_argument('log', help="Checkpoint log to read and append to")
+    resume.add_argument('checkpoint', type=int, nargs='?', default=-1, help="Checkpoint number (default: latest)")
+    resume.add_argument('--every', type=int, default=10000000, help="Instructions between checkpoints")
+    resume.add_argument('--max-instructions', type=int, help="Stop after this many instructions in total")
+    args = parser.parse_args()
+
+    with CheckpointLog(args.log) as log:
+        if args.command == 'list':
+            for number, entry in enumerate(log.checkpoints):
+                kind = 'base' if entry.kind == KIND_BASE else f'delta of {entry.parent}'
+                print(f"{number:6} {entry.instructions:>14} instructions  pc 0x{entry.pc:08x}  {kind}")
+            return
+        machine = Machine()
+        if args.command == 'run':
+            machine.load_elf(args.elf)
+            instructions = 0
+        else:
+            instructions = log.restore(machine, args.checkpoint)
+        result = run_with_checkpoints(machine, log, args.every, args.max_instructions, instructions)
+        print(f"Stopped: {result.reason}, {len(log.checkpoints)} checkpoints")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# Persistent code cache
+# Stores the predecoded instructions and translated blocks of an ELF file on disk, keyed by a hash
+# of its PT_LOAD segments and the emulator's own decode/translate sources, so later runs of the same
+# binary skip decoding and block compilation. Entries are marshal files: predecoded fields as tuples and
+# block functions as code objects. Only code that still matches the ELF image is saved, so code the
+# guest modified at run time never reaches the cache.
+#
+# Files are written to a temporary name and renamed into place, so concurrent writers and readers
+# only ever see complete entries. Loading an entry refreshes its modification time, and saving evicts
+# the least recently used entries once the directory exceeds max_bytes.
+#
+#   cache = CodeCache('~/.cache/rv32-emulator')
+#   machine.load_elf(elf)
+#   cache.load(machine, elf)
+#   machine.run()
+#   cache.save(machine, elf)
+
+import builtins
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+import types
+import weakref
+
+import FetchDecodeExecute
+import assembler
+import memory
+import rvc
+import translate
+import writeback
+from FetchDecodeExecute import ALU_OPERATIONS, Predecoded, alu_nop
+from memory import PAGE_SHIFT
+from translate import Block, BlockTranslator
+
+CACHE_VERSION = 2
+MAX_BYTES = 256 << 20  # Default size bound of the cache directory
+SUFFIX = '.rvcode'
+
+def source_digest():
+    # Entries are only valid for the decoder and translator that produced them, and for the memory and
+    # system call interfaces and instruction encodings their code relies on
+    digest = hashlib.sha256(f'{CACHE_VERSION} {sys.implementation.cache_tag}'.encode())
+    for module in (FetchDecodeExecute, assembler, memory, rvc, translate, writeback):
+        with open(module.__file__, 'rb') as file:
+            digest.update(file.read())
+    return digest.digest()
+
+SOURCE_DIGEST = source_digest()
+
+elf_keys = weakref.WeakKeyDictionary()  # ElfFile -> key, so a shared mapping is hashed once
+
+def elf_key(elf):
+    key = elf_keys.get(elf)
+    if key is not None:
+        return key
+    digest = hashlib.sha256(SOURCE_DIGEST)
+    for program_header in elf.load_segments():
+        digest.update(repr(program_header).encode())
+        with elf.segment_data(program_header) as data:
+            digest.update(data)
+    key = elf_keys[elf] = digest.hexdigest()
+    return key
+
+class CodeCache:
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self, machine, elf):
+        # Fills the machine's decode cache and translators from a cached entry; returns False on a miss
+        path = self.path(elf_key(elf))
+        try:
+            with open(path, 'rb') as file:
+                version, predecoded, blocks = marshal.loads(file.read())
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            return False  # Missing, evicted meanwhile, or unreadable
+        if version != CACHE_VERSION:
+            return False
+
+        entries = machine.decode_cache.entries
+        pages = set()
+        operations = ALU_OPERATIONS
+        new = tuple.__new__  # Skips the namedtuple constructor's Python-level __new__
+        for pc, fields in predecoded:
+            entries[pc] = new(Predecoded, fields + (operations.get(fields[8], alu_nop),))
+            pages.add(pc >> PAGE_SHIFT)
+            pages.add((pc + 3) >> PAGE_SHIFT)
+        machine.decode_cache.pages.update(pages)
+
+        translators = [cache for cache in machine.code_caches if isinstance(cache, BlockTranslator)]
+        if translators:
+            namespace = {'__builtins__': builtins}
+            for start, end, length, line_pcs, code in blocks:
+                block = Block(types.FunctionType(code, namespace), start, end, length, line_pcs)
+                for translator in translators:
+                    translator.install(block)
+        return True
+
+    def save(self, machine, elf):
+        # Writes the machine's current code for elf, if it decoded anything, and trims the cache
+        image = self.image(elf)
+
+        def unchanged(start, end):
+            for vaddr, data in image:
+                if vaddr <= start and end <= vaddr + len(data):
+                    return data[start - vaddr:end - vaddr] == machine.memory.read(start, end - start)
+            return False
+
+        predecoded = [(pc, tuple(entry[:-1])) for pc, entry in machine.decode_cache.entries.items()
+                      if unchanged(pc, pc + entry.size)]
+        blocks = []
+        for cache in machine.code_caches:
+            if isinstance(cache, BlockTranslator):
+                for block in cache.blocks.values():
+                    if unchanged(block.start, block.end):
+                        blocks.append((block.start, block.end, block.length, block.line_pcs, block.function.__code__))
+                break
+        if not predecoded and not blocks:
+            return
+
+        data = marshal.dumps((CACHE_VERSION, predecoded, blocks))
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(data)
+            os.replace(temporary, self.path(elf_key(elf)))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        self.evict()
+
+    def image(self, elf):
+        # (vaddr, bytes) for the file-backed part of each PT_LOAD segment
+        image = []
+        for program_header in elf.load_segments():
+            with elf.segment_data(program_header) as data:
+                image.append((program_header[2], bytes(data)))
+        return image
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(SUFFIX):
+                try:
+                    status = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Another process evicted it first
+            total -= size
@@ -0,0 +1,200 @@
+# Console device behind the putchar and getchar system calls
+# Output bytes are collected in a buffer and written in bulk on newline, when the buffer reaches
+# flush_threshold bytes, and when the guest exits. Input is read from a supplied bytes/str/file source,
+# or from sys.stdin when none is given, without prompting. getchar returns -1 at end of input.
+
+import asyncio
+import codecs
+import copy
+import io
+import sys
+
+FLUSH_THRESHOLD = 4096  # Bytes buffered before a flush regardless of newlines
+READ_SIZE = 4096  # Bytes requested from a file input source at a time
+COMPACT_SIZE = 65536  # Consumed input bytes kept before the pending buffer is compacted
+
+class Console:
+    def __init__(self, output=None, input=None, flush_threshold=FLUSH_THRESHOLD, line_buffered=True):
+        # output: text or binary stream; None writes to whatever sys.stdout is at flush time
+        # input: bytes, str, text or binary stream; None reads from whatever sys.stdin is
+        self.output = output
+        self.flush_threshold = flush_threshold
+        self.line_buffered = line_buffered
+        self.buffer = bytearray()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')  # Guest multibyte sequences may span flushes
+        self.pending = bytearray()  # Input read from the source; bytes before start are consumed
+        self.start = 0
+        self.position = 0  # Input bytes consumed
+        self.written = 0  # Output bytes written
+        self.source = None
+        self.eof = False
+        self.set_input(input)
+
+    def set_input(self, input):
+        self.pending.clear()
+        self.start = 0
+        self.eof = False
+        self.source = None
+        if isinstance(input, str):
+            input = input.encode()
+        if isinstance(input, (bytes, bytearray, memoryview)):
+            self.pending += input
+            self.eof = True
+        else:
+            self.source = input
+
+    def feed(self, data):
+        # Appends input, e.g. as it arrives from a client connection
+        if isinstance(data, str):
+            data = data.encode()
+        self.pending += data
+
+    def close_input(self):
+        self.eof = True
+
+    def write(self, value):
+        buffer = self.buffer
+        buffer.append(value & 0xff)
+        if (value == 10 and self.line_buffered) or len(buffer) >= self.flush_threshold:
+            self.flush()
+
+    def write_bytes(self, data):
+        self.buffer += data
+        if (self.line_buffered and b'\n' in data) or len(self.buffer) >= self.flush_threshold:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        self.written += len(data)
+        output = sys.stdout if self.output is None else self.output
+        if isinstance(output, io.TextIOBase):
+            output.write(self.decoder.decode(data))
+        else:
+            output.write(data)
+        output.flush()
+
+    def available(self):
+        # True when read() can return without waiting on the source
+        return len(self.pending) > self.start or self.eof
+
+    def read(self):
+        # Next input byte, or -1 at end of input
+        if len(self.pending) == self.start and not self.eof:
+            self.fill()
+        start = self.start
+        if len(self.pending) == start:
+            return -1
+        value = self.pending[start]
+        self.start = start + 1
+        self.position += 1
+        if self.start >= COMPACT_SIZE:
+            self.compact()
+        return value
+
+    def read_bytes(self, limit):
+        # Up to limit bytes of input, empty at end of input; waits on the source only if nothing is buffered
+        if len(self.pending) == self.start and not self.eof:
+            self.fill()
+        data = bytes(self.pending[self.start:self.start + limit])
+        self.start += len(data)
+        self.position += len(data)
+        if self.start >= COMPACT_SIZE:
+            self.compact()
+        return data
+
+    def input_state(self):
+        # (bytes consumed, input read from the source but not consumed, end of input reached), for snapshots
+        return self.position, bytes(self.pending[self.start:]), self.eof
+
+    def restore_input(self, position, pending, eof):
+        # Rewinds input to a saved input_state(); anything after the saved pending bytes still comes
+        # from this console's source
+        self.pending = bytearray(pending)
+        self.start = 0
+        self.position = position
+        self.eof = eof
+
+    def compact(self):
+        # Drops consumed input; reading advances start rather than shifting the buffer on every byte
+        del self.pending[:self.start]
+        self.start = 0
+
+    def fill(self):
+        source = sys.stdin if self.source is None else self.source
+        self.flush()  # Let a prompt written by the guest appear before blocking on input
+        if isinstance(source, io.TextIOBase):
+            data = source.readline().encode()
+        else:
+            data = source.read1(READ_SIZE) if hasattr(source, 'read1') else source.read(READ_SIZE)
+        if data:
+            self.pending += data
+        else:
+            self.eof = True
+
+    def fork(self):
+        # Console for a forked machine: same output and source, its own copy of pending input
+        self.flush()
+        child = copy.copy(self)
+        child.buffer = bytearray()
+        child.pending = self.pending[self.start:]
+        child.start = 0
+        child.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        return child
+
+class AsyncConsole(Console):
+    # Console backed by asyncio streams, for many machines sharing one event loop. Output goes to the
+    # StreamWriter's transport without blocking. read() raises BlockingIOError instead of waiting when
+    # no input is buffered; the caller awaits receive() and retries the system call. Without a reader,
+    # input arrives through feed() and close_input().
+    def __init__(self, reader=None, writer=None, flush_threshold=FLUSH_THRESHOLD, line_buffered=True):
+        super().__init__(output=writer, flush_threshold=flush_threshold, line_buffered=line_buffered)
+        self.reader = reader
+        self.ready = None  # asyncio.Event, created on first wait so it belongs to the running loop
+
+    def feed(self, data):
+        super().feed(data)
+        if self.ready is not None:
+            self.ready.set()
+
+    def close_input(self):
+        super().close_input()
+        if self.ready is not None:
+            self.ready.set()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        self.written += len(data)
+        if self.output is not None:
+            self.output.write(data)
+
+    def fill(self):
+        raise BlockingIOError("Console input not yet available")
+
+    async def receive(self):
+        # Waits until more input is buffered or the input is closed
+        if self.available():
+            return
+        if self.reader is not None:
+            data = await self.reader.read(READ_SIZE)
+            if data:
+                self.pending += data
+            else:
+                self.eof = True
+            return
+        if self.ready is None:
+            self.ready = asyncio.Event()
+        self.ready.clear()
+        while not self.available():
+            await self.ready.wait()
+            self.ready.clear()
+
+    async def drain(self):
+        self.flush()
+        if self.output is not None:
+            await self.output.drain()
@@ -0,0 +1,308 @@
+# Differential co-simulation
+# Runs a reference machine (Machine.step one instruction at a time) and a candidate engine side by side
+# and compares them every interval instructions: run outcome, PC, registers, console output and a digest
+# of every memory page either side wrote. Both machines are forked at the start of each interval; the
+# fork makes every page copy-on-write, so the pages written during the interval are exactly the ones
+# that became private bytearrays again, and the forks are rewind points. On a mismatch the interval is
+# bisected from those forks down to the first diverging instruction, and a minimal diff is reported.
+#
+# A generator of random RV32IMC instruction streams drives many cases across worker processes.
+#
+#   divergence = Cosim(reference, candidate, 'translate').run(max_instructions=10 ** 6)
+#   if divergence is not None:
+#       print(divergence)
+#
+#   python cosim.py --engine translate --cases 100000 -j 8
+#   python cosim.py --engine run --elf prog.elf
+
+import argparse
+import functools
+import hashlib
+import io
+import os
+import random
+import struct
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from assembler import encode_b, encode_i, encode_j, encode_r, encode_s, encode_u
+from console import Console
+from FetchDecodeExecute import Machine, run_stepwise
+from rvc import expansion_table
+from translate import BlockTranslator
+
+INTERVAL = 256  # Instructions between state comparisons
+CASE_LENGTH = 64  # Instructions per random case, before the exit sequence
+CASE_INSTRUCTIONS = 4096  # Instructions executed per random case at most
+
+CODE_BASE = 0x1000
+DATA_BASE = 0x100000  # Loads and stores of random cases land in the page here, based on x20
+DATA_REGISTER = 20
+LINK_REGISTER = 21  # Set by auipc ahead of each random jalr
+SYSTEM_REGISTER = 17  # Never random, so every ecall is a known system call
+RESERVED_REGISTERS = (DATA_REGISTER, LINK_REGISTER, SYSTEM_REGISTER)
+RANDOM_REGISTERS = [num for num in range(1, 32) if num not in RESERVED_REGISTERS]
+
+# Candidate engines: each takes a machine and returns a function running up to n instructions
+ENGINES = {
+    'run': lambda machine: machine.run,
+    'translate': lambda machine: BlockTranslator(machine).run,
+}
+
+# The first instruction whose effects differ; instruction is the word at pc, before it executes
+Divergence = namedtuple('Divergence', ['instructions', 'pc', 'instruction', 'differences'])
+
+def format_divergence(divergence):
+    lines = [f"Divergence at instruction {divergence.instructions}, pc 0x{divergence.pc:08x}: 0x{divergence.instruction:08x}"]
+    lines.extend('  ' + line for line in divergence.differences)
+    return '\n'.join(lines)
+
+def reference_engine(machine):
+    return functools.partial(run_stepwise, machine, machine.step)
+
+def capture_console(machine, input=None):
+    # Guest output is compared, so each side writes to its own buffer. Input is the given bytes, or the
+    # machine's unread input when continuing from a fork; never the host's stdin, which the two sides
+    # would split between them.
+    position, pending = (0, input) if input is not None else machine.console.input_state()[:2]
+    machine.console = Console(output=io.BytesIO())
+    machine.console.restore_input(position, pending, True)
+    return machine
+
+def advance(run, budget):
+    # Runs up to budget instructions; returns a comparable outcome, errors included
+    try:
+        result = run(budget)
+    except Exception as error:
+        return ('error', f'{type(error).__name__}: {error}', None)
+    return result
+
+def dirty_pages(machine):
+    # Pages written since the machine was last forked
+    return {number for number, page in machine.memory.pages.items() if type(page) is bytearray}
+
+def page_digests(machine, pages):
+    return {number: hashlib.blake2b(machine.memory.page(number), digest_size=16).digest() for number in pages}
+
+def compare(reference, candidate, pages, limit=8):
+    # Returns lines describing every difference, at most limit per kind
+    differences = []
+    if reference.pc != candidate.pc:
+        differences.append(f"pc: 0x{reference.pc:08x} != 0x{candidate.pc:08x}")
+    for num in range(32):
+        if reference.registers[num] != candidate.registers[num]:
+            differences.append(f"x{num}: 0x{reference.registers[num] & 0xffffffff:08x} != 0x{candidate.registers[num] & 0xffffffff:08x}")
+    expected = page_digests(reference, pages)
+    actual = page_digests(candidate, pages)
+    for number in sorted(pages):
+        if expected[number] == actual[number]:
+            continue
+        reference_page = reference.memory.page(number)
+        candidate_page = candidate.memory.page(number)
+        shown = 0
+        for offset in range(len(reference_page)):
+            if reference_page[offset] != candidate_page[offset]:
+                address = (number << 12) + offset
+                differences.append(f"mem[0x{address:08x}]: 0x{reference_page[offset]:02x} != 0x{candidate_page[offset]:02x}")
+                shown += 1
+                if shown == limit:
+                    differences.append(f"  ... more in page 0x{number:05x}")
+                    break
+    reference.console.flush()
+    candidate.console.flush()
+    expected = reference.console.output.getvalue()
+    actual = candidate.console.output.getvalue()
+    if expected != actual:
+        differences.append(f"output: {expected[-40:]!r} != {actual[-40:]!r}")
+    return differences
+
+def state_differences(reference, candidate, expected, actual):
+    # Differences between two machines forked from identical states, after runs with these outcomes
+    differences = compare(reference, candidate, dirty_pages(reference) | dirty_pages(candidate))
+    if expected != actual:
+        differences.insert(0, f"outcome: {expected} != {actual}")
+    return differences
+
+class Cosim:
+    def __init__(self, reference, candidate, engine='translate', interval=INTERVAL, input=b''):
+        # input: bytes both sides read through getchar
+        self.reference = capture_console(reference, input)
+        self.candidate = capture_console(candidate, input)
+        self.engine = ENGINES[engine]
+        self.interval = interval
+        self.run_reference = reference_engine(reference)
+        self.run_candidate = self.engine(candidate)
+        self.instructions = 0  # Compared and identical so far
+
+    def run(self, max_instructions=None):
+        # Returns None if the engines agreed until exit or max_instructions, otherwise the first Divergence
+        while max_instructions is None or self.instructions < max_instructions:
+            budget = self.interval
+            if max_instructions is not None:
+                budget = min(budget, max_instructions - self.instructions)
+            saved = (self.reference.fork(), self.candidate.fork())
+            expected = advance(self.run_reference, budget)
+            actual = advance(self.run_candidate, budget)
+            differences = state_differences(self.reference, self.candidate, expected, actual)
+            if differences:
+                return self.bisect(saved, budget, differences)
+            self.instructions += expected[1] if expected[0] != 'error' else 0
+            if expected[0] != 'max_instructions':
+                break
+        return None
+
+    def replay(self, saved, count):
+        # Fresh copies of the interval's starting states, each advanced by count instructions
+        # Output before the interval already matched, so only output from here on is compared
+        reference, candidate = (capture_console(machine.fork()) for machine in saved)
+        expected = advance(reference_engine(reference), count) if count else None
+        actual = advance(self.engine(candidate), count) if count else None
+        return reference, candidate, expected, actual
+
+    def diverged(self, saved, count):
+        return state_differences(*self.replay(saved, count))
+
+    def bisect(self, saved, budget, differences):
+        # The engines agree after good instructions and disagree after bad. Engines that run whole blocks
+        # may only stop at block boundaries, so the instruction found can be the end of the first bad block.
+        good, bad = 0, budget
+        if not self.diverged(saved, bad):
+            # Not reproducible from the forks (e.g. state outside the machine); report the whole interval
+            reference = self.replay(saved, 0)[0]
+            instruction = reference.predecode(reference.read_instruction(reference.pc)).inst
+            return Divergence(self.instructions + budget, reference.pc, instruction, differences)
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            found = self.diverged(saved, middle)
+            if found:
+                bad, differences = middle, found
+            else:
+                good = middle
+        reference = self.replay(saved, bad - 1)[0]
+        instruction = reference.predecode(reference.read_instruction(reference.pc)).inst
+        return Divergence(self.instructions + bad, reference.pc, instruction, differences)
+
+def random_instruction(rng, index, length):
+    # One RV32IMC instruction at position index of a length-instruction case; returns a list of words
+    rd = rng.choice(RANDOM_REGISTERS)
+    rs1 = rng.randrange(32)
+    rs2 = rng.randrange(32)
+    kind = rng.random()
+    if kind < 0.05:
+        return [random_compressed(rng) | (random_compressed(rng) << 16)]  # Two RV32C instructions in one word
+    if kind < 0.25:
+        funct7, funct3 = rng.choice([(0x00, f) for f in range(8)] + [(0x20, 0x0), (0x20, 0x5)] + [(0x01, f) for f in range(8)])
+        return [encode_r(funct7, rs2, rs1, funct3, rd, 0x33)]
+    if kind < 0.45:
+        funct3 = rng.choice([0x0, 0x2, 0x3, 0x4, 0x6, 0x7, 0x1, 0x5])
+        if funct3 == 0x1:
+            return [encode_i(rng.randrange(32), rs1, funct3, rd, 0x13)]
+        if funct3 == 0x5:
+            return [encode_i(rng.choice([0, 0x400]) | rng.randrange(32), rs1, funct3, rd, 0x13)]
+        return [encode_i(rng.randrange(-2048, 2048), rs1, funct3, rd, 0x13)]
+    if kind < 0.52:
+        return [encode_u(rng.getrandbits(32), rd, rng.choice([0x37, 0x17]))]
+    if kind < 0.64:
+        return [encode_i(rng.randrange(0, 2048), DATA_REGISTER, rng.choice([0, 1, 2, 4, 5]), rd, 0x03)]
+    if kind < 0.76:
+        return [encode_s(rng.randrange(0, 2048), rs2, DATA_REGISTER, rng.choice([0, 1, 2]))]
+    if kind < 0.88:
+        # Branches stay inside the case, including backward ones that may loop until the budget
+        offset = rng.randrange(-index, length - index + 1) * 4
+        return [encode_b(offset, rs2, rs1, rng.choice([0, 1, 4, 5, 6, 7]))]
+    if kind < 0.93:
+        return [encode_j(rng.randrange(1, length - index + 1) * 4, rd)]
+    if kind < 0.97:
+        # auipc then a jalr forward relative to it
+        offset = rng.randrange(2, length - index + 2) * 4
+        return [encode_u(0, LINK_REGISTER, 0x17), encode_i(offset, LINK_REGISTER, 0, rd, 0x67)]
+    # putchar of a random register's low byte
+    return [encode_i(1, 0, 0, SYSTEM_REGISTER, 0x13), encode_i(0, rs1, 0, 10, 0x13), 0x73]
+
+def random_compressed(rng):
+    # A compressed integer computational instruction that leaves the reserved registers alone
+    table = expansion_table()
+    while True:
+        halfword = rng.getrandbits(16)
+        expanded = table[halfword]
+        if expanded & 0x7f in (0x13, 0x33, 0x37) and (expanded >> 7) & 0x1f not in RESERVED_REGISTERS:
+            return halfword
+
+def random_case(seed, length=CASE_LENGTH):
+    # (code words, initial registers) for one case; the code ends in exit(x10)
+    rng = random.Random(seed)
+    words = []
+    while len(words) < length:
+        words.extend(random_instruction(rng, len(words), length))
+    words.extend([encode_i(0, 0, 0, SYSTEM_REGISTER, 0x13), 0x73])
+    registers = [0] + [rng.getrandbits(32) - (1 << 31) for _ in range(31)]
+    registers[DATA_REGISTER] = DATA_BASE
+    registers[SYSTEM_REGISTER] = 0
+    return words, registers
+
+def case_machine(words, registers):
+    machine = Machine()
+    machine.memory.write(CODE_BASE, struct.pack(f'<{len(words)}I', *words))
+    machine.registers[:] = registers
+    machine.pc = CODE_BASE
+    return machine
+
+def check_case(seed, engine='translate', length=CASE_LENGTH, max_instructions=CASE_INSTRUCTIONS, interval=INTERVAL):
+    # Returns None if the engine matches the reference on the case, otherwise a report
+    words, registers = random_case(seed, length)
+    cosim = Cosim(case_machine(words, registers), case_machine(words, registers), engine, interval)
+    divergence = cosim.run(max_instructions)
+    if divergence is None:
+        return None
+    return f"Seed {seed}: " + format_divergence(divergence)
+
+def check_cases(seeds, engine='translate', workers=None, chunksize=64, **options):
+    # Yields a report per diverging case, checking seeds across worker processes
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for report in executor.map(functools.partial(check_case, engine=engine, **options), seeds, chunksize=chunksize):
+            if report is not None:
+                yield report
+
+def main():
+    parser = argparse.ArgumentParser(description="Check an execution engine against the reference step()")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='translate', help="Engine to check")
+    parser.add_argument('--elf', help="Co-simulate this ELF file instead of random cases")
+    parser.add_argument('--input', help="File the ELF's getchar reads from (default: no input)")
+    parser.add_argument('--cases', type=int, default=10000, help="Random cases to run")
+    parser.add_argument('--seed', type=int, default=0, help="First case seed")
+    parser.add_argument('--length', type=int, default=CASE_LENGTH, help="Instructions per random case")
+    parser.add_argument('--max-instructions', type=int, help="Instructions to run per case or ELF file")
+    parser.add_argument('--interval', type=int, default=INTERVAL, help="Instructions between state comparisons")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help="Worker processes")
+    args = parser.parse_args()
+
+    if args.elf:
+        reference = Machine()
+        reference.load_elf(args.elf)
+        candidate = Machine()
+        candidate.load_elf(args.elf)
+        input = b''
+        if args.input:
+            with open(args.input, 'rb') as file:
+                input = file.read()
+        cosim = Cosim(reference, candidate, args.engine, args.interval, input)
+        divergence = cosim.run(args.max_instructions)
+        if divergence is not None:
+            print(format_divergence(divergence))
+            sys.exit(1)
+        print(f"{cosim.instructions} instructions match")
+        return
+
+    failures = 0
+    seeds = range(args.seed, args.seed + args.cases)
+    options = {'length': args.length, 'interval': args.interval, 'max_instructions': args.max_instructions or CASE_INSTRUCTIONS}
+    for report in check_cases(seeds, args.engine, args.workers, **options):
+        print(report)
+        failures += 1
+    print(f"{args.cases} cases, {failures} diverged")
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
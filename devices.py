@@ -0,0 +1,199 @@
+# Memory-mapped I/O devices
+# A Bus claims every address from its lowest device up, so RAM accesses below it pay one comparison
+# in MemoryStage. Devices see (offset, size) register accesses with unsigned values; addresses in the
+# window that no device claims still reach RAM. Bulk transfers go through DMA registers that move whole
+# buffers between guest memory and the device in one access.
+#
+#   bus = Bus(machine)
+#   bus.map(UART_BASE, Uart(machine.console))
+#   bus.map(TIMER_BASE, Timer())
+#   bus.map(BLOCK_BASE, BlockDevice('disk.img'))
+#
+# Devices are bound to the machine they are mapped on, so Machine.fork refuses a machine with a bus.
+
+import mmap
+import time
+
+from memory import LOAD_STRUCTS, STORE_MASKS, STORE_STRUCTS
+
+UART_BASE = 0xf0000000
+TIMER_BASE = 0xf0001000
+BLOCK_BASE = 0xf0002000
+
+SECTOR_SIZE = 512
+
+class Device:
+    size = 0x1000  # Bytes of address space claimed
+
+    def attach(self, machine):
+        # Called when mapped, for devices that transfer to and from guest memory
+        self.machine = machine
+
+    def read(self, offset, size):
+        return 0
+
+    def write(self, offset, size, value):
+        pass
+
+    def dma_read(self, address, length):
+        # Guest memory to host bytes
+        return bytes(self.machine.memory.read(address, length))  # Pages mapped from an ELF read as memoryviews
+
+    def dma_write(self, address, data):
+        # Host bytes to guest memory, dropping any cached code they overwrite
+        self.machine.memory.write(address, data)
+        self.machine.invalidate_code(address, len(data))
+
+class Bus:
+    def __init__(self, machine):
+        self.machine = machine
+        self.devices = []  # (start, end, device), sorted by start
+
+    def map(self, address, device):
+        end = address + device.size
+        for start, other_end, other in self.devices:
+            if address < other_end and start < end:
+                raise ValueError(f"Device at 0x{address:08x} overlaps device at 0x{start:08x}")
+        device.attach(self.machine)
+        self.devices.append((address, end, device))
+        self.devices.sort(key=lambda entry: entry[0])
+        stage = self.machine.memory_stage
+        stage.bus = self
+        stage.mmio_start = self.devices[0][0]
+        return device
+
+    def find(self, address):
+        for start, end, device in self.devices:
+            if start <= address < end:
+                return device, address - start
+        return None, None
+
+    def load(self, address, funct3):
+        device, offset = self.find(address)
+        if device is None:
+            return LOAD_STRUCTS[funct3].unpack(self.machine.memory.read(address, LOAD_STRUCTS[funct3].size))[0]
+        value = device.read(offset, LOAD_STRUCTS[funct3].size)
+        # Sign or zero extend as the load instruction asks
+        return LOAD_STRUCTS[funct3].unpack(STORE_STRUCTS[funct3].pack(value & STORE_MASKS[funct3]))[0]
+
+    def store(self, address, funct3, value):
+        device, offset = self.find(address)
+        if device is None:
+            self.machine.memory.write(address, STORE_STRUCTS[funct3].pack(value & STORE_MASKS[funct3]))
+        else:
+            device.write(offset, STORE_STRUCTS[funct3].size, value & STORE_MASKS[funct3])
+
+class Uart(Device):
+    # Serial port on a Console; the console's buffers act as the transmit and receive FIFOs
+    DATA = 0x00  # Write: transmit a byte. Read: next received byte, all ones at end of input
+    STATUS = 0x04  # Bit 0: a DATA read will not wait. Bit 1: transmitter ready (always)
+    DMA_ADDRESS = 0x08  # Guest buffer for DMA commands
+    DMA_LENGTH = 0x0c  # Bytes to transfer; reads back the bytes moved by the last command
+    DMA_COMMAND = 0x10  # Write 1: transmit the buffer. Write 2: receive up to DMA_LENGTH bytes into it
+
+    STATUS_RX_READY = 0x1
+    STATUS_TX_READY = 0x2
+
+    def __init__(self, console):
+        self.console = console
+        self.dma_address = 0
+        self.dma_length = 0
+
+    def read(self, offset, size):
+        if offset == self.DATA:
+            return self.console.read() & 0xffffffff
+        if offset == self.STATUS:
+            return self.STATUS_TX_READY | (self.STATUS_RX_READY if self.console.available() else 0)
+        if offset == self.DMA_ADDRESS:
+            return self.dma_address
+        if offset == self.DMA_LENGTH:
+            return self.dma_length
+        return 0
+
+    def write(self, offset, size, value):
+        if offset == self.DATA:
+            self.console.write(value)
+        elif offset == self.DMA_ADDRESS:
+            self.dma_address = value
+        elif offset == self.DMA_LENGTH:
+            self.dma_length = value
+        elif offset == self.DMA_COMMAND:
+            if value == 1:
+                self.console.write_bytes(self.dma_read(self.dma_address, self.dma_length))
+            elif value == 2:
+                data = self.console.read_bytes(self.dma_length)
+                self.dma_write(self.dma_address, data)
+                self.dma_length = len(data)
+
+class Timer(Device):
+    # Free-running nanosecond counter. Reading TIME_LO latches TIME_HI, so a LO then HI pair is consistent.
+    TIME_LO = 0x00
+    TIME_HI = 0x04
+
+    def __init__(self, clock=time.perf_counter_ns):
+        self.clock = clock
+        self.start = clock()
+        self.latched = 0
+
+    def read(self, offset, size):
+        if offset == self.TIME_LO:
+            now = self.clock() - self.start
+            self.latched = now >> 32
+            return now & 0xffffffff
+        if offset == self.TIME_HI:
+            return self.latched
+        return 0
+
+class BlockDevice(Device):
+    # Disk backed by a memory-mapped host file, transferred a run of sectors per command
+    SECTOR = 0x00  # First sector of the transfer
+    BUFFER = 0x04  # Guest buffer address
+    COUNT = 0x08  # Sectors to transfer
+    COMMAND = 0x0c  # Write 1: read sectors into the buffer. Write 2: write the buffer to sectors
+    STATUS = 0x10  # 0 after a successful command, 1 after one outside the disk or to a read-only disk
+    SECTORS = 0x14  # Disk size in sectors
+
+    def __init__(self, filename, writable=True):
+        self.writable = writable
+        with open(filename, 'r+b' if writable else 'rb') as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.sector = self.buffer = self.count = self.status = 0
+
+    def close(self):
+        self.mapping.close()
+
+    def read(self, offset, size):
+        if offset == self.SECTOR:
+            return self.sector
+        if offset == self.BUFFER:
+            return self.buffer
+        if offset == self.COUNT:
+            return self.count
+        if offset == self.STATUS:
+            return self.status
+        if offset == self.SECTORS:
+            return len(self.mapping) // SECTOR_SIZE
+        return 0
+
+    def write(self, offset, size, value):
+        if offset == self.SECTOR:
+            self.sector = value
+        elif offset == self.BUFFER:
+            self.buffer = value
+        elif offset == self.COUNT:
+            self.count = value
+        elif offset == self.COMMAND:
+            self.status = self.transfer(value)
+
+    def transfer(self, command):
+        start = self.sector * SECTOR_SIZE
+        end = start + self.count * SECTOR_SIZE
+        if end > len(self.mapping):
+            return 1
+        if command == 1:
+            self.dma_write(self.buffer, self.mapping[start:end])
+        elif command == 2 and self.writable:
+            self.mapping[start:end] = self.dma_read(self.buffer, end - start)
+        else:
+            return 1
+        return 0
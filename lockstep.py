@@ -0,0 +1,294 @@
+# Lockstep execution of one program over many lanes with NumPy
+# Every lane is a copy of a template Machine: registers are an (N, 32) uint32 array and each memory
+# region an (N, size) uint8 array. Lanes at the same PC execute each instruction together as array
+# operations, using the template's predecoded instructions and the scalar ALU semantics, so every lane
+# ends bit for bit where Machine.step would. When a branch sends lanes different ways, the group with
+# the lowest PC runs first (masking the others) until the lanes reconverge.
+#
+# Code is fetched from the template and is not expected to change. Memory outside the regions raises
+# IndexError rather than reading as zero, since each region is allocated for every lane.
+#
+#   lanes = Lockstep(machine, 4096, regions=[(0x100000, 0x10000)])
+#   lanes.registers[:, 10] = np.arange(4096)
+#   lanes.run()
+
+import numpy as np
+
+from memory import PAGE_SHIFT, PAGE_SIZE, STACK_TOP
+from writeback import GuestBreakpoint
+
+STACK_SIZE = 0x10000  # Bytes of stack given to each lane below STACK_TOP
+
+# Load width and signedness, indexed by funct3 as in Machine.get_size and Machine.is_signed
+LOAD_SIZES = [1, 2, 4, 4, 1, 2, 4, 4]
+LOAD_SIGNED = [True, True, True, False, False, False, False, False]
+
+def signed(values):
+    return values.astype(np.int32).astype(np.int64)
+
+def unsigned(values):
+    return values.astype(np.int64)
+
+def vector_mulh(operand1, operand2):
+    return (signed(operand1) * signed(operand2)) >> 32
+
+def vector_mulhsu(operand1, operand2):
+    return (signed(operand1) * unsigned(operand2)) >> 32
+
+def vector_mulhu(operand1, operand2):
+    return (operand1.astype(np.uint64) * operand2.astype(np.uint64)) >> np.uint64(32)
+
+# Quotients truncate toward zero and remainders take the dividend's sign, as in alu_div and alu_rem
+
+def vector_div(operand1, operand2):
+    dividend = signed(operand1)
+    divisor = signed(operand2)
+    zero = divisor == 0
+    quotient = np.abs(dividend) // np.abs(np.where(zero, 1, divisor))
+    return np.where(zero, -1, np.where((dividend < 0) != (divisor < 0), -quotient, quotient))
+
+def vector_divu(operand1, operand2):
+    divisor = unsigned(operand2)
+    zero = divisor == 0
+    return np.where(zero, 0xffffffff, unsigned(operand1) // np.where(zero, 1, divisor))
+
+def vector_rem(operand1, operand2):
+    dividend = signed(operand1)
+    divisor = signed(operand2)
+    zero = divisor == 0
+    return np.where(zero, dividend, np.fmod(dividend, np.where(zero, 1, divisor)))
+
+def vector_remu(operand1, operand2):
+    divisor = unsigned(operand2)
+    zero = divisor == 0
+    return np.where(zero, unsigned(operand1), unsigned(operand1) % np.where(zero, 1, divisor))
+
+# Vector forms of ALU_OPERATIONS on uint32 operands; results are truncated to uint32 by the caller
+VECTOR_OPERATIONS = {
+    'Add': lambda operand1, operand2: operand1 + operand2,
+    'Sub': lambda operand1, operand2: operand1 - operand2,
+    'Mul': lambda operand1, operand2: operand1 * operand2,
+    'MulH': vector_mulh,
+    'MulHSU': vector_mulhsu,
+    'MulHU': vector_mulhu,
+    'Div': vector_div,
+    'DivU': vector_divu,
+    'Rem': vector_rem,
+    'RemU': vector_remu,
+    'LeftShift': lambda operand1, operand2: operand1 << (operand2 & 0x1f),
+    'RightShiftA': lambda operand1, operand2: operand1.astype(np.int32) >> (operand2 & 0x1f).astype(np.int32),
+    'RightShiftL': lambda operand1, operand2: operand1 >> (operand2 & 0x1f),
+    'Or': lambda operand1, operand2: operand1 | operand2,
+    'Xor': lambda operand1, operand2: operand1 ^ operand2,
+    'And': lambda operand1, operand2: operand1 & operand2,
+    'Slt': lambda operand1, operand2: operand1.astype(np.int32) < operand2.astype(np.int32),
+    'SltU': lambda operand1, operand2: operand1 < operand2,
+    'lui': lambda operand1, operand2: operand2 + 0 * operand1,
+    'auipc': lambda operand1, operand2: operand1 + operand2,
+    'jal': lambda operand1, operand2: operand1 + operand2,
+    'jalr': lambda operand1, operand2: (operand1 + operand2) & np.uint32(0xfffffffe),
+    'Nop': lambda operand1, operand2: 0 * operand1,
+}
+
+# Branch conditions on (rs1, rs2), indexed by funct3 as BRANCH_CONDITIONS
+VECTOR_BRANCHES = [
+    lambda operand1, operand2: operand1 == operand2,  # BEQ
+    lambda operand1, operand2: operand1 != operand2,  # BNE
+    lambda operand1, operand2: np.zeros(operand1.shape, bool),
+    lambda operand1, operand2: np.zeros(operand1.shape, bool),
+    lambda operand1, operand2: operand1.astype(np.int32) < operand2.astype(np.int32),  # BLT
+    lambda operand1, operand2: operand1.astype(np.int32) >= operand2.astype(np.int32),  # BGE
+    lambda operand1, operand2: operand1 < operand2,  # BLTU
+    lambda operand1, operand2: operand1 >= operand2,  # BGEU
+]
+
+def immediate(value):
+    return np.uint32(value & 0xffffffff)
+
+class Lockstep:
+    def __init__(self, machine, lanes, regions=(), stack_size=STACK_SIZE):
+        # machine: loaded template Machine. regions: extra (address, size) ranges each lane may access,
+        # in addition to the template's allocated pages and the stack.
+        self.machine = machine
+        self.lanes = lanes
+        self.pc = np.full(lanes, machine.pc, np.uint32)
+        self.registers = np.tile(np.array(machine.registers, np.int64).astype(np.uint32), (lanes, 1))
+        self.running = np.ones(lanes, bool)
+        self.exit_codes = np.zeros(lanes, np.int32)
+        self.instructions = np.zeros(lanes, np.int64)  # Retired per lane
+        self.outputs = [bytearray() for _ in range(lanes)]  # putchar output per lane
+        self.inputs = [b''] * lanes  # getchar input per lane
+        self.input_positions = [0] * lanes
+        self.all_lanes = np.arange(lanes)
+        self.converged = True  # All running lanes share self.pc[0]'s value
+        self.decoded = {}  # PC -> Predecoded, from the template
+
+        ranges = [(STACK_TOP - stack_size, stack_size)] + list(regions)
+        for number in machine.memory.pages:
+            ranges.append((number << PAGE_SHIFT, PAGE_SIZE))
+        self.regions = []  # (start, end, (lanes, size) uint8 array)
+        for start, size in self.merge(ranges):
+            template = np.frombuffer(machine.memory.read_slow(start, size), np.uint8)
+            self.regions.append((start, start + size, np.tile(template, (lanes, 1))))
+
+    def merge(self, ranges):
+        merged = []
+        for start, size in sorted(ranges):
+            if merged and start <= merged[-1][0] + merged[-1][1]:
+                previous_start, previous_size = merged[-1]
+                merged[-1] = (previous_start, max(previous_start + previous_size, start + size) - previous_start)
+            else:
+                merged.append((start, size))
+        return merged
+
+    def set_input(self, lane, data):
+        self.inputs[lane] = data.encode() if isinstance(data, str) else bytes(data)
+        self.input_positions[lane] = 0
+
+    def lane_registers(self, lane):
+        # Registers of one lane as the signed values Machine.registers holds
+        return self.registers[lane].astype(np.int32).tolist()
+
+    def predecode(self, pc):
+        predecoded = self.decoded.get(pc)
+        if predecoded is None:
+            predecoded = self.decoded[pc] = self.machine.predecode(self.machine.read_instruction(pc))
+        return predecoded
+
+    def select(self):
+        # Lanes to run this step and their common PC; None when every lane has stopped
+        if self.converged:
+            if self.running.all():
+                return slice(None), int(self.pc[0])
+            active = np.flatnonzero(self.running)
+            if not len(active):
+                return None, None
+            return active, int(self.pc[active[0]])
+        running = np.flatnonzero(self.running)
+        if not len(running):
+            return None, None
+        pcs = self.pc[running]
+        pc = pcs.min()
+        if (pcs == pc).all():
+            self.converged = True
+            return (slice(None) if len(running) == self.lanes else running), int(pc)
+        return running[pcs == pc], int(pc)
+
+    def run(self, max_steps=None):
+        # Runs until every lane exits or after max_steps lockstep steps; returns the steps taken
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            lanes, pc = self.select()
+            if lanes is None:
+                break
+            self.step(lanes, pc)
+            steps += 1
+        return steps
+
+    def step(self, lanes, pc):
+        # Executes the instruction at pc on the selected lanes, mirroring Machine.run
+        inst, opcode, rd, rs1, rs2, funct3, funct7, imm, aluop, memop, size, operation = self.predecode(pc)
+        registers = self.registers
+        next_pc = np.uint32((pc + size) & 0xffffffff)
+
+        if opcode == 0x13 or opcode == 0x33:  # OP-IMM, R-type
+            if rd:
+                operand2 = immediate(imm) if opcode == 0x13 else registers[lanes, rs2]
+                registers[lanes, rd] = VECTOR_OPERATIONS[aluop](registers[lanes, rs1], operand2)
+            self.pc[lanes] = next_pc
+        elif opcode == 0x03:  # LOAD
+            value = self.load(lanes, registers[lanes, rs1] + immediate(imm), LOAD_SIZES[funct3], LOAD_SIGNED[funct3])
+            if rd:
+                registers[lanes, rd] = value
+            self.pc[lanes] = next_pc
+        elif opcode == 0x23:  # STORE
+            self.store(lanes, registers[lanes, rs1] + immediate(imm), LOAD_SIZES[funct3], registers[lanes, rs2])
+            self.pc[lanes] = next_pc
+        elif opcode == 0x63:  # BRANCH
+            taken = VECTOR_BRANCHES[funct3](registers[lanes, rs1], registers[lanes, rs2])
+            if taken.all():
+                self.pc[lanes] = np.uint32((pc + imm) & 0xffffffff)
+            elif not taken.any():
+                self.pc[lanes] = next_pc
+            else:
+                self.pc[lanes] = np.where(taken, np.uint32((pc + imm) & 0xffffffff), next_pc)
+                self.converged = False
+        elif opcode == 0x6f:  # JAL
+            if rd:
+                registers[lanes, rd] = next_pc
+            self.pc[lanes] = np.uint32((pc + imm) & 0xffffffff)
+        elif opcode == 0x67:  # JALR
+            target = VECTOR_OPERATIONS['jalr'](registers[lanes, rs1], immediate(imm))
+            if rd:
+                registers[lanes, rd] = next_pc
+            self.pc[lanes] = target
+            if (target != target[0]).any():
+                self.converged = False
+        elif opcode == 0x37:  # LUI
+            if rd:
+                registers[lanes, rd] = immediate(imm)
+            self.pc[lanes] = next_pc
+        elif opcode == 0x17:  # AUIPC
+            if rd:
+                registers[lanes, rd] = np.uint32((pc + imm) & 0xffffffff)
+            self.pc[lanes] = next_pc
+        elif aluop == 'ecall':
+            self.ecall(lanes, next_pc)
+            return
+        elif aluop == 'ebreak':
+            raise GuestBreakpoint(pc)  # The lanes are left at the breakpoint
+        else:
+            if rd:
+                registers[lanes, rd] = 0
+            self.pc[lanes] = next_pc
+        self.instructions[lanes] += 1
+
+    def ecall(self, lanes, next_pc):
+        # System calls differ per lane, so each lane is handled on its own
+        registers = self.registers
+        for lane in self.all_lanes[lanes]:
+            a7 = registers[lane, 17]
+            a0 = int(registers[lane, 10])
+            self.instructions[lane] += 1
+            if a7 == 0:
+                # Exited lanes stop at the ecall, as Machine.run leaves them
+                self.running[lane] = False
+                self.exit_codes[lane] = a0 - ((a0 & 0x80000000) << 1)
+                continue
+            if a7 == 1:
+                self.outputs[lane].append(a0 & 0xff)
+            elif a7 == 2:
+                position = self.input_positions[lane]
+                if position < len(self.inputs[lane]):
+                    registers[lane, 10] = self.inputs[lane][position]
+                    self.input_positions[lane] = position + 1
+                else:
+                    registers[lane, 10] = 0xffffffff  # -1 at end of input
+            elif a7 != 3:  # The debug call has no effect on lanes
+                raise ValueError("Unknown system call")
+            self.pc[lane] = next_pc
+
+    def locate(self, addresses, size):
+        # Region holding every address, and the offsets into it
+        low = int(addresses.min())
+        high = int(addresses.max()) + size
+        for start, end, data in self.regions:
+            if start <= low and high <= end:
+                return data, addresses.astype(np.int64) - start
+        raise IndexError(f"Lane address 0x{low:08x}-0x{high:08x} outside lockstep memory regions")
+
+    def load(self, lanes, addresses, size, is_signed):
+        data, offsets = self.locate(addresses, size)
+        rows = self.all_lanes[lanes]
+        value = data[rows, offsets].astype(np.uint32)
+        for byte in range(1, size):
+            value |= data[rows, offsets + byte].astype(np.uint32) << np.uint32(8 * byte)
+        if is_signed and size < 4:
+            value = value.astype(np.int8 if size == 1 else np.int16).astype(np.int32).astype(np.uint32)
+        return value
+
+    def store(self, lanes, addresses, size, values):
+        data, offsets = self.locate(addresses, size)
+        rows = self.all_lanes[lanes]
+        for byte in range(size):
+            data[rows, offsets + byte] = (values >> np.uint32(8 * byte)).astype(np.uint8)
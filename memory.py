@@ -1,57 +1,248 @@
 import struct
 
+PAGE_SHIFT = 12  # 4 KiB pages
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_MASK = PAGE_SIZE - 1
+ADDRESS_SPACE = 1 << 32
+STACK_TOP = 0x7ffff000  # Initial stack pointer, below the sign bit so it stays a positive register value
+
+ZERO_PAGE = bytes(PAGE_SIZE)  # Shared backing for every page that was never written
+
+class PagedMemory:
+    # Sparse 32-bit address space. Pages are bytearrays allocated on first write; until then they read
+    # as zero. Pages may also be read-only buffers (e.g. views of a mapped ELF file) that are copied on
+    # first write. The most recently read and written pages are cached to skip the page table lookup.
+    # Page numbers written since the last take_dirty() are collected in dirty; only page table changes and
+    # write cache misses record them, so the cached store fast path costs nothing extra.
+    def __init__(self):
+        self.pages = {}  # Page number -> bytearray, or read-only buffer for copy-on-write pages
+        self.dirty = set()
+        self.read_number = -1
+        self.read_page = None
+        self.write_number = -1
+        self.write_page = None
+
+    def __len__(self):
+        return ADDRESS_SPACE
+
+    def page(self, number):
+        return self.pages.get(number, ZERO_PAGE)
+
+    def writable_page(self, number):
+        page = self.pages.get(number)
+        if type(page) is not bytearray:
+            page = bytearray(PAGE_SIZE) if page is None else bytearray(page)
+            self.pages[number] = page
+        if number == self.read_number:
+            self.read_page = page
+        self.dirty.add(number)
+        self.write_number = number
+        self.write_page = page
+        return page
+
+    def readable_page(self, number):
+        page = self.pages.get(number, ZERO_PAGE)
+        self.read_number = number
+        self.read_page = page
+        return page
+
+    def read(self, address, size):
+        offset = address & PAGE_MASK
+        if offset + size > PAGE_SIZE:
+            return self.read_slow(address, size)
+        number = address >> PAGE_SHIFT
+        if number == self.read_number:
+            page = self.read_page
+        else:
+            page = self.pages.get(number, ZERO_PAGE)
+            self.read_number = number
+            self.read_page = page
+        return page[offset:offset + size]
+
+    def read_slow(self, address, size):
+        # Accesses spanning pages, including the wrap at the top of the address space
+        data = bytearray()
+        while size > 0:
+            address &= ADDRESS_SPACE - 1
+            offset = address & PAGE_MASK
+            chunk = min(size, PAGE_SIZE - offset)
+            data += self.page(address >> PAGE_SHIFT)[offset:offset + chunk]
+            address += chunk
+            size -= chunk
+        return bytes(data)
+
+    def write(self, address, data):
+        offset = address & PAGE_MASK
+        size = len(data)
+        if offset + size > PAGE_SIZE:
+            return self.write_slow(address, data)
+        number = address >> PAGE_SHIFT
+        if number == self.write_number:
+            page = self.write_page
+        else:
+            page = self.writable_page(number)
+        page[offset:offset + size] = data
+
+    def write_slow(self, address, data):
+        data = memoryview(data)
+        while len(data):
+            address &= ADDRESS_SPACE - 1
+            offset = address & PAGE_MASK
+            chunk = min(len(data), PAGE_SIZE - offset)
+            self.writable_page(address >> PAGE_SHIFT)[offset:offset + chunk] = data[:chunk]
+            address += chunk
+            data = data[chunk:]
+
+    def map(self, address, data):
+        # Maps a read-only buffer: whole pages reference it directly (copy-on-write), partial pages are copied
+        data = memoryview(data)
+        while len(data):
+            offset = address & PAGE_MASK
+            chunk = min(len(data), PAGE_SIZE - offset)
+            if chunk == PAGE_SIZE:
+                self.pages[address >> PAGE_SHIFT] = data[:PAGE_SIZE]
+                self.dirty.add(address >> PAGE_SHIFT)
+                self.forget(address >> PAGE_SHIFT)
+            else:
+                self.write(address, data[:chunk])
+            address += chunk
+            data = data[chunk:]
+
+    def zero(self, address, size):
+        # Whole pages go back to zero-fill-on-demand; partial pages are cleared only if allocated
+        while size > 0:
+            offset = address & PAGE_MASK
+            chunk = min(size, PAGE_SIZE - offset)
+            number = address >> PAGE_SHIFT
+            if chunk == PAGE_SIZE:
+                if self.pages.pop(number, None) is not None:
+                    self.dirty.add(number)
+                self.forget(number)
+            elif number in self.pages:
+                self.write(address, bytes(chunk))
+            address += chunk
+            size -= chunk
+
+    def fork(self):
+        # New address space sharing every page copy-on-write; both sides copy a page on their next write to it
+        clone = PagedMemory()
+        for number, page in self.pages.items():
+            if type(page) is bytearray:
+                page = memoryview(page).toreadonly()
+                self.pages[number] = page
+            clone.pages[number] = page
+        self.forget_all()
+        return clone
+
+    def take_dirty(self):
+        # Returns the pages written since the last call and starts a new set. Dropping the cached write
+        # page sends the next store to each page through writable_page, which records it again.
+        dirty = self.dirty
+        self.dirty = set()
+        self.write_number = -1
+        self.write_page = None
+        return dirty
+
+    def forget_all(self):
+        self.read_number = self.write_number = -1
+        self.read_page = self.write_page = None
+
+    def forget(self, number):
+        # Drops the cached page pointers after the page table entry changed behind them
+        if number == self.read_number:
+            self.read_number = -1
+            self.read_page = None
+        if number == self.write_number:
+            self.write_number = -1
+            self.write_page = None
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return bytes(self.read(key.start, key.stop - key.start))
+        return self.read(key, 1)[0]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            self.write(key.start, value)
+        else:
+            self.write(key, bytes([value]))
+
+# Struct per funct3 for loads (lb, lh, lw, -, lbu, lhu, -, -) and stores (sb, sh, sw, -); the unused
+# encodings behave like lw/sw, as get_size and is_signed treat them
+LOAD_STRUCTS = [struct.Struct(fmt) for fmt in ['<b', '<h', '<i', '<i', '<B', '<H', '<i', '<i']]
+STORE_STRUCTS = [struct.Struct(fmt) for fmt in ['<B', '<H', '<I', '<I', '<B', '<H', '<I', '<I']]
+STORE_MASKS = [(1 << (8 * entry.size)) - 1 for entry in STORE_STRUCTS]
+SIZE_CODES = {1: 0, 2: 1, 4: 2}  # Access size -> funct3 width bits
+LOAD_LIMIT = PAGE_SIZE - 4  # Accesses at or below this page offset never span pages
+
 class MemoryStage:
     def __init__(self, memory):
         self.memory = memory
+        self.bus = None  # Device bus owning every address from mmio_start up
+        self.mmio_start = ADDRESS_SPACE
+        self.unpackers = [entry.unpack_from for entry in LOAD_STRUCTS]
+        self.packers = [entry.pack_into for entry in STORE_STRUCTS]
+
+    def load_funct3(self, address, funct3):
+        # Unpacks straight from the page buffer; only accesses near the end of a page take the slow path
+        if address >= self.mmio_start:
+            return self.bus.load(address, funct3)
+        memory = self.memory
+        offset = address & PAGE_MASK
+        if offset <= LOAD_LIMIT:
+            number = address >> PAGE_SHIFT
+            if number == memory.read_number:
+                return self.unpackers[funct3](memory.read_page, offset)[0]
+            return self.unpackers[funct3](memory.readable_page(number), offset)[0]
+        return self.unpackers[funct3](memory.read(address, LOAD_STRUCTS[funct3].size))[0]
+
+    def store_funct3(self, address, funct3, value):
+        if address >= self.mmio_start:
+            return self.bus.store(address, funct3, value)
+        memory = self.memory
+        offset = address & PAGE_MASK
+        if offset <= LOAD_LIMIT:
+            number = address >> PAGE_SHIFT
+            if number == memory.write_number:
+                self.packers[funct3](memory.write_page, offset, value & STORE_MASKS[funct3])
+            else:
+                self.packers[funct3](memory.writable_page(number), offset, value & STORE_MASKS[funct3])
+        else:
+            memory.write(address, STORE_STRUCTS[funct3].pack(value & STORE_MASKS[funct3]))
 
     def load(self, address, size, signed=True):
-        data = self.memory[address:address + size]
-        if size == 1:  # lb or lbu
-            value = struct.unpack('<b' if signed else '<B', data)[0]
-        elif size == 2:  # lh or lhu
-            value = struct.unpack('<h' if signed else '<H', data)[0]
-        elif size == 4:  # lw
-            value = struct.unpack('<i', data)[0]
-        return value
+        return self.load_funct3(address, SIZE_CODES[size] | (0 if signed or size == 4 else 4))
 
     def store(self, address, size, value):
-        if size == 1:  # sb
-            data = struct.pack('<B', value & 0xFF)
-        elif size == 2:  # sh
-            data = struct.pack('<H', value & 0xFFFF)
-        elif size == 4:  # sw
-            data = struct.pack('<I', value & 0xFFFFFFFF)
-        self.memory[address:address + size] = data
+        self.store_funct3(address, SIZE_CODES[size], value)
 
 class Machine:
     def __init__(self):
-        self.memory = bytearray(1024 * 1024)
+        self.memory = PagedMemory()
         self.registers = [0] * 32
         self.pc = 0
-        self.registers[2] = len(self.memory)  # Set the stack pointer to the bottom of the RAM memory
+        self.registers[2] = STACK_TOP
         self.alu = ALU()
         self.memory_stage = MemoryStage(self.memory)
 
     def memory_access(self, decoded_instruction):
-        memop = decoded_instruction['memop']
-        address = decoded_instruction['result']
+        memop = decoded_instruction.memop
+        address = decoded_instruction.result & 0xffffffff
         if memop == 'load':
-            size = self.get_size(decoded_instruction['funct3'])
-            signed = self.is_signed(decoded_instruction['funct3'])
-            decoded_instruction['result'] = self.memory_stage.load(address, size, signed)
+            size = self.get_size(decoded_instruction.funct3)
+            signed = self.is_signed(decoded_instruction.funct3)
+            decoded_instruction.result = self.memory_stage.load(address, size, signed)
         elif memop == 'store':
-            size = self.get_size(decoded_instruction['funct3'])
-            value = decoded_instruction['strval']
+            size = self.get_size(decoded_instruction.funct3)
+            value = decoded_instruction.strval
             self.memory_stage.store(address, size, value)
 
     def get_size(self, funct3):
-        if funct3 == 0:  # lb, sb
+        if funct3 & 0x3 == 0:  # lb, lbu, sb
             return 1
-        elif funct3 == 1:  # lh, sh
+        elif funct3 & 0x3 == 1:  # lh, lhu, sh
             return 2
-        elif funct3 == 2:  # lw, sw
-            return 4
-        return 4  # Default to word size
+        return 4  # lw, sw
 
     def is_signed(self, funct3):
         return funct3 in [0, 1, 2]  # lb, lh, lw are signed; lbu, lhu are unsigned
@@ -62,7 +253,7 @@ class Machine:
         executed_instruction = self.execute(decoded_instruction)
         self.memory_access(executed_instruction)
         self.writeback(executed_instruction)
-        self.pc = executed_instruction['pc_update']  # Update PC after instruction execution
+        self.pc = executed_instruction.pc_update  # Update PC after instruction execution
 
 
 class ALU:
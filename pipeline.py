@@ -0,0 +1,206 @@
+# Detailed pipeline timing mode
+# Cycle-level model of the classic five-stage in-order pipeline (IF, ID, EX, MEM, WB) for a region of
+# interest, with Machine.run as the fast functional mode for skipping to it. Each instruction is
+# executed by machine.step() when it is fetched, so architectural state is always exact; the model only
+# decides how many cycles each instruction costs as it moves through the stage latches:
+#
+#   - data hazards: with forwarding only a load followed by a dependent instruction stalls (one cycle);
+#     without it, a dependent instruction waits in ID until its producer reaches WB
+#   - control hazards: fetch stops behind a mispredicted branch or jump until it resolves (JAL and
+#     predicted-taken branches in ID, other branches and JALR in EX); the lost fetch slots are bubbles
+#
+# A run drains the pipeline before returning, so the two modes can be alternated freely.
+#
+#   machine.run(until_pc=roi_start)                          # functional fast-forward
+#   pipeline = Pipeline(machine, predictor=GsharePredictor())
+#   pipeline.run(max_instructions=1000000)                   # detailed region of interest
+#   print(pipeline.report())
+#
+#   python pipeline.py prog.elf --skip 1000000 --detail 100000
+
+import argparse
+from collections import namedtuple
+
+from FetchDecodeExecute import Machine, RunResult
+from timing import PREDICTORS
+
+IF, ID, EX, MEM, WB = range(5)
+STAGE_NAMES = ['IF', 'ID', 'EX', 'MEM', 'WB']
+
+# An instruction in flight: destination register (0 for none), source registers, whether it is a load,
+# and the stage in which it redirects fetch (None when fetch continues sequentially)
+InFlight = namedtuple('InFlight', ['pc', 'inst', 'rd', 'sources', 'load', 'redirect'])
+
+class Pipeline:
+    def __init__(self, machine, forwarding=True, predictor=None):
+        self.machine = machine
+        self.forwarding = forwarding
+        self.predictor = predictor  # timing.BranchPredictor for conditional branches
+        self.stages = [None] * 5  # Latch contents per stage; None is a bubble
+        self.redirect = None  # Control instruction fetch is waiting on
+        self.cycles = 0
+        self.instructions = 0  # Retired
+        self.data_stalls = 0
+        self.control_bubbles = 0
+        self.branches = 0
+        self.redirects = 0
+
+    def predict(self, pc, predecoded, taken):
+        # Predicted direction of a resolved conditional branch; not taken without a predictor
+        if self.predictor is None:
+            return False
+        return self.predictor.record(pc, (pc + predecoded.imm) & 0xffffffff, taken)
+
+    def cpi(self):
+        return self.cycles / self.instructions if self.instructions else 0.0
+
+    def fetch(self):
+        # Executes the next instruction and returns its InFlight record, or None at the exit ecall
+        machine = self.machine
+        pc = machine.pc
+        predecoded = machine.decode_cache.entries.get(pc)
+        if predecoded is None:
+            predecoded = machine.predecode(machine.read_instruction(pc))
+            machine.decode_cache.insert(pc, predecoded)
+        inst, opcode, rd, rs1, rs2, funct3, funct7, imm, aluop, memop, size, operation = predecoded
+
+        if aluop == 'ecall' and machine.registers[17] == 0:
+            return None
+        machine.step()
+
+        sources = ()
+        if rs1:
+            sources = (rs1, rs2) if rs2 else (rs1,)
+        elif rs2:
+            sources = (rs2,)
+        redirect = None
+        if opcode == 0x63 or opcode == 0x6f or opcode == 0x67:
+            self.branches += 1
+            if opcode == 0x6f:
+                redirect = ID  # Target known once decoded
+            elif opcode == 0x67:
+                redirect = EX  # Target needs rs1
+            else:
+                taken = machine.pc != (pc + predecoded.size) & 0xffffffff
+                predicted = self.predict(pc, predecoded, taken)
+                if taken and predicted:
+                    redirect = ID  # Predicted taken: target computed in decode
+                elif taken != predicted:
+                    redirect = EX
+            if redirect is not None:
+                self.redirects += 1
+        return InFlight(pc, inst, rd or 0, sources, memop == 'load', redirect)
+
+    def hazard(self, consumer):
+        # True if the instruction in ID must wait for an older one
+        if consumer is None or not consumer.sources:
+            return False
+        producer = self.stages[EX]
+        if producer is not None and producer.rd and producer.rd in consumer.sources:
+            if producer.load or not self.forwarding:
+                return True
+        if not self.forwarding:
+            producer = self.stages[MEM]
+            if producer is not None and producer.rd and producer.rd in consumer.sources:
+                return True
+        return False
+
+    def cycle(self, fetching):
+        # Advances every latch by one cycle; returns False once fetch reached the exit ecall
+        stages = self.stages
+        self.cycles += 1
+        if stages[WB] is not None:
+            self.instructions += 1
+        stall = self.hazard(stages[ID])  # Against the producers in EX and MEM at the start of the cycle
+        stages[WB] = stages[MEM]
+        stages[MEM] = stages[EX]
+        if stall:
+            stages[EX] = None  # Bubble; ID and IF hold
+            self.data_stalls += 1
+            return True
+        stages[EX] = stages[ID]
+        stages[ID] = stages[IF]
+        stages[IF] = None
+        result = True
+        if self.redirect is not None:
+            self.control_bubbles += 1
+        elif fetching:
+            entry = self.fetch()
+            if entry is None:
+                result = False
+            else:
+                stages[IF] = entry
+                if entry.redirect is not None:
+                    self.redirect = entry
+        # A control instruction reaching its resolving stage lets fetch restart next cycle
+        redirect = self.redirect
+        if redirect is not None and stages[redirect.redirect] is redirect:
+            self.redirect = None
+        return result
+
+    def run(self, max_instructions=None, until_pc=None):
+        # Detailed mode; fetches at most max_instructions or up to until_pc, then drains the pipeline.
+        # The result counts instructions retired here, including the exit ecall as Machine.run does.
+        machine = self.machine
+        fetched = 0
+        reason = 'max_instructions'
+        exit_code = None
+        start = self.instructions
+        while True:
+            if max_instructions is not None and fetched >= max_instructions:
+                break
+            if machine.pc == until_pc and fetched:
+                reason = 'until_pc'
+                break
+            if self.redirect is None and not self.hazard(self.stages[ID]):
+                fetched += 1  # This cycle fetches
+            if not self.cycle(True):
+                fetched -= 1
+                reason = 'exit'
+                exit_code = machine.registers[10]
+                break
+        while any(stage is not None for stage in self.stages):
+            self.cycle(False)
+        self.redirect = None
+        retired = self.instructions - start
+        if reason == 'exit':
+            self.instructions += 1  # The exit ecall, never executed
+            self.cycles += 1
+            retired += 1
+        return RunResult(reason, retired, exit_code)
+
+    def report(self):
+        return '\n'.join([
+            f"Cycles:          {self.cycles}",
+            f"Instructions:    {self.instructions}",
+            f"CPI:             {self.cpi():.3f}",
+            f"Data stalls:     {self.data_stalls}",
+            f"Control bubbles: {self.control_bubbles}",
+            f"Branches/jumps:  {self.branches} ({self.redirects} redirected fetch)",
+        ])
+
+def main():
+    parser = argparse.ArgumentParser(description="Fast-forward functionally, then time a region in detail")
+    parser.add_argument('elf', help="RV32 ELF file to run")
+    parser.add_argument('--skip', type=int, help="Instructions to fast-forward before the detailed region")
+    parser.add_argument('--skip-to-pc', type=lambda text: int(text, 0), help="Fast-forward until this PC")
+    parser.add_argument('--detail', type=int, help="Instructions to run in detailed mode (default: to exit)")
+    parser.add_argument('--no-forwarding', action='store_true', help="Model a pipeline without forwarding paths")
+    parser.add_argument('--predictor', choices=sorted(PREDICTORS), help="Branch predictor (default: not taken)")
+    args = parser.parse_args()
+
+    machine = Machine()
+    machine.load_elf(args.elf)
+    if args.skip is not None or args.skip_to_pc is not None:
+        result = machine.run(max_instructions=args.skip, until_pc=args.skip_to_pc)
+        print(f"Fast-forward: {result.instructions} instructions ({result.reason})")
+        if result.reason == 'exit':
+            return
+    predictor = PREDICTORS[args.predictor]() if args.predictor else None
+    pipeline = Pipeline(machine, forwarding=not args.no_forwarding, predictor=predictor)
+    result = pipeline.run(max_instructions=args.detail)
+    print(f"Detailed: {result.instructions} instructions ({result.reason})")
+    print(pipeline.report())
+
+if __name__ == '__main__':
+    main()
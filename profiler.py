@@ -0,0 +1,192 @@
+# Emulator profiler
+# Counts instructions per opcode and ALU operation, times each pipeline stage and records how often
+# each guest PC executes. Attaching swaps profiled step() and run() methods onto one Machine instance;
+# detaching removes them, so an unprofiled machine runs the normal methods with no extra checks.
+#
+#   with Profiler(machine) as profiler:
+#       machine.run()
+#   print(profiler.report())
+#   open('emulator.folded', 'w').write(profiler.collapsed())
+#
+#   python profiler.py prog.elf --folded prog.folded
+
+import argparse
+import sys
+import time
+
+from FetchDecodeExecute import Machine, run_stepwise
+
+STAGES = ['fetch', 'decode', 'execute', 'memory', 'writeback']
+
+OPCODE_NAMES = {
+    0x33: 'OP',
+    0x13: 'OP-IMM',
+    0x03: 'LOAD',
+    0x23: 'STORE',
+    0x63: 'BRANCH',
+    0x6f: 'JAL',
+    0x67: 'JALR',
+    0x37: 'LUI',
+    0x17: 'AUIPC',
+    0x73: 'SYSTEM',
+}
+
+def opcode_name(opcode):
+    return OPCODE_NAMES.get(opcode, f'0x{opcode:02x}')
+
+class Profiler:
+    def __init__(self, machine, clock=time.perf_counter_ns):
+        self.machine = machine
+        self.clock = clock
+        self.stats = {}  # (opcode, aluop) -> [count, fetch ns, decode ns, execute ns, memory ns, writeback ns]
+        self.pcs = {}  # PC -> times executed
+
+    def attach(self):
+        self.machine.step = self.step
+        self.machine.run = self.run
+        return self
+
+    def detach(self):
+        del self.machine.step
+        del self.machine.run
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def reset(self):
+        self.stats.clear()
+        self.pcs.clear()
+
+    def step(self):
+        # Machine.step with a clock read between stages
+        machine = self.machine
+        clock = self.clock
+        t0 = clock()
+        pc = machine.pc
+        predecoded = machine.decode_cache.entries.get(pc)
+        if predecoded is None:
+            fetched_instruction = machine.fetch()
+            t1 = clock()
+            predecoded = machine.predecode(fetched_instruction['inst'])
+            machine.decode_cache.insert(pc, predecoded)
+        else:
+            t1 = clock()
+        decoded_instruction = machine.expand(predecoded)
+        t2 = clock()
+        t3 = t4 = None
+        try:
+            executed_instruction = machine.execute(decoded_instruction)
+            t3 = clock()
+            machine.memory_access(executed_instruction)
+            t4 = clock()
+            machine.writeback(executed_instruction)
+            machine.pc = executed_instruction.pc_update
+        finally:
+            t5 = clock()
+            if t3 is None:
+                t3 = t4 = t5
+            elif t4 is None:
+                t4 = t5
+            key = (predecoded.opcode, predecoded.aluop)
+            entry = self.stats.get(key)
+            if entry is None:
+                entry = self.stats[key] = [0, 0, 0, 0, 0, 0]
+            entry[0] += 1
+            entry[1] += t1 - t0
+            entry[2] += t2 - t1
+            entry[3] += t3 - t2
+            entry[4] += t4 - t3
+            entry[5] += t5 - t4
+            self.pcs[pc] = self.pcs.get(pc, 0) + 1
+
+    def run(self, max_instructions=None, until_pc=None, until_ecall_exit=True):
+        return run_stepwise(self.machine, self.step, max_instructions, until_pc, until_ecall_exit, self.record_exit)
+
+    def record_exit(self, predecoded):
+        # The exit ecall is counted but not executed
+        entry = self.stats.setdefault((predecoded.opcode, predecoded.aluop), [0, 0, 0, 0, 0, 0])
+        entry[0] += 1
+        self.pcs[self.machine.pc] = self.pcs.get(self.machine.pc, 0) + 1
+
+    def instructions(self):
+        return sum(entry[0] for entry in self.stats.values())
+
+    def stage_times(self):
+        # Cumulative ns per stage
+        totals = dict.fromkeys(STAGES, 0)
+        for entry in self.stats.values():
+            for index, stage in enumerate(STAGES, 1):
+                totals[stage] += entry[index]
+        return totals
+
+    def opcode_counts(self):
+        counts = {}
+        for (opcode, aluop), entry in self.stats.items():
+            name = opcode_name(opcode)
+            counts[name] = counts.get(name, 0) + entry[0]
+        return counts
+
+    def aluop_counts(self):
+        counts = {}
+        for (opcode, aluop), entry in self.stats.items():
+            counts[str(aluop)] = counts.get(str(aluop), 0) + entry[0]
+        return counts
+
+    def hot_pcs(self, limit=20):
+        return sorted(self.pcs.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def report(self, limit=20):
+        # Flat text report
+        instructions = self.instructions()
+        lines = [f"Instructions: {instructions}"]
+        stages = self.stage_times()
+        total = sum(stages.values()) or 1
+        lines.append("")
+        lines.append(f"{'stage':<10} {'ms':>10} {'%':>6} {'ns/inst':>9}")
+        for stage in STAGES:
+            lines.append(f"{stage:<10} {stages[stage] / 1e6:>10.2f} {100 * stages[stage] / total:>6.1f} {stages[stage] / max(instructions, 1):>9.1f}")
+
+        for title, counts in (('opcode', self.opcode_counts()), ('aluop', self.aluop_counts())):
+            lines.append("")
+            lines.append(f"{title:<10} {'count':>12} {'%':>6}")
+            for name, count in sorted(counts.items(), key=lambda item: item[1], reverse=True):
+                lines.append(f"{name:<10} {count:>12} {100 * count / max(instructions, 1):>6.1f}")
+
+        lines.append("")
+        lines.append(f"{'pc':<10} {'count':>12}")
+        for pc, count in self.hot_pcs(limit):
+            lines.append(f"0x{pc:08x} {count:>12}")
+        return '\n'.join(lines)
+
+    def collapsed(self):
+        # Collapsed stacks (stage;opcode;aluop ns) for flamegraph tools
+        lines = []
+        for (opcode, aluop), entry in sorted(self.stats.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            for index, stage in enumerate(STAGES, 1):
+                if entry[index]:
+                    lines.append(f"{stage};{opcode_name(opcode)};{aluop} {entry[index]}")
+        return '\n'.join(lines) + '\n'
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an ELF file under the profiler")
+    parser.add_argument('elf', help="RV32 ELF file to run")
+    parser.add_argument('--max-instructions', type=int, help="Stop after this many instructions")
+    parser.add_argument('--top', type=int, default=20, help="Hot PCs to list")
+    parser.add_argument('--folded', help="Write collapsed stacks to this file")
+    args = parser.parse_args()
+
+    machine = Machine()
+    machine.load_elf(args.elf)
+    with Profiler(machine) as profiler:
+        result = machine.run(max_instructions=args.max_instructions)
+    print(f"Stopped: {result.reason}, exit code {result.exit_code}", file=sys.stderr)
+    print(profiler.report(args.top), file=sys.stderr)
+    if args.folded:
+        with open(args.folded, 'w') as file:
+            file.write(profiler.collapsed())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Compressed instruction expansion
+# Maps every 16-bit RV32C encoding to the equivalent 32-bit RV32I instruction, so the predecoders handle
+# compressed code with no special cases. The 65,536-entry table is indexed by the halfword and built on
+# first use (it takes tens of milliseconds). Entries for reserved, floating-point and RV64-only encodings
+# (and halfwords ending in 0b11, which are not compressed) are 0, which the predecoder rejects as an
+# illegal instruction.
+
+from array import array
+
+from assembler import encode_b, encode_i, encode_j, encode_r, encode_s, encode_u
+
+def bits(value, high, low):
+    return (value >> low) & ((1 << (high - low + 1)) - 1)
+
+def sign_extend(value, bit_length):
+    sign_bit = 1 << (bit_length - 1)
+    return (value & (sign_bit - 1)) - (value & sign_bit)
+
+def expand_quadrant0(halfword, funct3):
+    rd = bits(halfword, 4, 2) + 8  # rd' and rs2' name x8-x15
+    rs1 = bits(halfword, 9, 7) + 8
+    if funct3 == 0x0:  # C.ADDI4SPN
+        imm = (bits(halfword, 12, 11) << 4) | (bits(halfword, 10, 7) << 6) | (bits(halfword, 6, 6) << 2) | (bits(halfword, 5, 5) << 3)
+        return encode_i(imm, 2, 0x0, rd, 0x13) if imm else 0
+    imm = (bits(halfword, 12, 10) << 3) | (bits(halfword, 6, 6) << 2) | (bits(halfword, 5, 5) << 6)
+    if funct3 == 0x2:  # C.LW
+        return encode_i(imm, rs1, 0x2, rd, 0x03)
+    if funct3 == 0x6:  # C.SW
+        return encode_s(imm, rd, rs1, 0x2)
+    return 0
+
+def expand_quadrant1(halfword, funct3):
+    rd = bits(halfword, 11, 7)
+    imm = sign_extend((bits(halfword, 12, 12) << 5) | bits(halfword, 6, 2), 6)
+    if funct3 == 0x0:  # C.ADDI, C.NOP
+        return encode_i(imm, rd, 0x0, rd, 0x13)
+    if funct3 == 0x1 or funct3 == 0x5:  # C.JAL, C.J
+        offset = ((bits(halfword, 12, 12) << 11) | (bits(halfword, 11, 11) << 4) | (bits(halfword, 10, 9) << 8) | (bits(halfword, 8, 8) << 10)
+                  | (bits(halfword, 7, 7) << 6) | (bits(halfword, 6, 6) << 7) | (bits(halfword, 5, 3) << 1) | (bits(halfword, 2, 2) << 5))
+        return encode_j(sign_extend(offset, 12), 1 if funct3 == 0x1 else 0)
+    if funct3 == 0x2:  # C.LI
+        return encode_i(imm, 0, 0x0, rd, 0x13)
+    if funct3 == 0x3:
+        if rd == 2:  # C.ADDI16SP
+            offset = ((bits(halfword, 12, 12) << 9) | (bits(halfword, 6, 6) << 4) | (bits(halfword, 5, 5) << 6)
+                      | (bits(halfword, 4, 3) << 7) | (bits(halfword, 2, 2) << 5))
+            return encode_i(sign_extend(offset, 10), 2, 0x0, 2, 0x13) if offset else 0
+        return encode_u(imm << 12, rd, 0x37) if imm else 0  # C.LUI
+    if funct3 == 0x4:
+        rd = bits(halfword, 9, 7) + 8
+        funct2 = bits(halfword, 11, 10)
+        if funct2 == 0x0 or funct2 == 0x1:  # C.SRLI, C.SRAI; shamt[5] must be clear on RV32
+            if bits(halfword, 12, 12):
+                return 0
+            return encode_i((funct2 << 10) | bits(halfword, 6, 2), rd, 0x5, rd, 0x13)
+        if funct2 == 0x2:  # C.ANDI
+            return encode_i(imm, rd, 0x7, rd, 0x13)
+        if bits(halfword, 12, 12):
+            return 0  # C.SUBW and C.ADDW are RV64 only
+        rs2 = bits(halfword, 4, 2) + 8
+        funct7, funct3 = [(0x20, 0x0), (0x00, 0x4), (0x00, 0x6), (0x00, 0x7)][bits(halfword, 6, 5)]  # C.SUB, C.XOR, C.OR, C.AND
+        return encode_r(funct7, rs2, rd, funct3, rd, 0x33)
+    # C.BEQZ, C.BNEZ
+    offset = ((bits(halfword, 12, 12) << 8) | (bits(halfword, 11, 10) << 3) | (bits(halfword, 6, 5) << 6)
+              | (bits(halfword, 4, 3) << 1) | (bits(halfword, 2, 2) << 5))
+    return encode_b(sign_extend(offset, 9), 0, bits(halfword, 9, 7) + 8, 0x0 if funct3 == 0x6 else 0x1)
+
+def expand_quadrant2(halfword, funct3):
+    rd = bits(halfword, 11, 7)
+    rs2 = bits(halfword, 6, 2)
+    if funct3 == 0x0:  # C.SLLI
+        if bits(halfword, 12, 12):
+            return 0
+        return encode_i(rs2, rd, 0x1, rd, 0x13)
+    if funct3 == 0x2:  # C.LWSP
+        imm = (bits(halfword, 12, 12) << 5) | (bits(halfword, 6, 4) << 2) | (bits(halfword, 3, 2) << 6)
+        return encode_i(imm, 2, 0x2, rd, 0x03) if rd else 0
+    if funct3 == 0x4:
+        if not bits(halfword, 12, 12):
+            if rs2:
+                return encode_r(0x00, rs2, 0, 0x0, rd, 0x33)  # C.MV
+            return encode_i(0, rd, 0x0, 0, 0x67) if rd else 0  # C.JR
+        if rs2:
+            return encode_r(0x00, rs2, rd, 0x0, rd, 0x33)  # C.ADD
+        if rd:
+            return encode_i(0, rd, 0x0, 1, 0x67)  # C.JALR
+        return 0x00100073  # C.EBREAK
+    if funct3 == 0x6:  # C.SWSP
+        imm = (bits(halfword, 12, 9) << 2) | (bits(halfword, 8, 7) << 6)
+        return encode_s(imm, rs2, 2, 0x2)
+    return 0
+
+QUADRANTS = [expand_quadrant0, expand_quadrant1, expand_quadrant2]
+
+def expand_compressed(halfword):
+    # 32-bit equivalent of a compressed instruction, or 0 if it is reserved or unsupported
+    quadrant = halfword & 0x3
+    if quadrant == 0x3 or halfword == 0:
+        return 0
+    return QUADRANTS[quadrant](halfword, halfword >> 13)
+
+expansions = None
+
+def expansion_table():
+    global expansions
+    if expansions is None:
+        expansions = array('I', map(expand_compressed, range(1 << 16)))
+    return expansions
@@ -0,0 +1,179 @@
+# Sampling guest profiler
+# Records the guest PC every period instructions and attributes it to the function containing it, using
+# the symbol table of the loaded ELF file. With call stacks on, a shadow stack is kept at every JAL and
+# JALR following the RISC-V calling convention hints (a link register in rd pushes a frame, a jump
+# through ra or t0 with no link pops one, a plain jump to a function start is a tail call), so each
+# sample also carries its callers. Without call stacks the program runs on the fast Machine.run between
+# samples.
+#
+# Counts are estimates in instructions: every sample stands for period instructions. A function's
+# exclusive count covers samples taken in it, its inclusive count samples with it anywhere on the stack.
+#
+#   with SamplingProfiler(machine, period=1000) as sampler:
+#       machine.run()
+#   print(sampler.report())
+#   sampler.write_collapsed(open('guest.folded', 'w'))
+#
+#   python sampler.py prog.elf --period 1000 --folded prog.folded
+
+import argparse
+import sys
+
+from FetchDecodeExecute import Machine, run_stepwise
+
+PERIOD = 1000  # Instructions between samples
+MAX_DEPTH = 1024  # Shadow stack frames kept; the oldest are dropped beyond this
+LINK_REGISTERS = (1, 5)  # ra and t0
+
+class SamplingProfiler:
+    def __init__(self, machine, period=PERIOD, call_stacks=True):
+        self.machine = machine
+        self.period = period
+        self.call_stacks = call_stacks
+        self.countdown = period  # Instructions left until the next sample
+        self.samples = {}  # Stack of frame addresses, ending in the sampled PC -> samples
+        self.stack = [machine.pc]  # Entry PCs of the active functions; the root is any PC in its function
+        self.function_starts = frozenset(machine.symbols.starts)
+
+    def attach(self):
+        machine = self.machine
+        machine.step = self.step
+        machine.run = self.run
+        return self
+
+    def detach(self):
+        del self.machine.step
+        del self.machine.run
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def reset(self):
+        self.samples.clear()
+        self.countdown = self.period
+        self.stack = [self.machine.pc]
+
+    def sample(self, pc):
+        key = tuple(self.stack[:-1]) + (pc,) if self.call_stacks else (pc,)
+        self.samples[key] = self.samples.get(key, 0) + 1
+        self.countdown = self.period
+
+    def step(self):
+        # Machine.step, sampling and following calls and returns
+        machine = self.machine
+        pc = machine.pc
+        predecoded = machine.decode_cache.entries.get(pc)
+        if predecoded is None:
+            predecoded = machine.predecode(machine.fetch()['inst'])
+            machine.decode_cache.insert(pc, predecoded)
+        executed_instruction = machine.execute(machine.expand(predecoded))
+        machine.memory_access(executed_instruction)
+        machine.writeback(executed_instruction)
+        machine.pc = executed_instruction.pc_update
+        self.countdown -= 1
+        if not self.countdown:
+            self.sample(pc)
+        if predecoded.opcode == 0x6f or predecoded.opcode == 0x67:
+            self.transfer(predecoded, machine.pc)
+
+    def transfer(self, predecoded, target):
+        # Updates the shadow stack for a jump to target
+        stack = self.stack
+        link = predecoded.rd in LINK_REGISTERS
+        returning = predecoded.opcode == 0x67 and predecoded.rs1 in LINK_REGISTERS and predecoded.rs1 != predecoded.rd
+        if link and returning:
+            stack[-1] = target  # Coroutine swap: return and call at once
+        elif link:
+            stack.append(target)
+            if len(stack) > MAX_DEPTH:
+                del stack[0]
+        elif returning:
+            if len(stack) > 1:
+                stack.pop()
+            else:
+                stack[0] = target  # Returned past the first frame seen; continue in the caller
+        elif target in self.function_starts:
+            stack[-1] = target  # Tail call
+
+    def run(self, max_instructions=None, until_pc=None, until_ecall_exit=True):
+        machine = self.machine
+        if self.call_stacks:
+            return run_stepwise(machine, self.step, max_instructions, until_pc, until_ecall_exit, self.record_exit)
+        # PC samples only: run at full speed up to each sample point
+        count = 0
+        while True:
+            budget = self.countdown if max_instructions is None else min(self.countdown, max_instructions - count)
+            result = type(machine).run(machine, budget, until_pc, until_ecall_exit)
+            count += result.instructions
+            self.countdown -= result.instructions
+            if not self.countdown:
+                self.sample(machine.pc)
+            if result.reason != 'max_instructions' or count == max_instructions:
+                return result._replace(instructions=count)
+
+    def record_exit(self, predecoded):
+        self.countdown -= 1
+        if not self.countdown:
+            self.sample(self.machine.pc)
+
+    def collapsed_counts(self):
+        # Function name stack (root first) -> estimated instructions
+        name = self.machine.symbols.name
+        counts = {}
+        for frames, samples in self.samples.items():
+            key = tuple(name(frame) for frame in frames)
+            counts[key] = counts.get(key, 0) + samples * self.period
+        return counts
+
+    def function_counts(self):
+        # Function name -> [inclusive, exclusive] estimated instructions
+        counts = {}
+        for names, instructions in self.collapsed_counts().items():
+            for function in set(names):  # Recursion counts once towards inclusive
+                counts.setdefault(function, [0, 0])[0] += instructions
+            counts[names[-1]][1] += instructions
+        return counts
+
+    def report(self, limit=20):
+        counts = self.function_counts()
+        total = sum(samples for samples in self.samples.values()) * self.period
+        lines = [f"Samples: {sum(self.samples.values())} (one per {self.period} instructions, ~{total} instructions)", ""]
+        lines.append(f"{'inclusive':>12} {'%':>6} {'exclusive':>12} {'%':>6}  function")
+        for function, (inclusive, exclusive) in sorted(counts.items(), key=lambda item: item[1][1], reverse=True)[:limit]:
+            lines.append(f"{inclusive:>12} {100 * inclusive / max(total, 1):>6.1f} {exclusive:>12} {100 * exclusive / max(total, 1):>6.1f}  {function}")
+        return '\n'.join(lines)
+
+    def write_collapsed(self, file):
+        # Collapsed stacks (caller;callee instructions) for flamegraph tools, one line at a time
+        for names, instructions in sorted(self.collapsed_counts().items()):
+            file.write(f"{';'.join(names)} {instructions}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an ELF file under the sampling guest profiler")
+    parser.add_argument('elf', help="RV32 ELF file to run")
+    parser.add_argument('--period', type=int, default=PERIOD, help="Instructions between samples")
+    parser.add_argument('--no-call-stacks', action='store_true', help="Sample PCs only, running at full speed between samples")
+    parser.add_argument('--max-instructions', type=int, help="Stop after this many instructions")
+    parser.add_argument('--top', type=int, default=20, help="Functions to list")
+    parser.add_argument('--folded', help="Write collapsed stacks to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    machine = Machine()
+    machine.load_elf(args.elf)
+    if not len(machine.symbols):
+        print("No symbol table; functions are reported by address", file=sys.stderr)
+    with SamplingProfiler(machine, args.period, call_stacks=not args.no_call_stacks) as sampler:
+        result = machine.run(max_instructions=args.max_instructions)
+    print(f"Stopped: {result.reason}, exit code {result.exit_code}", file=sys.stderr)
+    print(sampler.report(args.top), file=sys.stderr)
+    if args.folded == '-':
+        sampler.write_collapsed(sys.stdout)
+    elif args.folded:
+        with open(args.folded, 'w') as file:
+            sampler.write_collapsed(file)
+
+if __name__ == '__main__':
+    main()
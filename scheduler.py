@@ -0,0 +1,106 @@
+# Cooperative scheduler for many Machines in one process
+# Each machine runs as an asyncio task in slices of slice_instructions, yielding to the event loop
+# between slices. A guest blocked in getchar is parked until its AsyncConsole has input, and guest exit
+# is returned as that machine's SessionResult instead of ending the process.
+#
+#   python scheduler.py prog.elf --port 7000    # one guest per TCP connection
+
+import argparse
+import asyncio
+import itertools
+from collections import namedtuple
+
+from console import AsyncConsole
+from ELF import ElfFile
+from FetchDecodeExecute import Machine
+
+SLICE_INSTRUCTIONS = 10000  # Instructions a machine runs before yielding
+
+# status is 'exit', 'max_instructions', 'cancelled' or 'error'
+SessionResult = namedtuple('SessionResult', ['name', 'status', 'exit_code', 'instructions', 'error'])
+
+class Session:
+    def __init__(self, machine, name, max_instructions=None):
+        self.machine = machine
+        self.name = name
+        self.max_instructions = max_instructions
+        self.instructions = 0
+        self.task = None
+
+class Scheduler:
+    def __init__(self, slice_instructions=SLICE_INSTRUCTIONS):
+        self.slice_instructions = slice_instructions
+        self.sessions = {}  # name -> Session
+        self.names = itertools.count()
+
+    def add(self, machine, name=None, max_instructions=None):
+        # Starts running machine on the current event loop; returns the Session, whose task yields a SessionResult.
+        # Machines that read input should have an AsyncConsole, or getchar blocks the whole loop.
+        if name is None:
+            name = next(self.names)
+        session = Session(machine, name, max_instructions)
+        session.task = asyncio.ensure_future(self.run_session(session))
+        self.sessions[name] = session
+        return session
+
+    async def run_session(self, session):
+        machine = session.machine
+        console = machine.console
+        try:
+            while True:
+                budget = self.slice_instructions
+                if session.max_instructions is not None:
+                    budget = min(budget, session.max_instructions - session.instructions)
+                result = machine.run(max_instructions=budget)
+                session.instructions += result.instructions
+                if isinstance(console, AsyncConsole):
+                    await console.drain()
+                if result.reason == 'exit':
+                    return SessionResult(session.name, 'exit', result.exit_code, session.instructions, None)
+                if session.max_instructions is not None and session.instructions >= session.max_instructions:
+                    return SessionResult(session.name, 'max_instructions', None, session.instructions, None)
+                if result.reason == 'blocked':
+                    await console.receive()
+                else:
+                    await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            return SessionResult(session.name, 'cancelled', None, session.instructions, None)
+        except Exception as error:
+            return SessionResult(session.name, 'error', None, session.instructions, f'{type(error).__name__}: {error}')
+        finally:
+            machine.console.flush()
+
+    async def wait(self):
+        # Results of every session added so far, in the order they were added
+        return await asyncio.gather(*(session.task for session in self.sessions.values()))
+
+async def serve(elf_path, host='127.0.0.1', port=7000, slice_instructions=SLICE_INSTRUCTIONS, max_instructions=None):
+    # Serves a fresh guest per TCP connection; all guests share one ELF mapping and one event loop
+    elf = ElfFile(elf_path)
+    scheduler = Scheduler(slice_instructions)
+
+    async def connect(reader, writer):
+        machine = Machine()
+        machine.console = AsyncConsole(reader, writer)
+        machine.load_elf(elf)
+        result = await scheduler.add(machine, max_instructions=max_instructions).task
+        del scheduler.sessions[result.name]
+        print(f"Session {result.name}: {result.status}, exit code {result.exit_code}, {result.instructions} instructions" + (f", {result.error}" if result.error else ''))
+        writer.close()
+
+    server = await asyncio.start_server(connect, host, port)
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve an ELF guest to many TCP clients")
+    parser.add_argument('elf', help="RV32 ELF file to run for each connection")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on")
+    parser.add_argument('--port', type=int, default=7000, help="Port to listen on")
+    parser.add_argument('--slice', type=int, default=SLICE_INSTRUCTIONS, help="Instructions per time slice")
+    parser.add_argument('--max-instructions', type=int, help="Stop a session after this many instructions")
+    args = parser.parse_args()
+    asyncio.run(serve(args.elf, args.host, args.port, args.slice, args.max_instructions))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Snapshot and restore of a Machine's architectural state and console input position. Unread input
+# already taken from the console's source is saved with it, so a restored guest's getchar continues
+# where it left off.
+
+import struct
+import zlib
+
+from memory import PAGE_SIZE, ZERO_PAGE
+
+SNAPSHOT_MAGIC = b'RVSN'
+SNAPSHOT_VERSION = 2
+FLAG_COMPRESSED = 0x1
+FLAG_INPUT_EOF = 0x2
+
+# magic, version, flags, pc, x0-x31, page count, input bytes consumed, pending input length.
+# The pending input follows the header, then the page records.
+SNAPSHOT_HEADER_FORMAT = '<4sHHI32iIQI'
+SNAPSHOT_HEADER_SIZE = struct.calcsize(SNAPSHOT_HEADER_FORMAT)
+# Each page record is its page number followed by PAGE_SIZE bytes; pages that are all zero are omitted
+PAGE_RECORD_FORMAT = '<I'
+PAGE_RECORD_SIZE = 4 + PAGE_SIZE
+
+def snapshot(machine, compress=False):
+    pages = [(number, page) for number, page in sorted(machine.memory.pages.items()) if page != ZERO_PAGE]
+    body = bytearray(len(pages) * PAGE_RECORD_SIZE)
+    offset = 0
+    for number, page in pages:
+        struct.pack_into(PAGE_RECORD_FORMAT, body, offset, number)
+        body[offset + 4:offset + PAGE_RECORD_SIZE] = page
+        offset += PAGE_RECORD_SIZE
+
+    position, pending, eof = machine.console.input_state()
+    flags = FLAG_INPUT_EOF if eof else 0
+    if compress:
+        body = zlib.compress(body, 1)
+        flags |= FLAG_COMPRESSED
+    header = struct.pack(SNAPSHOT_HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags, machine.pc, *machine.registers,
+                         len(pages), position, len(pending))
+    return header + pending + body
+
+def restore(machine, data):
+    # Uncompressed snapshots are not copied: each page is a read-only view of data, copied on first write
+    header = struct.unpack_from(SNAPSHOT_HEADER_FORMAT, data, 0)
+    if header[0] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a machine snapshot")
+    if header[1] != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {header[1]}")
+    flags = header[2]
+    page_count, position, pending_length = header[-3:]
+
+    pending = bytes(memoryview(data)[SNAPSHOT_HEADER_SIZE:SNAPSHOT_HEADER_SIZE + pending_length])
+    body = memoryview(data)[SNAPSHOT_HEADER_SIZE + pending_length:]
+    if flags & FLAG_COMPRESSED:
+        body = memoryview(zlib.decompress(body))
+    if len(body) != page_count * PAGE_RECORD_SIZE:
+        raise ValueError("Truncated snapshot")
+    body = body.toreadonly()
+
+    memory = machine.memory
+    memory.dirty.update(memory.pages)  # Pages dropped or replaced here changed too
+    memory.pages.clear()
+    memory.forget_all()
+    for offset in range(0, len(body), PAGE_RECORD_SIZE):
+        number = struct.unpack_from(PAGE_RECORD_FORMAT, body, offset)[0]
+        memory.pages[number] = body[offset + 4:offset + PAGE_RECORD_SIZE]
+    memory.dirty.update(memory.pages)
+
+    machine.pc = header[3]
+    machine.registers[:] = header[4:36]
+    machine.console.restore_input(position, pending, bool(flags & FLAG_INPUT_EOF))
+    for cache in machine.code_caches:
+        cache.clear()
+
+def save_snapshot(machine, filename, compress=True):
+    with open(filename, 'wb') as file:
+        file.write(snapshot(machine, compress))
+
+def load_snapshot(machine, filename):
+    with open(filename, 'rb') as file:
+        restore(machine, file.read())
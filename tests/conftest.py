@@ -0,0 +1,24 @@
+# Shared test setup
+# The modules are flat files in the repository root, so the root goes on sys.path as it does when the
+# tools are run from there. The engine fixture runs a machine to its exit ecall (or another stop) with
+# each execution engine in turn and returns the RunResult.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from FetchDecodeExecute import run_stepwise
+from translate import BlockTranslator
+
+ENGINES = {
+    'step': lambda machine, max_instructions=None: run_stepwise(machine, machine.step, max_instructions),
+    'run': lambda machine, max_instructions=None: machine.run(max_instructions),
+    'translate': lambda machine, max_instructions=None: BlockTranslator(machine).run(max_instructions),
+}
+
+@pytest.fixture(params=sorted(ENGINES))
+def engine(request):
+    return ENGINES[request.param]
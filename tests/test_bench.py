@@ -0,0 +1,20 @@
+# Benchmark workloads finish with the checksum their Python models expect
+
+import pytest
+
+import bench
+from assembler import load_program
+from FetchDecodeExecute import ALU_OPERATIONS, Machine, alu_nop
+
+@pytest.mark.parametrize('engine', ['run', 'translate'])
+@pytest.mark.parametrize('workload', sorted(bench.WORKLOADS))
+def test_workload_checksum(workload, engine):
+    machine = Machine()
+    load_program(machine, bench.WORKLOADS[workload](1))
+    instructions, exit_code = bench.run_engine(machine, engine)
+    assert exit_code == bench.EXPECTED[workload](1)
+
+def test_no_op_multiply_fails_the_case(monkeypatch):
+    monkeypatch.setitem(ALU_OPERATIONS, 'Mul', alu_nop)
+    with pytest.raises(ValueError, match='checksum'):
+        bench.run_case('muldiv', 'run', 1, 1, 0)
@@ -0,0 +1,119 @@
+# Delta checkpoint log: rewinding, branching and recovery from a torn record
+
+import os
+
+import pytest
+
+from assembler import load_program
+from checkpoint import CheckpointLog, KIND_BASE, run_with_checkpoints
+from console import Console
+from FetchDecodeExecute import Machine
+from memory import ZERO_PAGE
+
+# Writes two words into each KiB of 64 KiB at 0x100000, clears every other page again, then reads two
+# bytes of input into the exit code
+SOURCE = '''
+    li s0, 0x100000
+    li t0, 0
+    li t1, 64
+fill:
+    slli t2, t0, 10
+    add t2, s0, t2
+    sw t0, 0(t2)
+    sw t1, 4(t2)
+    addi t0, t0, 1
+    blt t0, t1, fill
+    li t0, 0
+clear:
+    slli t2, t0, 10
+    add t2, s0, t2
+    sw zero, 0(t2)
+    sw zero, 4(t2)
+    addi t0, t0, 8
+    blt t0, t1, clear
+    li a7, 2
+    ecall
+    mv s1, a0
+    ecall
+    slli s1, s1, 8
+    or a0, s1, a0
+    li a7, 0
+    ecall
+'''
+INPUT = b'ok'
+EVERY = 37
+
+def make_machine(input=INPUT):
+    machine = Machine()
+    load_program(machine, SOURCE)
+    machine.console = Console(input=input)
+    return machine
+
+def state(machine):
+    pages = {number: bytes(page) for number, page in machine.memory.pages.items() if page != ZERO_PAGE}
+    return machine.pc, list(machine.registers), pages
+
+def reference(instructions):
+    machine = make_machine()
+    machine.run(max_instructions=instructions)
+    return state(machine)
+
+@pytest.fixture
+def log(tmp_path):
+    machine = make_machine()
+    with CheckpointLog(str(tmp_path / 'run.rvck'), base_interval=3) as log:
+        result = run_with_checkpoints(machine, log, EVERY)
+        assert result.exit_code == int.from_bytes(INPUT, 'big')
+        yield log
+
+def test_chains_start_at_a_base(log):
+    kinds = [checkpoint.kind for checkpoint in log.checkpoints]
+    assert len(kinds) > 8
+    assert kinds[0] == kinds[4] == KIND_BASE
+    assert all(checkpoint.depth <= 3 for checkpoint in log.checkpoints)
+
+def test_restore_every_checkpoint(log):
+    for number, checkpoint in enumerate(log.checkpoints):
+        machine = Machine()
+        instructions = log.restore(machine, number)
+        assert instructions == checkpoint.instructions
+        assert state(machine) == reference(instructions)
+
+def test_rewind_a_machine_that_ran_ahead(log):
+    # Pages written after the checkpoint must be dropped or reverted, not merged
+    machine = make_machine()
+    machine.run()
+    for number in (len(log.checkpoints) - 1, 5, 1, 0):
+        instructions = log.restore(machine, number)
+        assert state(machine) == reference(instructions)
+
+def test_rewound_run_resumes_its_input(log):
+    for number in range(len(log.checkpoints)):
+        machine = Machine()
+        machine.console = Console(input=b'??')
+        log.restore(machine, number)
+        assert machine.run().exit_code == int.from_bytes(INPUT, 'big')
+
+def test_branch_from_a_rewound_checkpoint(log):
+    machine = Machine()
+    instructions = log.restore(machine, 5)
+    machine.run(max_instructions=50)
+    number = log.checkpoint(machine, instructions + 50)
+    assert log.checkpoints[number].parent == 5
+
+    branched = Machine()
+    assert log.restore(branched, number) == instructions + 50
+    assert state(branched) == reference(instructions + 50)
+
+def test_reopen_drops_a_torn_record(log, tmp_path):
+    filename = str(tmp_path / 'run.rvck')
+    count = len(log.checkpoints)
+    log.close()
+    os.truncate(filename, os.path.getsize(filename) - 10)
+
+    with CheckpointLog(filename, base_interval=3) as reopened:
+        assert len(reopened.checkpoints) == count - 1
+        machine = Machine()
+        instructions = reopened.restore(machine)
+        assert state(machine) == reference(instructions)
+        assert reopened.checkpoint(machine, instructions) == count - 1  # Written over the torn record
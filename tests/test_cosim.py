@@ -0,0 +1,63 @@
+# Differential co-simulation: random cases, fixed input and locating an injected fault
+
+import pytest
+
+from assembler import load_program
+from cosim import Cosim, check_case
+from FetchDecodeExecute import Machine
+
+@pytest.mark.parametrize('engine', ['run', 'translate'])
+def test_random_cases_agree(engine):
+    for seed in range(40):
+        assert check_case(seed, engine, interval=64) is None
+
+def make_machine(source):
+    machine = Machine()
+    labels = load_program(machine, source)
+    return machine, labels
+
+ECHO = '''
+    li s0, 3
+loop:
+    li a7, 2
+    ecall
+    li a7, 1
+    ecall
+    addi s0, s0, -1
+    bnez s0, loop
+    li a7, 0
+    ecall
+'''
+
+@pytest.mark.parametrize('engine', ['run', 'translate'])
+def test_both_sides_read_the_same_input(engine):
+    reference = make_machine(ECHO)[0]
+    candidate = make_machine(ECHO)[0]
+    cosim = Cosim(reference, candidate, engine, interval=4, input=b'abc')
+    assert cosim.run() is None
+    assert reference.console.output.getvalue() == candidate.console.output.getvalue() == b'abc'
+    assert reference.registers[10] == ord('c')
+
+def test_fault_is_located():
+    source = '''
+    li t0, 0
+    li t1, 500
+loop:
+    addi t0, t0, 1
+    blt t0, t1, loop
+fault:
+    mv a0, t0
+    li a7, 0
+    ecall
+'''
+    reference = make_machine(source)[0]
+    candidate, labels = make_machine(source)
+    pc = labels['fault']
+    predecoded = candidate.predecode(candidate.read_instruction(pc))
+    candidate.decode_cache.insert(pc, predecoded._replace(imm=1))  # Decodes as addi a0, t0, 1
+
+    divergence = Cosim(reference, candidate, 'run', interval=256).run()
+    assert divergence is not None
+    assert (divergence.instructions, divergence.pc) == (2 + 2 * 500 + 1, pc)
+    assert divergence.instruction == predecoded.inst
+    assert 'x10: 0x000001f4 != 0x000001f5' in divergence.differences
@@ -0,0 +1,119 @@
+# Decoding of RV32C compressed instructions, the M extension and SYSTEM instructions on every engine
+
+import struct
+
+import pytest
+
+from assembler import encode_i, encode_r, load_program
+from FetchDecodeExecute import Machine
+from rvc import expansion_table
+from writeback import GuestBreakpoint
+
+INT_MIN = -0x80000000
+
+# Halfword -> 32-bit expansion, encoded by hand from the RVC tables
+EXPANSIONS = [
+    (0x0001, encode_i(0, 0, 0x0, 0, 0x13)),  # c.nop
+    (0x4505, encode_i(1, 0, 0x0, 10, 0x13)),  # c.li a0, 1
+    (0x1141, encode_i(-16, 2, 0x0, 2, 0x13)),  # c.addi sp, -16
+    (0x952e, encode_r(0x00, 11, 10, 0x0, 10, 0x33)),  # c.add a0, a1
+    (0x4108, encode_i(0, 10, 0x2, 10, 0x03)),  # c.lw a0, 0(a0)
+    (0x8082, encode_i(0, 1, 0x0, 0, 0x67)),  # c.jr ra
+    (0xa001, 0x0000006f),  # c.j 0
+    (0x9002, 0x00100073),  # c.ebreak
+]
+
+@pytest.mark.parametrize('halfword, expanded', EXPANSIONS)
+def test_expansion(halfword, expanded):
+    assert expansion_table()[halfword] == expanded
+
+@pytest.mark.parametrize('halfword', [0x0000, 0x0003, 0xffff])
+def test_reserved_and_uncompressed_expand_to_zero(halfword):
+    assert expansion_table()[halfword] == 0
+
+def test_compressed_predecode_keeps_halfword():
+    predecoded = Machine().predecode(0x952e)
+    assert (predecoded.inst, predecoded.size, predecoded.aluop) == (0x952e, 2, 'Add')
+
+def load_halfwords(machine, halfwords, tail=()):
+    # Writes compressed instructions followed by 32-bit ones at 0x1000
+    code = b''.join(struct.pack('<H', halfword) for halfword in halfwords)
+    code += b''.join(struct.pack('<I', word) for word in tail)
+    machine.memory.write(0x1000, code)
+    machine.pc = 0x1000
+
+def test_compressed_loop(engine):
+    # Sums 10..1 in a loop of compressed instructions, then exits with 32-bit ones
+    machine = Machine()
+    load_halfwords(machine, [
+        0x4501,  # c.li a0, 0
+        0x45a9,  # c.li a1, 10
+        0x952e,  # loop: c.add a0, a1
+        0x15fd,  # c.addi a1, -1
+        0xfdf5,  # c.bnez a1, loop
+    ], [encode_i(0, 0, 0x0, 17, 0x13), 0x00000073])
+    result = engine(machine)
+    assert (result.reason, result.exit_code, result.instructions) == ('exit', 55, 34)
+    assert machine.pc == 0x100e
+
+def test_reserved_compressed_raises(engine):
+    machine = Machine()
+    load_program(machine, '''
+    li a0, 5
+    addi a0, a0, 1
+''')  # Runs into zeroed memory
+    with pytest.raises(ValueError, match='Illegal instruction 0x0000'):
+        engine(machine)
+    assert machine.pc == 0x1008
+    assert machine.registers[10] == 6
+
+M_CASES = [
+    ('div', 7, 0, -1),
+    ('divu', 7, 0, -1),
+    ('rem', 7, 0, 7),
+    ('remu', -7, 0, -7),
+    ('div', INT_MIN, -1, INT_MIN),
+    ('rem', INT_MIN, -1, 0),
+    ('div', -7, 2, -3),  # Rounds towards zero
+    ('rem', -7, 2, -1),
+    ('divu', -1, 2, 0x7fffffff),
+    ('mul', INT_MIN, -1, INT_MIN),
+    ('mulh', INT_MIN, INT_MIN, 0x40000000),
+    ('mulh', -1, -1, 0),
+    ('mulhu', -1, -1, -2),
+    ('mulhsu', -1, -1, -1),  # -1 * 0xffffffff
+    ('mulhsu', INT_MIN, -1, INT_MIN),
+    ('mulhsu', 3, -1, 2),
+]
+
+@pytest.mark.parametrize('mnemonic, left, right, expected', M_CASES)
+def test_m_extension(engine, mnemonic, left, right, expected):
+    machine = Machine()
+    load_program(machine, f'''
+    li a1, {left}
+    li a2, {right}
+    {mnemonic} a0, a1, a2
+    li a7, 0
+    ecall
+''')
+    assert engine(machine).exit_code == expected
+
+def test_ebreak_stops_at_the_breakpoint(engine):
+    machine = Machine()
+    load_program(machine, '''
+    li a0, 5
+    li a7, 0
+    ebreak
+    ecall
+''')
+    with pytest.raises(GuestBreakpoint) as error:
+        engine(machine)
+    assert error.value.pc == machine.pc == 0x1008
+    assert machine.registers[10] == 5
+
+def test_compressed_ebreak(engine):
+    machine = Machine()
+    load_halfwords(machine, [0x4505, 0x9002], [encode_i(0, 0, 0x0, 17, 0x13), 0x00000073])
+    with pytest.raises(GuestBreakpoint):
+        engine(machine)
+    assert machine.pc == 0x1002
@@ -0,0 +1,136 @@
+# ELF function symbols: lookup, fallback on malformed section data, and the sampling profiler
+
+import random
+import struct
+
+import pytest
+
+from assembler import assemble
+from ELF import ElfFile, SymbolTable
+from FetchDecodeExecute import Machine
+from sampler import SamplingProfiler
+
+BASE = 0x10000
+CODE_OFFSET = 0x1000
+
+# _start calls spin, which loops before calling leaf; the exit code is the loop count
+SOURCE = '''
+_start:
+    li a0, 0
+    call spin
+    li a7, 0
+    ecall
+spin:
+    mv s0, ra
+    li t0, 3000
+loop:
+    addi a0, a0, 1
+    addi t0, t0, -1
+    bnez t0, loop
+    call leaf
+    jalr x0, 0(s0)
+leaf:
+    addi a0, a0, 0
+    ret
+'''
+
+def build_elf():
+    # Executable with one PT_LOAD segment and .text, .symtab and .strtab sections. Returns the file
+    # bytes and the offsets of the section headers, symbol table and string table.
+    code, labels = assemble(SOURCE, BASE)
+    symbols = [('_start', labels['_start'], 0, 0), ('spin', labels['spin'], labels['leaf'] - labels['spin'], 2),
+               ('leaf', labels['leaf'], 8, 2), ('.Lloop', labels['loop'], 0, 0)]
+    strtab = b'\0'
+    symtab = bytes(16)
+    for name, value, size, kind in symbols:
+        symtab += struct.pack('<IIIBBH', len(strtab), value, size, (1 << 4) | kind, 0, 1)
+        strtab += name.encode() + b'\0'
+    symtab += struct.pack('<IIIBBH', 0, 0x20000, 4, (1 << 4) | 1, 0, 1)  # Data object, ignored
+
+    symtab_offset = CODE_OFFSET + len(code)
+    strtab_offset = symtab_offset + len(symtab)
+    section_offset = (strtab_offset + len(strtab) + 3) & ~3
+    sections = [
+        bytes(40),
+        struct.pack('<10I', 0, 1, 0x6, BASE, CODE_OFFSET, len(code), 0, 0, 4, 0),
+        struct.pack('<10I', 0, 2, 0, 0, symtab_offset, len(symtab), 3, 1, 4, 16),
+        struct.pack('<10I', 0, 3, 0, 0, strtab_offset, len(strtab), 0, 0, 1, 0),
+    ]
+    data = bytearray(struct.pack('<4sBBBBB7xHHIIIIIHHHHHH', b'\x7fELF', 1, 1, 1, 0, 0, 2, 243, 1, BASE, 52,
+                                 section_offset, 0, 52, 32, 1, 40, len(sections), 0))
+    data += struct.pack('<8I', 1, CODE_OFFSET, BASE, BASE, len(code), len(code), 5, 0x1000)
+    data += bytes(CODE_OFFSET - len(data)) + code + symtab + strtab
+    data += bytes(section_offset - len(data)) + b''.join(sections)
+    return data, section_offset, symtab_offset, strtab_offset
+
+def run_file(tmp_path, data):
+    path = tmp_path / 'prog.elf'
+    path.write_bytes(data)
+    machine = Machine()
+    machine.load_elf(str(path))
+    return machine, machine.run()
+
+def test_function_symbols(tmp_path):
+    data = build_elf()[0]
+    path = tmp_path / 'prog.elf'
+    path.write_bytes(data)
+    with ElfFile(str(path)) as elf:
+        symbols = elf.symbols()
+    assert symbols.names == ['_start', 'spin', 'leaf']  # Data objects and local labels are skipped
+    assert symbols.lookup(BASE).name == '_start'
+    assert symbols.lookup(BASE + 4).end == symbols.starts[1]  # Sizeless labels extend to the next symbol
+    assert symbols.name(symbols.starts[1] + 8) == 'spin'
+    assert symbols.lookup(symbols.ends[2]) is None
+    assert symbols.name(0x20000) == '0x00020000'
+
+def test_sized_symbol_wins_over_an_alias():
+    symbols = SymbolTable([(0x100, 0, 'label'), (0x100, 16, 'function'), (0x100, 16, 'alias')])
+    assert len(symbols) == 1
+    assert symbols.lookup(0x10f).name == 'alias'
+
+def corrupt(data, offset, fmt, value):
+    data = bytearray(data)
+    struct.pack_into(fmt, data, offset, value)
+    return data
+
+def malformed_files():
+    data, sections, symtab, strtab = build_elf()
+    yield 'section table past the end', corrupt(data, 32, '<I', len(data) + 100)
+    yield 'missing string table', corrupt(data, sections + 2 * 40 + 24, '<I', 99)
+    yield 'symbol in a missing section', corrupt(data, symtab + 16 + 14, '<H', 500)
+    yield 'symbol table past the end', corrupt(data, sections + 2 * 40 + 20, '<I', 10 ** 6)
+    yield 'name past the string table', corrupt(data, symtab + 16, '<I', 10 ** 6)
+    strtab_size = struct.unpack_from('<I', data, sections + 3 * 40 + 20)[0]
+    yield 'unterminated name', data[:strtab] + b'x' * strtab_size + data[strtab + strtab_size:]
+    yield 'truncated section table', data[:sections + 50]
+
+@pytest.mark.parametrize('name, data', list(malformed_files()))
+def test_malformed_sections_fall_back_to_no_symbols(tmp_path, name, data):
+    machine, result = run_file(tmp_path, data)
+    assert len(machine.symbols) == 0
+    assert result.exit_code == 3000
+
+def test_corrupted_symbol_data_never_stops_loading(tmp_path):
+    data, sections, symtab, strtab = build_elf()
+    rng = random.Random(0)
+    for _ in range(300):
+        damaged = bytearray(data)
+        for _ in range(rng.randint(1, 8)):
+            damaged[rng.randrange(symtab, len(damaged))] = rng.getrandbits(8)
+        machine, result = run_file(tmp_path, damaged)
+        assert result.exit_code == 3000
+
+@pytest.mark.parametrize('call_stacks', [True, False])
+def test_sampler_attributes_samples_to_functions(tmp_path, call_stacks):
+    path = tmp_path / 'prog.elf'
+    path.write_bytes(build_elf()[0])
+    machine = Machine()
+    machine.load_elf(str(path))
+    with SamplingProfiler(machine, period=100, call_stacks=call_stacks) as sampler:
+        result = machine.run()
+    assert result.exit_code == 3000
+    counts = sampler.function_counts()
+    assert counts['spin'][1] >= 8900
+    if call_stacks:
+        assert counts['_start'][0] >= counts['spin'][0]  # spin runs under _start
+        assert ('_start', 'spin') in sampler.collapsed_counts()
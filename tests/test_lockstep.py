@@ -0,0 +1,113 @@
+# Lockstep lanes against the scalar interpreter, lane by lane
+
+import io
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from assembler import load_program
+from console import Console
+from FetchDecodeExecute import Machine
+from lockstep import Lockstep
+
+REGION = 0x100000
+
+# Counts the Collatz steps of a0, storing each value into a ring at REGION, so lanes branch apart and
+# reconverge. Odd lanes then divide INT_MIN by -1 and even lanes divide by zero. The exit code folds
+# in the step count, the M-extension results and one byte of input, which is also echoed.
+SOURCE = f'''
+    li s0, {REGION}
+    mv t0, a0
+    li t1, 0
+    li t5, 1
+loop:
+    beq t0, t5, done
+    andi t2, t0, 1
+    beqz t2, even
+    slli t3, t0, 1
+    add t0, t0, t3
+    addi t0, t0, 1
+    j next
+even:
+    li t3, 2
+    div t0, t0, t3
+next:
+    addi t1, t1, 1
+    andi t2, t1, 63
+    slli t2, t2, 2
+    add t2, s0, t2
+    sw t0, 0(t2)
+    j loop
+done:
+    andi t2, a0, 1
+    slli s2, t2, 31
+    neg s3, t2
+    div a1, s2, s3
+    rem a2, s2, s3
+    divu a3, s2, s3
+    remu a4, s2, s3
+    mulh a5, s2, s3
+    mulhsu a6, s2, s3
+    mulhu t4, s2, s3
+    xor a1, a1, a2
+    xor a1, a1, a3
+    xor a1, a1, a4
+    xor a1, a1, a5
+    xor a1, a1, a6
+    xor a1, a1, t4
+    li a7, 2
+    ecall
+    mv s4, a0
+    li a7, 1
+    ecall
+    slli a0, s4, 16
+    xor a0, a0, a1
+    add a0, a0, t1
+    li a7, 0
+    ecall
+'''
+
+VALUES = [1, 2, 3, 6, 7, 9, 27, 97, 871, 4, 5, 8, 16, 31, 63, 255]
+
+def make_machine():
+    machine = Machine()
+    load_program(machine, SOURCE)
+    return machine
+
+def lane_memory(lanes, lane, address, size):
+    for start, end, data in lanes.regions:
+        if start <= address and address + size <= end:
+            return bytes(data[lane, address - start:address - start + size])
+    raise IndexError(address)
+
+def test_lanes_match_scalar_runs():
+    lanes = Lockstep(make_machine(), len(VALUES), regions=[(REGION, 0x100)])
+    lanes.registers[:, 10] = VALUES
+    for lane in range(len(VALUES)):
+        lanes.set_input(lane, bytes([65 + lane]))
+    lanes.run()
+    assert not lanes.running.any()
+
+    for lane, value in enumerate(VALUES):
+        machine = make_machine()
+        machine.registers[10] = value
+        machine.console = Console(input=bytes([65 + lane]), output=io.BytesIO())
+        result = machine.run()
+        assert int(lanes.exit_codes[lane]) == result.exit_code
+        assert int(lanes.instructions[lane]) == result.instructions
+        assert int(lanes.pc[lane]) == machine.pc
+        assert lanes.lane_registers(lane) == machine.registers
+        assert lane_memory(lanes, lane, REGION, 0x100) == machine.memory.read(REGION, 0x100)
+        assert bytes(lanes.outputs[lane]) == machine.console.output.getvalue()
+
+def test_max_steps_stops_every_lane_where_scalar_would():
+    lanes = Lockstep(make_machine(), 4, regions=[(REGION, 0x100)])
+    lanes.registers[:, 10] = [1, 27, 6, 7]
+    lanes.run(max_steps=40)
+    for lane, value in enumerate([1, 27, 6, 7]):
+        machine = make_machine()
+        machine.registers[10] = value
+        machine.run(max_instructions=int(lanes.instructions[lane]))
+        assert lanes.lane_registers(lane) == machine.registers
+        assert int(lanes.pc[lane]) == machine.pc
@@ -0,0 +1,116 @@
+# Snapshots and copy-on-write forks
+
+import pytest
+
+from assembler import load_program
+from console import Console
+from devices import Bus, Timer, TIMER_BASE
+from FetchDecodeExecute import Machine
+from memory import ZERO_PAGE
+from snapshot import restore, snapshot
+
+# Fills 256 words at 0x100000 with a0 + index, then reads three bytes of input into the exit code
+SOURCE = '''
+    li s0, 0x100000
+    li t0, 0
+    li t1, 256
+fill:
+    add t2, a0, t0
+    sw t2, 0(s0)
+    addi s0, s0, 4
+    addi t0, t0, 1
+    blt t0, t1, fill
+    li a7, 2
+    ecall
+    mv s1, a0
+    ecall
+    slli s1, s1, 8
+    or s1, s1, a0
+    ecall
+    slli s1, s1, 8
+    or a0, s1, a0
+    li a7, 0
+    ecall
+'''
+
+def make_machine(input=b'abc'):
+    machine = Machine()
+    load_program(machine, SOURCE)
+    machine.console = Console(input=input)
+    return machine
+
+def state(machine):
+    pages = {number: bytes(page) for number, page in machine.memory.pages.items() if page != ZERO_PAGE}
+    return machine.pc, list(machine.registers), pages
+
+def test_fork_shares_pages_until_written():
+    parent = make_machine()
+    parent.run(max_instructions=100)
+    child = parent.fork()
+    number = 0x100000 >> 12
+    assert child.memory.pages[number] is parent.memory.pages[number]
+
+    child.memory.write(0x100000, b'\xff\xff\xff\xff')
+    assert parent.memory.read(0x100000, 4) == bytes(4)
+    parent.memory.write(0x100004, b'\xee')
+    assert child.memory.read(0x100004, 1) == b'\x01'
+
+def test_fork_runs_independently():
+    parent = make_machine()
+    parent.run(max_instructions=500)
+    child = parent.fork()
+    expected = make_machine()
+    expected.run(max_instructions=500)
+
+    child.registers[10] = 0  # Not read again by the fill loop, so both finish alike
+    child_result = child.run()
+    parent_result = parent.run()
+    expected_result = expected.run()
+    assert child_result == parent_result == expected_result
+    assert state(child) == state(parent) == state(expected)
+    assert expected_result.exit_code == int.from_bytes(b'abc', 'big')
+
+def test_fork_after_stores_to_a_cached_page():
+    # The parent's cached write page must not leak its later stores into the child
+    parent = make_machine()
+    parent.run(max_instructions=20)
+    child = parent.fork()
+    before = child.memory.read(0x100000, 1024)
+    parent.run(max_instructions=200)
+    assert child.memory.read(0x100000, 1024) == before
+
+def test_fork_refuses_devices():
+    machine = make_machine()
+    Bus(machine).map(TIMER_BASE, Timer())
+    with pytest.raises(ValueError):
+        machine.fork()
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('instructions', [0, 10, 1287, 1290, 1293])
+def test_snapshot_resumes_like_the_original(compress, instructions):
+    original = make_machine()
+    original.run(max_instructions=instructions)
+    data = snapshot(original, compress)
+    expected = original.run()
+
+    restored = make_machine(input=b'wrong')
+    restore(restored, data)
+    assert restored.run() == expected
+    assert state(restored) == state(original)
+
+def test_restored_pages_are_copied_on_write():
+    original = make_machine()
+    original.run(max_instructions=100)
+    data = snapshot(original)
+    copy = bytes(data)
+    restored = Machine()
+    restore(restored, data)
+    restored.memory.write(0x100000, b'\xff' * 16)
+    assert data == copy
+
+def test_restore_rejects_bad_data():
+    data = snapshot(make_machine())
+    with pytest.raises(ValueError):
+        restore(Machine(), b'XXXX' + data[4:])
+    with pytest.raises(ValueError):
+        restore(Machine(), data[:-1])
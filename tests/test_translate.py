@@ -0,0 +1,114 @@
+# Block translator: self-modifying code, blocking input and instruction budgets
+
+from assembler import encode_i, load_program
+from console import AsyncConsole
+from FetchDecodeExecute import Machine
+from translate import BlockTranslator
+
+PATCH = encode_i(100, 10, 0x0, 10, 0x13)  # addi a0, a0, 100
+
+def test_store_invalidates_an_earlier_block(engine):
+    # Patches a function that already ran, then calls it again
+    machine = Machine()
+    load_program(machine, f'''
+    li a0, 0
+    li t2, {PATCH}
+    jal t3, start
+function:
+    addi a0, a0, 1
+    jalr x0, 0(ra)
+start:
+    call function
+    sw t2, 0(t3)
+    call function
+    li a7, 0
+    ecall
+''')
+    assert engine(machine).exit_code == 101
+
+def test_store_invalidates_the_running_block(engine):
+    # Patches an instruction further down the block that is executing the store
+    machine = Machine()
+    load_program(machine, f'''
+    li a0, 0
+    li t2, {PATCH}
+    jal t3, here
+here:
+    sw t2, 8(t3)
+    nop
+    addi a0, a0, 1
+    li a7, 0
+    ecall
+''')
+    assert engine(machine).exit_code == 100
+
+def test_store_to_a_translated_loop():
+    # The loop body is translated once, then rewritten from inside the loop on its second pass
+    machine = Machine()
+    load_program(machine, f'''
+    li a0, 0
+    li t0, 3
+    li t2, {PATCH}
+    jal t3, loop
+loop:
+    addi a0, a0, 1
+    addi t0, t0, -1
+    li t4, 1
+    bne t0, t4, skip
+    sw t2, 0(t3)
+skip:
+    bnez t0, loop
+    li a7, 0
+    ecall
+''')
+    translator = BlockTranslator(machine)
+    assert translator.run().exit_code == 1 + 1 + 100
+
+def test_blocked_getchar_resumes():
+    source = '''
+    li t0, 10
+loop:
+    addi t0, t0, -1
+    bnez t0, loop
+    li a7, 2
+    ecall
+    li a7, 0
+    ecall
+'''
+    reference = Machine()
+    load_program(reference, source)
+    reference.console = AsyncConsole()
+    machine = Machine()
+    load_program(machine, source)
+    machine.console = AsyncConsole()
+    translator = BlockTranslator(machine)
+
+    expected = reference.run()
+    result = translator.run()
+    assert result == expected
+    assert result.reason == 'blocked'
+    assert machine.pc == reference.pc == 0x1010
+    assert translator.run().instructions == 0  # Still no input
+
+    machine.console.feed(b'x')
+    result = translator.run()
+    assert (result.reason, result.exit_code, result.instructions) == ('exit', ord('x'), 3)
+
+def test_budget_matches_run():
+    source = '''
+    li t0, 0
+    li t1, 1000
+loop:
+    add t2, t2, t0
+    addi t0, t0, 1
+    blt t0, t1, loop
+    li a7, 0
+    ecall
+'''
+    for budget in (1, 2, 5, 64, 65, 1000, 2999):
+        reference = Machine()
+        load_program(reference, source)
+        machine = Machine()
+        load_program(machine, source)
+        assert BlockTranslator(machine).run(budget) == reference.run(budget)
+        assert (machine.pc, machine.registers) == (reference.pc, reference.registers)
@@ -0,0 +1,289 @@
+# Cache and branch predictor timing models
+# Set-associative L1 caches and branch direction predictors that watch a running machine and count
+# hits, misses and mispredicts, for an estimated CPI on a simple in-order core. State lives in flat
+# arrays (one tag array per cache, one counter bytearray per predictor), so each access costs a few
+# integer operations rather than allocating objects.
+#
+# Attaching a TimingModel swaps a step() and run() onto the Machine instance, like Profiler, to see
+# every fetch and branch; a data cache is attached to the MemoryStage's load and store methods, so it
+# also sees the accesses of Machine.run and translated blocks.
+#
+#   model = TimingModel(machine, icache=Cache(16384, 4, 64), dcache=Cache(16384, 4, 64), predictor=GsharePredictor())
+#   with model:
+#       machine.run()
+#   print(model.report())
+#
+#   python timing.py prog.elf --icache 16384:4:64 --dcache 16384:4:64 --predictor gshare
+
+import argparse
+import random
+from array import array
+
+from FetchDecodeExecute import Machine, run_stepwise
+from memory import LOAD_STRUCTS, STORE_STRUCTS
+
+MISS_PENALTY = 20  # Cycles added by an L1 miss
+MISPREDICT_PENALTY = 2  # Cycles lost by a mispredicted conditional branch
+
+class Cache:
+    # Tags are stored as line numbers, one array slot per way. With LRU replacement each set is kept in
+    # most-recently-used order, so a hit or fill is a slice move within the set.
+    def __init__(self, size, associativity, line_size, policy='lru', seed=0):
+        if line_size & (line_size - 1) or size % (associativity * line_size):
+            raise ValueError("Line size must be a power of two dividing the cache into whole sets")
+        sets = size // (associativity * line_size)
+        if sets & (sets - 1):
+            raise ValueError("Number of sets must be a power of two")
+        if policy not in ('lru', 'random'):
+            raise ValueError(f"Unknown replacement policy {policy!r}")
+        self.size = size
+        self.ways = associativity
+        self.line_size = line_size
+        self.policy = policy
+        self.line_shift = line_size.bit_length() - 1
+        self.set_mask = sets - 1
+        self.lru = policy == 'lru'
+        self.random = random.Random(seed)
+        self.tags = array('q', [-1]) * (sets * associativity)
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        self.tags = array('q', [-1]) * len(self.tags)
+        self.hits = self.misses = 0
+
+    def access(self, address, size=1):
+        # Returns True on a hit; an access straddling two lines touches both
+        line = address >> self.line_shift
+        hit = self.access_line(line)
+        if (address + size - 1) >> self.line_shift != line:
+            hit = self.access_line(line + 1) and hit
+        return hit
+
+    def access_line(self, line):
+        tags = self.tags
+        ways = self.ways
+        base = (line & self.set_mask) * ways
+        if tags[base] == line:
+            self.hits += 1
+            return True
+        for way in range(base + 1, base + ways):
+            if tags[way] == line:
+                self.hits += 1
+                if self.lru:
+                    tags[base + 1:way + 1] = tags[base:way]
+                    tags[base] = line
+                return True
+        self.misses += 1
+        if self.lru:
+            tags[base + 1:base + ways] = tags[base:base + ways - 1]
+            tags[base] = line
+        else:
+            tags[base + self.random.randrange(ways)] = line
+        return False
+
+    def accesses(self):
+        return self.hits + self.misses
+
+    def miss_rate(self):
+        return self.misses / self.accesses() if self.accesses() else 0.0
+
+class BranchPredictor:
+    # Direction predictor for conditional branches; subclasses implement predict() and update()
+    def __init__(self):
+        self.branches = 0
+        self.mispredicts = 0
+
+    def predict(self, pc, target):
+        return False
+
+    def update(self, pc, taken):
+        pass
+
+    def record(self, pc, target, taken):
+        # Predicts, trains and counts one resolved branch; returns the prediction
+        predicted = self.predict(pc, target)
+        self.update(pc, taken)
+        self.branches += 1
+        if predicted != taken:
+            self.mispredicts += 1
+        return predicted
+
+    def accuracy(self):
+        return 1.0 - self.mispredicts / self.branches if self.branches else 0.0
+
+class StaticPredictor(BranchPredictor):
+    # Backward taken, forward not taken; or never taken with backward_taken=False
+    def __init__(self, backward_taken=True):
+        super().__init__()
+        self.backward_taken = backward_taken
+
+    def predict(self, pc, target):
+        return self.backward_taken and target < pc
+
+class BimodalPredictor(BranchPredictor):
+    # Table of 2-bit saturating counters indexed by PC
+    def __init__(self, entries=4096):
+        super().__init__()
+        if entries & (entries - 1):
+            raise ValueError("Predictor table size must be a power of two")
+        self.mask = entries - 1
+        self.counters = bytearray([1]) * entries  # Weakly not taken
+
+    def index(self, pc):
+        return (pc >> 2) & self.mask
+
+    def predict(self, pc, target):
+        return self.counters[self.index(pc)] >= 2
+
+    def update(self, pc, taken):
+        index = self.index(pc)
+        counter = self.counters[index]
+        if taken:
+            if counter < 3:
+                self.counters[index] = counter + 1
+        elif counter > 0:
+            self.counters[index] = counter - 1
+
+class GsharePredictor(BimodalPredictor):
+    # 2-bit counters indexed by PC xor global branch history
+    def __init__(self, entries=4096, history_bits=12):
+        super().__init__(entries)
+        self.history_mask = (1 << history_bits) - 1
+        self.history = 0
+
+    def index(self, pc):
+        return ((pc >> 2) ^ self.history) & self.mask
+
+    def update(self, pc, taken):
+        super().update(pc, taken)
+        self.history = ((self.history << 1) | taken) & self.history_mask
+
+PREDICTORS = {
+    'static': StaticPredictor,
+    'bimodal': BimodalPredictor,
+    'gshare': GsharePredictor,
+}
+
+class TimingModel:
+    def __init__(self, machine, icache=None, dcache=None, predictor=None,
+                 miss_penalty=MISS_PENALTY, mispredict_penalty=MISPREDICT_PENALTY):
+        self.machine = machine
+        self.icache = icache
+        self.dcache = dcache
+        self.predictor = predictor
+        self.miss_penalty = miss_penalty
+        self.mispredict_penalty = mispredict_penalty
+        self.instructions = 0
+
+    def attach(self):
+        machine = self.machine
+        machine.step = self.step
+        machine.run = self.run
+        if self.dcache is not None:
+            stage = machine.memory_stage
+            self.stage_load = stage.load_funct3
+            self.stage_store = stage.store_funct3
+            stage.load_funct3 = self.load
+            stage.store_funct3 = self.store
+        return self
+
+    def detach(self):
+        machine = self.machine
+        del machine.step
+        del machine.run
+        if self.dcache is not None:
+            del machine.memory_stage.load_funct3
+            del machine.memory_stage.store_funct3
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def load(self, address, funct3):
+        self.dcache.access(address, LOAD_STRUCTS[funct3].size)
+        return self.stage_load(address, funct3)
+
+    def store(self, address, funct3, value):
+        self.dcache.access(address, STORE_STRUCTS[funct3].size)  # Write-allocate
+        self.stage_store(address, funct3, value)
+
+    def step(self):
+        # Machine.step with an instruction fetch through the I-cache and branches through the predictor
+        machine = self.machine
+        pc = machine.pc
+        if self.icache is not None:
+            self.icache.access(pc, 4)  # A compressed instruction may be followed by another in the same fetch
+        predecoded = machine.decode_cache.entries.get(pc)
+        if predecoded is None:
+            predecoded = machine.predecode(machine.fetch()['inst'])
+            machine.decode_cache.insert(pc, predecoded)
+        executed_instruction = machine.execute(machine.expand(predecoded))
+        machine.memory_access(executed_instruction)
+        machine.writeback(executed_instruction)
+        machine.pc = executed_instruction.pc_update
+        self.instructions += 1
+        if predecoded.opcode == 0x63 and self.predictor is not None:
+            self.predictor.record(pc, (pc + predecoded.imm) & 0xffffffff, machine.pc != (pc + predecoded.size) & 0xffffffff)
+
+    def run(self, max_instructions=None, until_pc=None, until_ecall_exit=True):
+        return run_stepwise(self.machine, self.step, max_instructions, until_pc, until_ecall_exit, self.record_exit)
+
+    def record_exit(self, predecoded):
+        if self.icache is not None:
+            self.icache.access(self.machine.pc, 4)
+        self.instructions += 1
+
+    def cycles(self):
+        # One cycle per instruction plus miss and mispredict penalties
+        misses = sum(cache.misses for cache in (self.icache, self.dcache) if cache is not None)
+        mispredicts = self.predictor.mispredicts if self.predictor is not None else 0
+        return self.instructions + misses * self.miss_penalty + mispredicts * self.mispredict_penalty
+
+    def cpi(self):
+        return self.cycles() / self.instructions if self.instructions else 0.0
+
+    def report(self):
+        lines = [f"Instructions: {self.instructions}"]
+        for name, cache in (('I-cache', self.icache), ('D-cache', self.dcache)):
+            if cache is not None:
+                lines.append(f"{name}:      {cache.hits} hits, {cache.misses} misses ({cache.miss_rate():.2%} miss rate)")
+        if self.predictor is not None:
+            predictor = self.predictor
+            lines.append(f"Branches:     {predictor.branches}, {predictor.mispredicts} mispredicted ({predictor.accuracy():.2%} accuracy)")
+        lines.append(f"Cycles:       {self.cycles()} (estimated)")
+        lines.append(f"CPI:          {self.cpi():.3f}")
+        return '\n'.join(lines)
+
+def cache_spec(text):
+    # size:associativity:line_size[:policy]
+    fields = text.split(':')
+    if len(fields) not in (3, 4):
+        raise argparse.ArgumentTypeError("Expected size:associativity:line_size[:lru|random]")
+    try:
+        return Cache(*[int(field, 0) for field in fields[:3]], *fields[3:])
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an ELF file through cache and branch predictor models")
+    parser.add_argument('elf', help="RV32 ELF file to run")
+    parser.add_argument('--icache', type=cache_spec, help="L1 instruction cache, size:associativity:line_size[:policy]")
+    parser.add_argument('--dcache', type=cache_spec, help="L1 data cache, size:associativity:line_size[:policy]")
+    parser.add_argument('--predictor', choices=sorted(PREDICTORS), help="Branch predictor")
+    parser.add_argument('--miss-penalty', type=int, default=MISS_PENALTY, help="Cycles per cache miss")
+    parser.add_argument('--mispredict-penalty', type=int, default=MISPREDICT_PENALTY, help="Cycles per mispredicted branch")
+    parser.add_argument('--max-instructions', type=int, help="Stop after this many instructions")
+    args = parser.parse_args()
+
+    machine = Machine()
+    machine.load_elf(args.elf)
+    predictor = PREDICTORS[args.predictor]() if args.predictor else None
+    with TimingModel(machine, args.icache, args.dcache, predictor, args.miss_penalty, args.mispredict_penalty) as model:
+        machine.run(max_instructions=args.max_instructions)
+    print(model.report())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Instruction trace recorder
+# Records every retired instruction as a fixed 24-byte record: pc, instruction word, flags, rd, access
+# size, value written to rd, memory address and memory value. Records are packed into a preallocated
+# buffer and written as zlib-compressed chunks, so memory use is bounded by the chunk size however long
+# the trace runs. Attaching swaps traced step() and run() methods onto one Machine instance, like
+# Profiler; untraced machines are unaffected.
+#
+#   with Tracer(machine, 'prog.trace'):
+#       machine.run()
+#   for record in read_trace('prog.trace'):
+#       ...
+#
+#   python tracer.py record prog.elf prog.trace
+#   python tracer.py dump prog.trace --limit 100
+
+import argparse
+import struct
+import zlib
+from collections import namedtuple
+
+from FetchDecodeExecute import Machine, run_stepwise
+from writeback import GuestExit
+
+try:
+    import numpy
+except ImportError:  # Only needed by read_trace_arrays
+    numpy = None
+
+TRACE_MAGIC = b'RVTR'
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct('<4sHH')  # magic, version, record size
+CHUNK_HEADER = struct.Struct('<II')  # records, compressed bytes
+RECORD = struct.Struct('<IIBBBxIII')  # pc, inst, flags, rd, size, value, address, data
+CHUNK_RECORDS = 65536
+
+# Record flags
+TRACE_WRITE = 0x1  # rd was written; value holds the new register value
+TRACE_LOAD = 0x2  # address and data hold the location and value loaded
+TRACE_STORE = 0x4  # address and data hold the location and value stored
+
+SIZE_MASKS = {1: 0xff, 2: 0xffff, 4: 0xffffffff}
+
+TraceRecord = namedtuple('TraceRecord', ['pc', 'inst', 'flags', 'rd', 'size', 'value', 'address', 'data'])
+
+if numpy is not None:
+    TRACE_DTYPE = numpy.dtype([('pc', '<u4'), ('inst', '<u4'), ('flags', 'u1'), ('rd', 'u1'), ('size', 'u1'), ('pad', 'u1'),
+                               ('value', '<u4'), ('address', '<u4'), ('data', '<u4')])
+
+class Tracer:
+    def __init__(self, machine, filename, chunk_records=CHUNK_RECORDS, level=1):
+        self.machine = machine
+        self.file = open(filename, 'wb')
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, RECORD.size))
+        self.level = level
+        self.buffer = bytearray(chunk_records * RECORD.size)
+        self.offset = 0
+        self.records = 0  # Written so far, including the buffered chunk
+
+    def attach(self):
+        self.machine.step = self.step
+        self.machine.run = self.run
+        return self
+
+    def detach(self):
+        del self.machine.step
+        del self.machine.run
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+        self.close()
+
+    def record(self, pc, inst, flags, rd, size, value, address, data):
+        RECORD.pack_into(self.buffer, self.offset, pc, inst, flags, rd, size, value, address, data)
+        self.offset += RECORD.size
+        self.records += 1
+        if self.offset == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        if not self.offset:
+            return
+        compressed = zlib.compress(memoryview(self.buffer)[:self.offset], self.level)
+        self.file.write(CHUNK_HEADER.pack(self.offset // RECORD.size, len(compressed)))
+        self.file.write(compressed)
+        self.offset = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def step(self):
+        # Machine.step, recording the instruction's effects
+        machine = self.machine
+        pc = machine.pc
+        predecoded = machine.decode_cache.entries.get(pc)
+        if predecoded is None:
+            predecoded = machine.predecode(machine.fetch()['inst'])
+            machine.decode_cache.insert(pc, predecoded)
+        executed_instruction = machine.execute(machine.expand(predecoded))
+
+        flags = size = address = data = 0
+        memop = predecoded.memop
+        if memop:
+            address = executed_instruction.result & 0xffffffff
+            size = machine.get_size(predecoded.funct3)
+            if memop == 'store':
+                flags = TRACE_STORE
+                data = executed_instruction.strval & SIZE_MASKS[size]
+            else:
+                flags = TRACE_LOAD
+        machine.memory_access(executed_instruction)
+        if memop == 'load':
+            data = executed_instruction.result & SIZE_MASKS[size]
+
+        rd = predecoded.rd
+        if predecoded.aluop == 'ecall':
+            rd = 10 if machine.registers[17] == 2 else 0  # getchar writes a0
+        try:
+            machine.writeback(executed_instruction)
+        except GuestExit:
+            self.record(pc, predecoded.inst, flags, 0, size, 0, address, data)
+            raise
+        machine.pc = executed_instruction.pc_update
+
+        value = 0
+        if rd:
+            flags |= TRACE_WRITE
+            value = machine.registers[rd] & 0xffffffff
+        self.record(pc, predecoded.inst, flags, rd or 0, size, value, address, data)
+
+    def run(self, max_instructions=None, until_pc=None, until_ecall_exit=True):
+        return run_stepwise(self.machine, self.step, max_instructions, until_pc, until_ecall_exit, self.record_exit)
+
+    def record_exit(self, predecoded):
+        self.record(self.machine.pc, predecoded.inst, 0, 0, 0, 0, 0, 0)
+
+def read_chunks(filename):
+    # Yields the uncompressed record bytes of each chunk
+    with open(filename, 'rb') as file:
+        magic, version, record_size = TRACE_HEADER.unpack(file.read(TRACE_HEADER.size))
+        if magic != TRACE_MAGIC:
+            raise ValueError("Not an instruction trace")
+        if version != TRACE_VERSION or record_size != RECORD.size:
+            raise ValueError(f"Unsupported trace version {version}")
+        while True:
+            header = file.read(CHUNK_HEADER.size)
+            if not header:
+                return
+            if len(header) != CHUNK_HEADER.size:
+                raise ValueError("Truncated trace")
+            records, length = CHUNK_HEADER.unpack(header)
+            data = zlib.decompress(file.read(length))
+            if len(data) != records * RECORD.size:
+                raise ValueError("Truncated trace")
+            yield data
+
+def read_trace(filename):
+    # Streams TraceRecords one at a time
+    for data in read_chunks(filename):
+        for fields in RECORD.iter_unpack(data):
+            yield TraceRecord._make(fields)
+
+def read_trace_arrays(filename):
+    # Streams one NumPy structured array (TRACE_DTYPE) per chunk
+    if numpy is None:
+        raise ImportError("read_trace_arrays requires NumPy")
+    for data in read_chunks(filename):
+        yield numpy.frombuffer(data, TRACE_DTYPE)
+
+def format_record(record):
+    text = f"{record.pc:08x}: {record.inst:08x}"
+    if record.flags & TRACE_WRITE:
+        text += f"  x{record.rd} = 0x{record.value:08x}"
+    if record.flags & TRACE_LOAD:
+        text += f"  load{record.size} [0x{record.address:08x}] = 0x{record.data:x}"
+    if record.flags & TRACE_STORE:
+        text += f"  store{record.size} [0x{record.address:08x}] = 0x{record.data:x}"
+    return text
+
+def main():
+    parser = argparse.ArgumentParser(description="Record or print instruction traces")
+    commands = parser.add_subparsers(dest='command', required=True)
+    record = commands.add_parser('record', help="Run an ELF file and record its trace")
+    record.add_argument('elf', help="RV32 ELF file to run")
+    record.add_argument('trace', help="Trace file to write")
+    record.add_argument('--max-instructions', type=int, help="Stop after this many instructions")
+    dump = commands.add_parser('dump', help="Print a trace file")
+    dump.add_argument('trace', help="Trace file to read")
+    dump.add_argument('--limit', type=int, help="Print at most this many records")
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        machine = Machine()
+        machine.load_elf(args.elf)
+        with Tracer(machine, args.trace) as tracer:
+            result = machine.run(max_instructions=args.max_instructions)
+        print(f"Stopped: {result.reason}, {tracer.records} records")
+    else:
+        for count, entry in enumerate(read_trace(args.trace)):
+            if count == args.limit:
+                break
+            print(format_record(entry))
+
+if __name__ == '__main__':
+    main()
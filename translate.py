@@ -0,0 +1,269 @@
+# Basic-block translator
+# Compiles straight-line guest code into Python functions cached by entry PC
+
+from collections import namedtuple
+
+from FetchDecodeExecute import RunResult
+from memory import PAGE_SHIFT
+
+MAX_BLOCK_LENGTH = 64  # Instructions per translated block
+
+# Python expressions equivalent to ALU.perform_operation; other operations call the ALU directly
+ALU_TEMPLATES = {
+    'Add': '{0} + {1}',
+    'Sub': '{0} - {1}',
+    'Mul': '{0} * {1}',
+    'MulH': '({0} * {1}) >> 32',
+    'MulHSU': '({0} * ({1} & 0xffffffff)) >> 32',
+    'MulHU': '(({0} & 0xffffffff) * ({1} & 0xffffffff)) >> 32',
+    'LeftShift': '{0} << ({1} & 0x1f)',
+    'RightShiftA': '{0} >> ({1} & 0x1f)',
+    'RightShiftL': '({0} & 0xffffffff) >> ({1} & 0x1f)',
+    'Or': '{0} | {1}',
+    'Xor': '{0} ^ {1}',
+    'And': '{0} & {1}',
+    'Slt': '(1 if {0} < {1} else 0)',
+    'SltU': '(1 if ({0} & 0xffffffff) < ({1} & 0xffffffff) else 0)',
+}
+
+# Operations whose result is already a signed 32-bit value for signed 32-bit operands
+IN_RANGE_OPERATIONS = {'And', 'Or', 'Xor', 'Slt', 'SltU', 'RightShiftA'}
+
+# Branch conditions on two signed register values, indexed by funct3
+BRANCH_TEMPLATES = {
+    0x0: '{0} == {1}',  # BEQ
+    0x1: '{0} != {1}',  # BNE
+    0x4: '{0} < {1}',  # BLT
+    0x5: '{0} >= {1}',  # BGE
+    0x6: '({0} & 0xffffffff) < ({1} & 0xffffffff)',  # BLTU
+    0x7: '({0} & 0xffffffff) >= ({1} & 0xffffffff)',  # BGEU
+}
+
+# A translated block; line_pcs maps each generated source line back to its guest PC
+Block = namedtuple('Block', ['function', 'start', 'end', 'length', 'line_pcs'])
+
+def register(num):
+    return '0' if num == 0 else f'r[{num}]'
+
+def literal(value):
+    return f'({value})' if value < 0 else str(value)
+
+def signed32(value):
+    value &= 0xffffffff
+    return value - ((value & 0x80000000) << 1)
+
+class BlockTranslator:
+    def __init__(self, machine):
+        self.machine = machine
+        self.blocks = {}  # Entry PC -> Block
+        self.page_blocks = {}  # Page -> entry PCs of blocks overlapping it
+        machine.code_caches.append(self)
+
+    def translate(self, pc):
+        machine = self.machine
+        lines = [f'def block_{pc:x}(r, load, store, invalidate, alu, syscall, machine, budget, stop_on_exit):', '    n = 0', '    while True:']
+        line_pcs = [pc, pc, pc]
+        start = pc
+        length = 0
+
+        def emit(text):
+            lines.append('        ' + text)
+            line_pcs.append(pc)
+
+        while True:
+            try:
+                predecoded = machine.predecode(machine.read_instruction(pc))
+            except Exception:
+                if length == 0:
+                    raise  # Same error step() would raise on the fetch
+                emit(f'return {pc}, n + {length}')
+                break
+            length += 1
+            if self.emit_instruction(emit, predecoded, pc, start, length):
+                pc += predecoded.size
+                break
+            pc += predecoded.size
+            if length == MAX_BLOCK_LENGTH or pc >= 1 << 32:  # Blocks never wrap around the address space
+                emit(f'return {pc & 0xffffffff}, n + {length}')
+                break
+
+        namespace = {}
+        exec(compile('\n'.join(lines), f'<block 0x{start:x}>', 'exec'), namespace)
+        return self.install(Block(namespace[f'block_{start:x}'], start, pc, length, line_pcs))
+
+    def install(self, block):
+        # Adds a block, translated here or loaded from a persistent cache
+        self.blocks[block.start] = block
+        for page in range(block.start >> PAGE_SHIFT, ((block.end - 1) >> PAGE_SHIFT) + 1):
+            self.page_blocks.setdefault(page, set()).add(block.start)
+        return block
+
+    def emit_instruction(self, emit, predecoded, pc, start, length):
+        # Emits one instruction; returns True if it ends the block.
+        # Returned counts include n, the instructions retired by earlier iterations of a self-looping block.
+        # A returned PC of None means the block stopped at the exit ecall.
+        inst, opcode, rd, rs1, rs2, funct3, funct7, imm, aluop, memop, size, operation = predecoded
+        left = register(rs1) if rs1 is not None else 'None'
+        next_pc = (pc + size) & 0xffffffff
+
+        if opcode == 0x33 or opcode == 0x13:  # R-type and OP-IMM
+            if rd:
+                right = register(rs2) if opcode == 0x33 else literal(imm)
+                self.emit_result(emit, rd, aluop, left, right)
+        elif opcode == 0x37:  # LUI
+            if rd:
+                emit(f'r[{rd}] = {imm}')
+        elif opcode == 0x17:  # AUIPC
+            if rd:
+                emit(f'r[{rd}] = {signed32(pc + imm)}')
+        elif memop == 'load':
+            value = f'load(({left} + {literal(imm)}) & 0xffffffff, {funct3})'
+            emit(f'r[{rd}] = {value}' if rd else value)
+        elif memop == 'store':
+            emit(f'a = ({left} + {literal(imm)}) & 0xffffffff')
+            emit(f'store(a, {funct3}, {register(rs2)})')
+            emit(f'if invalidate(a, {self.machine.get_size(funct3)}): return {next_pc}, n + {length}')
+        elif opcode == 0x63:  # BRANCH
+            condition = BRANCH_TEMPLATES.get(funct3)
+            if condition is None:
+                emit(f'return {next_pc}, n + {length}')
+                return True
+            condition = condition.format(left, register(rs2))
+            target = (pc + imm) & 0xffffffff
+            if target == start:
+                # Loop back to the top of the block without returning while the budget allows
+                emit(f'n += {length}')
+                emit(f'if {condition}:')
+                emit(f'    if n + {length} <= budget: continue')
+                emit(f'    return {target}, n')
+                emit(f'return {next_pc}, n')
+            else:
+                emit(f'return ({target} if {condition} else {next_pc}), n + {length}')
+            return True
+        elif opcode == 0x6f:  # JAL
+            if rd:
+                emit(f'r[{rd}] = {signed32(next_pc)}')
+            emit(f'return {(pc + imm) & 0xffffffff}, n + {length}')
+            return True
+        elif opcode == 0x67:  # JALR
+            emit(f't = ({left} + {literal(imm)}) & 0xfffffffe')
+            if rd:
+                emit(f'r[{rd}] = {signed32(next_pc)}')
+            emit(f'return t, n + {length}')
+            return True
+        elif aluop == 'ecall':
+            emit(f'machine.pc = {pc}')
+            emit(f'if stop_on_exit and r[17] == 0: return None, n + {length}')
+            emit('syscall.ecall()')
+            emit(f'return {next_pc}, n + {length}')
+            return True
+        elif aluop == 'ebreak':
+            emit(f'machine.pc = {pc}')
+            emit('syscall.ebreak()')
+            return True
+        elif rd:  # Anything else just writes the ALU result, as in Machine.execute
+            right = literal(imm) if imm is not None else 'None'
+            self.emit_result(emit, rd, aluop, left, right)
+        return False
+
+    def emit_result(self, emit, rd, aluop, left, right):
+        template = ALU_TEMPLATES.get(aluop)
+        if template is None:
+            expression = f'alu({aluop!r}, {left}, {right})'
+        else:
+            expression = template.format(left, right)
+        if aluop in IN_RANGE_OPERATIONS:
+            emit(f'r[{rd}] = {expression}')
+        else:
+            emit(f'v = ({expression}) & 0xffffffff')
+            emit(f'r[{rd}] = v - ((v & 0x80000000) << 1)')
+
+    def invalidate(self, address, size):
+        end = address + size
+        dropped = False
+        for page in range(address >> PAGE_SHIFT, ((end - 1) >> PAGE_SHIFT) + 1):
+            entries = self.page_blocks.get(page)
+            if not entries:
+                continue
+            for entry in list(entries):
+                block = self.blocks.get(entry)
+                if block is None:
+                    entries.discard(entry)
+                elif block.start < end and address < block.end:
+                    del self.blocks[entry]
+                    entries.discard(entry)
+                    dropped = True
+        return dropped
+
+    def clear(self):
+        self.blocks.clear()
+        self.page_blocks.clear()
+
+    def run(self, max_instructions=None, until_ecall_exit=True):
+        # Runs translated blocks like Machine.run and returns a RunResult
+        machine = self.machine
+        blocks = self.blocks
+        r = machine.registers
+        load = machine.memory_stage.load_funct3
+        store = machine.memory_stage.store_funct3
+        invalidate = machine.invalidate_code
+        alu = machine.alu.perform_operation
+        syscall = machine.write_back.syscall
+        count = 0
+        pc = machine.pc
+        unlimited = max_instructions is None
+        budget = 1 << 62 if unlimited else max_instructions
+
+        try:
+            while unlimited or count < budget:
+                block = blocks.get(pc)
+                if block is None:
+                    block = self.translate(pc)
+                if count + block.length > budget:
+                    # Finish the budget one instruction at a time
+                    result = machine.run(budget - count, until_ecall_exit=until_ecall_exit)
+                    return RunResult(result.reason, count + result.instructions, result.exit_code)
+                try:
+                    pc, retired = block.function(r, load, store, invalidate, alu, syscall, machine, budget - count, until_ecall_exit)
+                except BlockingIOError as error:
+                    # Input not ready for getchar or a device; the instruction is left current, as in Machine.run
+                    machine.pc, retired = self.blocked_at(block, error)
+                    return RunResult('blocked', count + retired, None)
+                except BaseException as error:
+                    machine.pc = self.faulting_pc(block, error)
+                    raise
+                count += retired
+                if pc is None:
+                    return RunResult('exit', count, r[10])
+                machine.pc = pc
+            return RunResult('max_instructions', count, None)
+        finally:
+            machine.console.flush()
+
+    def block_frame(self, block, error):
+        # Traceback entry of the block function, or None if it raised before entering it
+        traceback = error.__traceback__
+        while traceback is not None:
+            if traceback.tb_frame.f_code is block.function.__code__:
+                return traceback
+            traceback = traceback.tb_next
+        return None
+
+    def faulting_pc(self, block, error):
+        # Maps the generated source line that raised back to the guest instruction
+        traceback = self.block_frame(block, error)
+        return block.start if traceback is None else block.line_pcs[traceback.tb_lineno - 1]
+
+    def blocked_at(self, block, error):
+        # (PC, instructions retired) for a block interrupted by error: n from earlier iterations of a
+        # self-looping block, plus the instructions ahead of the faulting one in this iteration
+        traceback = self.block_frame(block, error)
+        if traceback is None:
+            return block.start, 0
+        pc = block.line_pcs[traceback.tb_lineno - 1]
+        retired = traceback.tb_frame.f_locals.get('n', 0)
+        address = block.start
+        while address < pc:
+            address += self.machine.predecode(self.machine.read_instruction(address)).size
+            retired += 1
+        return pc, retired
@@ -1,40 +1,51 @@
+class GuestExit(SystemExit):
+    # Raised by the exit system call; code holds the guest's exit code
+    pass
+
+class GuestBreakpoint(Exception):
+    # Raised by EBREAK, which is left as the current instruction; pc holds its address
+    def __init__(self, pc):
+        super().__init__(f"Breakpoint at 0x{pc:08x}")
+        self.pc = pc
+
 class WriteBack:
     def __init__(self, machine):
         self.machine = machine
         self.syscall = SystemCall(machine)
 
     def writeback(self, decoded_instruction):
-        rd = decoded_instruction['rd']
-        result = decoded_instruction['result']
+        if decoded_instruction.aluop == 'ecall':
+            self.syscall.ecall()
+            return
+        if decoded_instruction.aluop == 'ebreak':
+            self.syscall.ebreak()
 
-        if rd == 0:  # Writes to x0 are discarded
+        rd = decoded_instruction.rd
+        if not rd:  # Writes to x0 are discarded
             return
 
-        if decoded_instruction['inst'] & 0x7f == 0x73:
-            self.syscall.ecall()
-        else:
-            if rd is not None:
-                self.machine.registers[rd] = result
+        # Registers hold signed 32-bit values
+        result = decoded_instruction.result & 0xffffffff
+        self.machine.registers[rd] = result - ((result & 0x80000000) << 1)
 
     def update_pc(self, decoded_instruction):
-        inst = decoded_instruction['inst']
-        opcode = inst & 0x7f
+        opcode = decoded_instruction.opcode  # Of the expansion for a compressed instruction
         current_pc = self.machine.pc
 
         # JAL or JALR
         if opcode in {0x6f, 0x67}:  # 0x6f for JAL and 0x67 for JALR
-            self.machine.pc = decoded_instruction['result']  # Result contains target address
+            self.machine.pc = decoded_instruction.pc_update  # Target address computed in execute
 
         # BRANCH
         elif opcode == 0x63:
-            if decoded_instruction['branch_taken']:
-                self.machine.pc = current_pc + decoded_instruction['imm']  # imm contains the branch target offset
+            if decoded_instruction.branch_taken:
+                self.machine.pc = (current_pc + decoded_instruction.imm) & 0xffffffff  # imm contains the branch target offset
             else:
-                self.machine.pc = current_pc + 4  # Next instruction
+                self.machine.pc = (current_pc + decoded_instruction.size) & 0xffffffff  # Next instruction
 
         # Non-BRANCH or Non-JUMP
         else:
-            self.machine.pc = current_pc + 4
+            self.machine.pc = (current_pc + decoded_instruction.size) & 0xffffffff
 
 class SystemCall:
     def __init__(self, machine):
@@ -53,18 +64,22 @@ class SystemCall:
         else:
             raise ValueError("Unknown system call")
 
+    def ebreak(self):
+        self.machine.console.flush()
+        raise GuestBreakpoint(self.machine.pc)
+
     def exit(self):
         exit_code = self.machine.registers[10]  # x10 holds the exit code
+        self.machine.console.flush()
         print(f"Exit with code {exit_code}")
-        exit(exit_code)
+        raise GuestExit(exit_code)
 
     def putchar(self):
-        char = chr(self.machine.registers[10])  # x10 holds the character to print
-        print(char, end='')
+        self.machine.console.write(self.machine.registers[10])  # x10 holds the character to print
 
     def getchar(self):
-        char = input("Input a character: ")[0]
-        self.machine.registers[10] = ord(char)  # Store the character in x10
+        self.machine.registers[10] = self.machine.console.read()  # Store the character in x10, -1 at end of input
 
     def debug(self):
+        self.machine.console.flush()
         print("Debug system call")
\ No newline at end of file